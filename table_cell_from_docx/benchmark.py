@@ -0,0 +1,619 @@
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from table_detector import ssim_diff, exact_diff, tables_from_mask, \
+    locate_tables_by_color_image, locate_tables_by_vector, \
+    compare_page_images, coarse_table_regions, locate_tables_in_regions, \
+    FUCHSIA, SSIM_WINDOW
+from cell_detector import _drop_nested_cells, _box_in_box_xywh, \
+    cell_borders_detection_image, cell_borders_detection_vector
+from palette import Palette
+from rasterizer import Rasterizer, fitz
+from dataset_reader import DatasetReader
+from image_encoder import ImageEncoder, decode_image
+
+
+def synthetic_page_pair(seed, with_tables=True):
+    """
+    Build a 300 DPI page with text-like blocks rendered twice: with fuchsia
+    and with aqua outside table borders
+    """
+    rng = np.random.RandomState(seed)
+    page = np.full((3300, 2550, 3), 255, dtype=np.uint8)
+    # Lines of "text"
+    for y in range(200, 3100, 60):
+        for x in range(200, 2300, 90):
+            if rng.rand() < 0.8:
+                cv2.rectangle(page, (x, y), (x + rng.randint(30, 80), y + 30),
+                              (40, 40, 40), -1)
+    tables = []
+    if with_tables:
+        for y in (300, 1700):
+            x = rng.randint(150, 300)
+            w = rng.randint(1500, 2000)
+            h = rng.randint(600, 1200)
+            tables.append((x, y, w, h))
+            # Keep the text away from the table borders
+            cv2.rectangle(page, (x, y), (x + w, y + h), (255, 255, 255), 20)
+    pages = []
+    for color in [(255, 0, 255), (255, 255, 0)]:
+        image = page.copy()
+        for (x, y, w, h) in tables:
+            cv2.rectangle(image, (x, y), (x + w, y + h), color, 1,
+                          cv2.LINE_AA)
+        pages.append(image)
+    return pages
+
+
+def pdf_page_pairs(pdf_fuchsia, pdf_aqua):
+    """
+    Render the pages of the fuchsia and the aqua pdf of one document
+    """
+    with Rasterizer(pdf_fuchsia) as fuchsia, Rasterizer(pdf_aqua) as aqua:
+        page_count = min(fuchsia.page_count, aqua.page_count)
+        return [(fuchsia.render(i), aqua.render(i))
+                for i in range(page_count)]
+
+
+def benchmark_diff(page_pairs, repeat):
+    """
+    Compare the SSIM and the exact difference of page pairs: time and
+    traced peak memory per page and the table rectangles found
+    """
+    engines = [
+        ("ssim", ssim_diff),
+        ("exact", exact_diff),
+    ]
+    reference = None
+    for name, engine in engines:
+        rects = []
+        start = time.time()
+        for _ in range(repeat):
+            for img1, img2 in page_pairs:
+                engine(img1, img2)
+        seconds = (time.time() - start) / repeat / len(page_pairs)
+
+        # Memory allocated by numpy, OpenCV buffers are not traced
+        tracemalloc.start()
+        for i, (img1, img2) in enumerate(page_pairs):
+            thresh = engine(img1, img2)
+            if thresh is None:
+                rects.append({})
+                continue
+            rects.append(tables_from_mask(
+                "page_%i.png" % i, img1, thresh, table_folder=None))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        if reference is None:
+            reference = rects
+        same, off = _compare_rects(reference, rects)
+        print("%-20s %8.1f ms/page %8.1f MB peak  same rects: %i, "
+              "max offset: %i px" % (
+                  name, seconds * 1000, peak / 2 ** 20, same, off))
+
+
+def synthetic_pdf(pdf_path, pages, seed=0, border_color=(1, 0, 1)):
+    """
+    Write a pdf with text-like lines and, on every second page, a table
+    whose outside border is drawn in fuchsia (or border_color) segment by
+    segment, as the renderers export cell borders
+    """
+    rng = np.random.RandomState(seed)
+    document = fitz.open()
+    for i in range(pages):
+        page = document.new_page(width=612, height=792)
+        for y in range(60, 740, 14):
+            page.insert_text((72, y), "text " * rng.randint(5, 15),
+                             fontsize=9)
+        if i % 2:
+            continue
+        x0, y0 = 72, rng.randint(100, 300)
+        rows, cols = rng.randint(3, 12), rng.randint(2, 6)
+        cell_w, cell_h = 460 / cols, 18
+        for row in range(rows):
+            for col in range(cols):
+                rect = fitz.Rect(x0 + col * cell_w, y0 + row * cell_h,
+                                 x0 + (col + 1) * cell_w,
+                                 y0 + (row + 1) * cell_h)
+                page.draw_rect(rect, color=(0, 0, 0), width=0.5)
+                for side, edge in [(row == 0, (rect.tl, rect.tr)),
+                                   (row == rows - 1, (rect.bl, rect.br)),
+                                   (col == 0, (rect.tl, rect.bl)),
+                                   (col == cols - 1, (rect.tr, rect.br))]:
+                    if side:
+                        page.draw_line(*edge, color=border_color,
+                                       width=0.375)
+    document.save(pdf_path)
+
+
+def benchmark_vector(pdf_fuchsia, repeat):
+    """
+    Compare finding the tables by the fuchsia color on the rendered pages
+    and in the vector paths of the pdf: time per page and the rectangles
+    """
+    engines = [
+        ("render + mask", lambda pdf, i, name: locate_tables_by_color_image(
+            name, pdf.render(i), None)),
+        ("vector", lambda pdf, i, name: locate_tables_by_vector(
+            name, pdf.color_extents(i, FUCHSIA), pdf.page_size(i),
+            lambda locs: pdf.render_regions(i, locs), None)),
+    ]
+    reference = None
+    with Rasterizer(pdf_fuchsia) as pdf:
+        for name, engine in engines:
+            start = time.time()
+            for _ in range(repeat):
+                rects = [engine(pdf, i, "page_%i.png" % i) or {}
+                         for i in range(pdf.page_count)]
+            seconds = (time.time() - start) / repeat / pdf.page_count
+            if reference is None:
+                reference = rects
+            same, off = _compare_rects(reference, rects)
+            print("%-20s %8.1f ms/page  tables: %i, same rects: %i, "
+                  "max offset: %i px" % (
+                      name, seconds * 1000,
+                      sum(len(page_rects) for page_rects in rects),
+                      same, off))
+
+
+def synthetic_color_pdf(pdf_path, pages, colors, seed=0):
+    """
+    Write a pdf with a table per page whose cells are filled with the
+    colors of the palette, as in the colorful variant, and text in some
+    of the cells
+
+    Returns:
+        a list of (page, loc, number of cells) of the tables, loc as
+        (x, y, w, h) at 300 dpi
+    """
+    rng = np.random.RandomState(seed)
+    scale = 300 / 72
+    document = fitz.open()
+    tables = []
+    for i in range(pages):
+        page = document.new_page(width=612, height=792)
+        x0, y0 = rng.uniform(50, 90), rng.uniform(60, 300)
+        rows, cols = rng.randint(3, 20), rng.randint(2, 8)
+        cell_w, cell_h = rng.uniform(400, 480) / cols, rng.uniform(14, 24)
+        for row in range(rows):
+            for col in range(cols):
+                rect = fitz.Rect(x0 + col * cell_w, y0 + row * cell_h,
+                                 x0 + (col + 1) * cell_w,
+                                 y0 + (row + 1) * cell_h)
+                b, g, r = colors.bgr[row * cols + col]
+                page.draw_rect(rect, fill=(r / 255, g / 255, b / 255),
+                               color=(0, 0, 0), width=0.5)
+                if rng.rand() < 0.5:
+                    page.insert_text((rect.x0 + 3, rect.y1 - 4), "text",
+                                     fontsize=9)
+        loc = (int(x0 * scale) - 10, int(y0 * scale) - 10,
+               int(cols * cell_w * scale) + 20,
+               int(rows * cell_h * scale) + 20)
+        tables.append((i, loc, rows * cols))
+    document.save(pdf_path)
+    return tables
+
+
+def benchmark_cells(pdf_color, tables, colors, repeat):
+    """
+    Compare finding the cells by their colors on the rendered pages and in
+    the filled paths of the pdf: time per table and the cells
+    """
+    def by_colors(pdf, page, loc, number_of_cells):
+        x, y, w, h = loc
+        image = pdf.render(page)
+        return cell_borders_detection_image(
+            image[y:(y + h), x:(x + w)], colors, number_of_cells)
+
+    def by_paths(pdf, page, loc, number_of_cells):
+        return cell_borders_detection_vector(
+            pdf.vector_paths(page), loc, colors, number_of_cells)
+
+    reference = None
+    with Rasterizer(pdf_color) as pdf:
+        for name, engine in [("render + colors", by_colors),
+                             ("vector", by_paths)]:
+            start = time.time()
+            for _ in range(repeat):
+                cells = [engine(pdf, page, loc, number_of_cells)
+                         for page, loc, number_of_cells in tables]
+            seconds = (time.time() - start) / repeat / len(tables)
+            if reference is None:
+                reference = cells
+            same = sum(
+                [tuple(cell) for cell in reference_cells] ==
+                [tuple(cell) for cell in table_cells]
+                for reference_cells, table_cells in zip(reference, cells))
+            print("%-20s %8.1f ms/table  cells: %i, same tables: %i/%i" % (
+                name, seconds * 1000,
+                sum(len(table_cells) for table_cells in cells),
+                same, len(tables)))
+
+
+def benchmark_clip(pdf_path, tables, repeat):
+    """
+    Compare cropping the tables from full page renders with rendering only
+    the tables: time and traced peak memory per table, and the pixels
+    """
+    engines = [
+        ("render + crop", lambda pdf, page, loc: pdf.render(page)[
+            loc[1]:loc[1] + loc[3], loc[0]:loc[0] + loc[2]].copy()),
+        ("clip", lambda pdf, page, loc: pdf.render_regions(page, [loc])[0]),
+    ]
+    reference = None
+    with Rasterizer(pdf_path) as pdf:
+        page_area = np.prod(pdf.page_size(0))
+        table_area = np.mean([loc[2] * loc[3] for _, loc, _ in tables])
+        print("table area: %.1f%% of the page" % (
+            100 * table_area / page_area))
+        for name, engine in engines:
+            start = time.time()
+            for _ in range(repeat):
+                for page, loc, _ in tables:
+                    engine(pdf, page, loc)
+            seconds = (time.time() - start) / repeat / len(tables)
+
+            # Memory allocated by numpy for one table, MuPDF buffers are
+            # not traced
+            images = []
+            peak = 0
+            for page, loc, _ in tables:
+                tracemalloc.start()
+                images.append(engine(pdf, page, loc))
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+            if reference is None:
+                reference = images
+            same = sum(np.array_equal(image, reference_image)
+                       for image, reference_image in zip(images, reference))
+            print("%-20s %8.1f ms/table %8.1f MB peak  same pixels: %i/%i" %
+                  (name, seconds * 1000, peak / 2**20, same, len(tables)))
+
+
+def benchmark_encode(pdf_path, tables, codecs, workers, repeat):
+    """
+    Compare the codecs of the written images on the rendered colored
+    tables: time per table, encoding throughput, size and decoding time,
+    then the time spent writing the tables to a folder by the processing
+    thread and in total, with the encoding in the processing thread and in
+    workers background threads
+
+    Args:
+        codecs: a list of (codec, level)
+    """
+    with Rasterizer(pdf_path) as pdf:
+        images = [pdf.render_regions(page, [loc])[0]
+                  for page, loc, _ in tables]
+    raw_mb = sum(image.nbytes for image in images) / 2**20
+    print("%i tables, %.1f MB of raw arrays" % (len(images), raw_mb))
+    for codec, level in codecs:
+        encoder = ImageEncoder(codec, level, workers=0)
+        start = time.time()
+        for _ in range(repeat):
+            datas = [encoder.encode(image) for image in images]
+        seconds = (time.time() - start) / repeat
+        file_name = encoder.file_name("table.png")
+        start = time.time()
+        decoded = [decode_image(data, file_name) for data in datas]
+        decode_seconds = time.time() - start
+        lossless = sum(np.array_equal(image, decoded_image)
+                       for image, decoded_image in zip(images, decoded))
+        print("%-8s %6.1f ms/table %7.1f MB/s  size %6.2f%%  "
+              "decode %6.1f ms/table  lossless: %i/%i" % (
+                  codec + ("" if level is None else ":%i" % level),
+                  seconds * 1000 / len(images), raw_mb / seconds,
+                  100 * sum(map(len, datas)) / 2**20 / raw_mb,
+                  decode_seconds * 1000 / len(images), lossless,
+                  len(images)))
+
+    codec, level = codecs[0]
+    for encode_workers in [0, workers]:
+        encoder = ImageEncoder(codec, level, encode_workers)
+        with tempfile.TemporaryDirectory() as temp_path:
+            start = time.time()
+            for _ in range(repeat):
+                for i, image in enumerate(images):
+                    encoder.write(os.path.join(temp_path, "%i.png" % i),
+                                  image)
+            submitted = time.time() - start
+            encoder.wait()
+            seconds = time.time() - start
+        encoder.close()
+        print("write %s, %i threads: %6.1f ms/table in the processing "
+              "thread, %6.1f ms/table in total" % (
+                  codec, encode_workers,
+                  submitted * 1000 / repeat / len(images),
+                  seconds * 1000 / repeat / len(images)))
+
+
+def benchmark_dpi(pdf_fuchsia, pdf_aqua, color_pdf, color_tables, colors,
+                  detection_dpis, diff_engine, repeat):
+    """
+    Compare finding the tables on 300 DPI renders with finding them at a
+    lower detection DPI: the regions of the tables scaled to 300 DPI
+    (rescaled) and found again in 300 DPI renders of the regions (refined),
+    time per page and the offset from the 300 DPI rectangles
+
+    The cells are found at the detection DPI and scaled too, to show their
+    offset from the cells found at 300 DPI
+    """
+    dpi = 300
+    with Rasterizer(pdf_fuchsia, dpi) as fuchsia, \
+            Rasterizer(pdf_aqua, dpi) as aqua:
+        pages = range(fuchsia.page_count)
+
+        def full(i, name):
+            return compare_page_images(name, fuchsia.render(i),
+                                       aqua.render(i), None, diff_engine)
+
+        def rescaled(detection_dpi):
+            # The scaled regions with the padding of the comparison
+            scale = dpi / detection_dpi
+            pad = SSIM_WINDOW // 2
+
+            def engine(i, name):
+                regions = coarse_table_regions(
+                    fuchsia.render(i, detection_dpi),
+                    aqua.render(i, detection_dpi))
+                rects = {}
+                for idx, (x0, y0, x1, y1) in enumerate(sorted(
+                        regions, key=lambda region: region[1])):
+                    x, y = int(x0 * scale) - pad, int(y0 * scale) - pad
+                    rects[name[:-4] + "_%i.png" % idx] = (
+                        x, y, int((x1 + 1) * scale) + pad - x,
+                        int((y1 + 1) * scale) + pad - y)
+                return rects
+            return engine
+
+        def refined(detection_dpi):
+            def engine(i, name):
+                regions = coarse_table_regions(
+                    fuchsia.render(i, detection_dpi),
+                    aqua.render(i, detection_dpi))
+                return locate_tables_in_regions(
+                    name, regions, dpi / detection_dpi, fuchsia.page_size(i),
+                    lambda locs: fuchsia.render_regions(i, locs),
+                    lambda locs: aqua.render_regions(i, locs), None,
+                    diff_engine)
+            return engine
+
+        engines = [("%i dpi" % dpi, full)]
+        for detection_dpi in detection_dpis:
+            engines.append(("%i dpi rescaled" % detection_dpi,
+                            rescaled(detection_dpi)))
+            engines.append(("%i dpi refined" % detection_dpi,
+                            refined(detection_dpi)))
+        reference = None
+        for name, engine in engines:
+            start = time.time()
+            for _ in range(repeat):
+                rects = [engine(i, "page_%i.png" % i) or {} for i in pages]
+            seconds = (time.time() - start) / repeat / len(pages)
+            if reference is None:
+                reference = rects
+            same, off = _compare_rects(reference, rects)
+            print("%-20s %8.1f ms/page  tables: %i, same rects: %i, "
+                  "max offset: %i px" % (
+                      name, seconds * 1000,
+                      sum(len(page_rects) for page_rects in rects),
+                      same, off))
+
+    with Rasterizer(color_pdf, dpi) as pdf:
+        reference = [
+            cell_borders_detection_image(
+                pdf.render_regions(page, [loc])[0], colors, number_of_cells)
+            for page, loc, number_of_cells in color_tables]
+        for detection_dpi in detection_dpis:
+            scale = dpi / detection_dpi
+            off = 0
+            same = 0
+            for (page, loc, number_of_cells), reference_cells in zip(
+                    color_tables, reference):
+                x, y, w, h = [int(value / scale) for value in loc]
+                image = pdf.render(page, detection_dpi)[y:y + h, x:x + w]
+                cells = cell_borders_detection_image(
+                    image, colors, number_of_cells)
+                cells = np.round((np.asarray(cells).reshape(-1, 4) +
+                                  [x, y, 0, 0]) * scale -
+                                 [loc[0], loc[1], 0, 0]).astype(int)
+                if len(cells) != len(reference_cells):
+                    continue
+                diff = np.abs(cells - np.asarray(reference_cells)).max()
+                same += int(diff == 0)
+                off = max(off, int(diff))
+            print("%-20s cells of %i tables: same: %i, max offset: %i px" %
+                  ("%i dpi cells" % detection_dpi, len(color_tables), same,
+                   off))
+
+
+def _compare_rects(reference, rects):
+    """
+    Count equal rectangles and the maximum coordinate offset
+    """
+    same = 0
+    offset = 0
+    for page_reference, page_rects in zip(reference, rects):
+        for table_name, loc in page_reference.items():
+            if table_name not in page_rects:
+                continue
+            diff = np.abs(np.subtract(loc, page_rects[table_name])).max()
+            same += int(diff == 0)
+            offset = max(offset, int(diff))
+    return same, offset
+
+
+def benchmark_nested(repeat):
+    """
+    Time _drop_nested_cells and the pairwise comparison on a large table
+    with glyph contours, their equality is checked in
+    tests/test_cell_detector.py
+    """
+    rng = np.random.RandomState(0)
+    # 60x25 cells, 8 glyph contours in every cell
+    cells_list = []
+    for row in range(60):
+        for col in range(25):
+            x, y = col * 80, row * 40
+            cells_list.append((x, y, 78, 38))
+            for glyph in range(8):
+                cells_list.append((x + 3 + glyph * 9, y + 10, 6, 8))
+    rng.shuffle(cells_list)
+    for name, drop_nested in [("pairwise", _drop_nested_cells_pairwise),
+                              ("sweep", _drop_nested_cells)]:
+        start = time.time()
+        for _ in range(repeat):
+            drop_nested(cells_list)
+        seconds = (time.time() - start) / repeat
+        print("%-10s %i boxes: %8.3f s" % (name, len(cells_list), seconds))
+
+
+def _drop_nested_cells_pairwise(cells_list):
+    """
+    Compare every cell with every other cell
+    """
+    cells_list_shortened = []
+    for cell1 in cells_list:
+        if not any(_box_in_box_xywh(cell1, cell2) and cell1 != cell2
+                   for cell2 in cells_list):
+            cells_list_shortened.append(cell1)
+    return cells_list_shortened
+
+
+def benchmark_reader(output_path, layout, tables, workers, repeat):
+    """
+    Tables per second read from an output folder: random access one by one
+    and the prefetching iterator, with and without decoding the images
+    """
+    reader = DatasetReader(output_path, layout)
+    print("layout: ", reader.layout, " tables: ", len(reader),
+          " binary gt: ", reader.binary is not None)
+    if not len(reader):
+        return
+    rng = np.random.RandomState(0)
+    indices = rng.randint(0, len(reader), tables)
+    for decode in [False, True]:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for i in indices:
+                sample = reader[int(i)]
+                if decode:
+                    sample.image
+                else:
+                    sample.image_bytes()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("random access decode: ", decode,
+              " tables/s: ", round(tables / best, 1))
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for sample in reader.iterate(indices, workers, decode=decode):
+                pass
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("iterate workers: ", workers, " decode: ", decode,
+              " tables/s: ", round(tables / best, 1))
+    reader.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--do', default='diff',
+                        help="Benchmark to run: diff, nested, reader, "
+                        "vector, cells, clip, dpi, encode")
+    parser.add_argument('--pdf_fuchsia', default=None,
+                        help="A pdf rendered with fuchsia table borders, "
+                        "synthetic pages are used if not given")
+    parser.add_argument('--pdf_aqua', default=None,
+                        help="The same pdf rendered with aqua table borders")
+    parser.add_argument('--pages', default='10',
+                        help="Number of synthetic pages")
+    parser.add_argument('--detection_dpi', default='72,100,150',
+                        help="Detection resolutions to compare with 300 DPI")
+    parser.add_argument('--diff', default='ssim', choices=['ssim', 'exact'],
+                        help="Comparison of the fuchsia and the aqua pages")
+    parser.add_argument('--repeat', default='3',
+                        help="Number of repetitions")
+    parser.add_argument('--output_path', default='../output',
+                        help="Output folder to read tables from")
+    parser.add_argument('--layout', default=None,
+                        choices=['files', 'shards'],
+                        help="Layout of the output, found if not given")
+    parser.add_argument('--tables', default='1000',
+                        help="Number of tables to read")
+    parser.add_argument('--workers', default='4',
+                        help="Number of threads of the prefetching iterator "
+                        "or of the background encoder")
+    parser.add_argument('--codecs', default='png,png:1,png:9,webp,npy',
+                        help="Codecs to compare, with the PNG level after a "
+                        "colon, the first one is used for writing")
+    args = parser.parse_args()
+
+    if args.do == "diff":
+        if args.pdf_fuchsia is not None:
+            page_pairs = pdf_page_pairs(args.pdf_fuchsia, args.pdf_aqua)
+        else:
+            # Every second page without tables: identical renders
+            page_pairs = [synthetic_page_pair(i, with_tables=i % 2 == 0)
+                          for i in range(int(args.pages))]
+        benchmark_diff(page_pairs, int(args.repeat))
+    elif args.do == "nested":
+        benchmark_nested(int(args.repeat))
+    elif args.do == "vector":
+        if args.pdf_fuchsia is not None:
+            benchmark_vector(args.pdf_fuchsia, int(args.repeat))
+        else:
+            with tempfile.TemporaryDirectory() as temp_path:
+                pdf_path = os.path.join(temp_path, "fuchsia.pdf")
+                synthetic_pdf(pdf_path, int(args.pages))
+                benchmark_vector(pdf_path, int(args.repeat))
+    elif args.do == "cells":
+        colors = Palette('../dictionaries/random_colors_100000.csv')
+        with tempfile.TemporaryDirectory() as temp_path:
+            pdf_path = os.path.join(temp_path, "color.pdf")
+            tables = synthetic_color_pdf(pdf_path, int(args.pages), colors)
+            benchmark_cells(pdf_path, tables, colors, int(args.repeat))
+    elif args.do == "clip":
+        colors = Palette('../dictionaries/random_colors_100000.csv')
+        with tempfile.TemporaryDirectory() as temp_path:
+            pdf_path = os.path.join(temp_path, "color.pdf")
+            tables = synthetic_color_pdf(pdf_path, int(args.pages), colors)
+            benchmark_clip(pdf_path, tables, int(args.repeat))
+    elif args.do == "encode":
+        colors = Palette('../dictionaries/random_colors_100000.csv')
+        codecs = [(codec.split(":")[0], int(codec.split(":")[1])
+                   if ":" in codec else None)
+                  for codec in args.codecs.split(",")]
+        with tempfile.TemporaryDirectory() as temp_path:
+            pdf_path = os.path.join(temp_path, "color.pdf")
+            tables = synthetic_color_pdf(pdf_path, int(args.pages), colors)
+            benchmark_encode(pdf_path, tables, codecs, int(args.workers),
+                             int(args.repeat))
+    elif args.do == "dpi":
+        colors = Palette('../dictionaries/random_colors_100000.csv')
+        with tempfile.TemporaryDirectory() as temp_path:
+            pdf_fuchsia = os.path.join(temp_path, "fuchsia.pdf")
+            pdf_aqua = os.path.join(temp_path, "aqua.pdf")
+            color_pdf = os.path.join(temp_path, "color.pdf")
+            synthetic_pdf(pdf_fuchsia, int(args.pages))
+            synthetic_pdf(pdf_aqua, int(args.pages), border_color=(0, 1, 1))
+            color_tables = synthetic_color_pdf(color_pdf, int(args.pages),
+                                               colors)
+            benchmark_dpi(pdf_fuchsia, pdf_aqua, color_pdf, color_tables,
+                          colors, [int(detection_dpi) for detection_dpi
+                                   in args.detection_dpi.split(",")],
+                          args.diff, int(args.repeat))
+    elif args.do == "reader":
+        benchmark_reader(args.output_path, args.layout, int(args.tables),
+                         int(args.workers), int(args.repeat))
+
+
+if __name__ == "__main__":
+    main()
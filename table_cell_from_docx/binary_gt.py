@@ -0,0 +1,268 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+# The columns of a table with 4 coordinates per row, loc has one row
+COLUMNS = ["cells", "horizontal_lines", "vertical_lines"]
+
+# Version of the layout, written to meta.json
+VERSION = 1
+
+
+class BinaryGroundTruth():
+    """
+    Read the ground truth written by write_binary_gt: every table is found
+    by its name or index without parsing, from memory-mapped arrays
+
+        loc.npy: (tables, 4) int32, x, y, w, h of every table
+        <column>.npy: (rows, 4) int16 or int32, the rows of all tables
+        <column>_offsets.npy: (tables + 1,) int64, the rows of the i-th
+                              table are offsets[i]:offsets[i + 1]
+        names.bin, names_offsets.npy: the utf-8 table names
+        slots.npy: an open addressing hash table from the name hash
+                   to the table index, -1 for an empty slot
+        meta.json: the version and the number of tables, written last
+
+    A pickled reader only carries the path of the folder
+    """
+
+    def __init__(self, binary_path):
+        """
+        Args:
+            binary_path: a folder written by write_binary_gt
+        """
+        self.binary_path = binary_path
+        with open(os.path.join(binary_path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != VERSION:
+            raise ValueError("Unknown version of the binary ground truth: "
+                             "%s" % self.meta["version"])
+        self.arrays = {}
+        for name in ["loc", "names_offsets", "slots"] + COLUMNS + \
+                [column + "_offsets" for column in COLUMNS]:
+            self.arrays[name] = np.load(
+                os.path.join(binary_path, name + ".npy"), mmap_mode="r")
+        names_path = os.path.join(binary_path, "names.bin")
+        # np.memmap fails on an empty file
+        if os.path.getsize(names_path):
+            self.names_blob = np.memmap(names_path, dtype=np.uint8, mode="r")
+        else:
+            self.names_blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return self.meta["tables"]
+
+    def name(self, i):
+        """
+        The name of the i-th table
+        """
+        offsets = self.arrays["names_offsets"]
+        return self.names_blob[offsets[i]:offsets[i + 1]].tobytes().decode(
+            "utf-8")
+
+    def names(self):
+        return [self.name(i) for i in range(len(self))]
+
+    def index(self, table_name):
+        """
+        The index of the table, -1 if there is no such table
+        """
+        slots = self.arrays["slots"]
+        mask = len(slots) - 1
+        slot = name_hash(table_name) & mask
+        while True:
+            i = int(slots[slot])
+            if i < 0:
+                return -1
+            if self.name(i) == table_name:
+                return i
+            slot = (slot + 1) & mask
+
+    def __contains__(self, table_name):
+        return self.index(table_name) >= 0
+
+    def __getitem__(self, key):
+        """
+        The ground truth of a table given by its name or index
+
+        Returns:
+            a dictionary with loc, cells, horizontal_lines and
+            vertical_lines as (read-only) arrays
+        """
+        if isinstance(key, str):
+            i = self.index(key)
+            if i < 0:
+                raise KeyError(key)
+        else:
+            i = int(key)
+            if i < 0:
+                i += len(self)
+            if not 0 <= i < len(self):
+                raise IndexError(key)
+        table = {"loc": self.arrays["loc"][i]}
+        for column in COLUMNS:
+            offsets = self.arrays[column + "_offsets"]
+            table[column] = self.arrays[column][offsets[i]:offsets[i + 1]]
+        return table
+
+    def to_json(self, key):
+        """
+        The ground truth of a table as in gt_tables_dict
+        """
+        return {column: array.tolist()
+                for column, array in self[key].items()}
+
+    def __getstate__(self):
+        return {"binary_path": self.binary_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["binary_path"])
+
+
+def name_hash(table_name):
+    """
+    A hash of the table name that is the same in every process and run
+    """
+    digest = hashlib.blake2b(table_name.encode("utf-8"),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def coordinate_dtype(array):
+    """
+    int16 if the coordinates fit in it, int32 otherwise
+    """
+    info = np.iinfo(np.int16)
+    if not len(array) or \
+            (array.min() >= info.min and array.max() <= info.max):
+        return np.int16
+    return np.int32
+
+
+def write_binary_gt(binary_path, tables):
+    """
+    Write the ground truth of the tables in the binary layout, see
+    BinaryGroundTruth
+
+    Args:
+        binary_path: a folder, the files in it are replaced
+        tables: an iterable of (table_name, table), a table is a
+                dictionary or a Table with loc, cells, horizontal_lines
+                and vertical_lines
+    Returns:
+        the number of tables
+    """
+    names = []
+    locs = []
+    rows = {column: [] for column in COLUMNS}
+    for table_name, table in tables:
+        if not isinstance(table, dict):
+            table = table.__dict__
+        names.append(table_name.encode("utf-8"))
+        locs.append(table["loc"])
+        for column in COLUMNS:
+            rows[column].append(
+                np.asarray(table[column], dtype=np.int64).reshape(-1, 4))
+
+    arrays = {"loc": np.asarray(locs, dtype=np.int32).reshape(-1, 4)}
+    for column in COLUMNS:
+        lengths = [len(array) for array in rows[column]]
+        arrays[column + "_offsets"] = np.concatenate(
+            [[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+        if rows[column]:
+            array = np.concatenate(rows[column])
+        else:
+            array = np.zeros((0, 4), dtype=np.int64)
+        arrays[column] = array.astype(coordinate_dtype(array))
+    arrays["names_offsets"] = np.concatenate(
+        [[0], np.cumsum([len(name) for name in names], dtype=np.int64)]
+    ).astype(np.int64)
+    arrays["slots"] = build_slots(names)
+
+    os.makedirs(binary_path, exist_ok=True)
+    # meta.json is removed first and written last: a folder with
+    # meta.json is complete
+    meta_path = os.path.join(binary_path, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for name, array in arrays.items():
+        with open(os.path.join(binary_path, name + ".npy"), "wb") as f:
+            np.save(f, array)
+    with open(os.path.join(binary_path, "names.bin"), "wb") as f:
+        f.write(b"".join(names))
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump({"version": VERSION, "tables": len(names),
+                   "dtypes": {column: arrays[column].dtype.name
+                              for column in COLUMNS}}, f, sort_keys=True)
+    os.replace(meta_path + ".tmp", meta_path)
+    return len(names)
+
+
+def build_slots(names):
+    """
+    An open addressing hash table (linear probing) at most half full
+
+    Args:
+        names: a list of utf-8 encoded table names
+    Returns:
+        an int32 array, the table index in the slot of its name hash or
+        in one of the next slots, -1 for an empty slot
+    """
+    size = 1
+    while size < 2 * len(names):
+        size *= 2
+    slots = np.full(size, -1, dtype=np.int32)
+    mask = size - 1
+    for i, name in enumerate(names):
+        slot = name_hash(name.decode("utf-8")) & mask
+        while slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        slots[slot] = i
+    return slots
+
+
+def iter_json_tables(gt_tables_dict_path):
+    """
+    The tables of the .json files in gt_tables_dict_path, sorted by name
+
+    Yields:
+        (table_name, table)
+    """
+    for json_name in sorted(os.listdir(gt_tables_dict_path)):
+        if not json_name.endswith(".json"):
+            continue
+        with open(os.path.join(gt_tables_dict_path, json_name)) as f:
+            gt_tables_dict = json.load(f)
+        for table_name in sorted(gt_tables_dict.keys()):
+            yield table_name, gt_tables_dict[table_name]
+
+
+def convert_json(gt_tables_dict_path, binary_path):
+    """
+    Convert the .json files of gt_tables_dict to the binary layout
+
+    Returns:
+        the number of tables
+    """
+    return write_binary_gt(binary_path, iter_json_tables(gt_tables_dict_path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gt_path', default='../output/gt_tables_dict',
+                        help="Folder with the .json files of the ground "
+                        "truth")
+    parser.add_argument('--binary_path', default='../output/gt_tables_bin',
+                        help="Folder for the binary ground truth")
+    args = parser.parse_args()
+
+    start = time.time()
+    number = convert_json(args.gt_path, args.binary_path)
+    print("tables: ", number, " time: ", time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
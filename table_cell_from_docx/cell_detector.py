@@ -1,6 +1,13 @@
 import cv2
 import numpy as np
 import imutils
+from palette import pack_bgr
+from table_detector import touching_groups
+from image_encoder import read_image
+
+# MuPDF samples a pixel on a 17x15 grid (anti-aliasing level 8, the
+# default): the edges of a path are moved down to the grid
+AA_GRID = np.array([17, 15, 17, 15])
 
 
 def cell_borders_detection(table_path, colors, number_of_cells):
@@ -13,81 +20,279 @@ def cell_borders_detection(table_path, colors, number_of_cells):
     page and drop the rest
 
     Args:
-        table_path: a path with the table image
-        colors: a list of colors of cell backgrounds
+        table_path: a path with the table image (.png, .webp or .npy)
+        colors: the Palette of cell backgrounds
         number_of_cells: the maximum number of cells in all tables in the
                         document
 
     Returns:
         a list of cells that the table contains[(x,y,w,h),...]
     """
-    cells_list = []
+    # Read the image of the colored table
+    table_image = read_image(table_path)
+    return cell_borders_detection_image(table_image, colors, number_of_cells)
+
+
+def cell_borders_detection_image(table_image, colors, number_of_cells):
+    """
+    Same as cell_borders_detection for a table image given as a BGR array
+
+    Every pixel is looked up in the palette once, instead of one pass over
+    the image per color
+    """
     not_found_thresh = 50
+    number_of_colors = min(number_of_cells, len(colors))
 
-    # Count how many times in a row the color was not found
-    not_found = 0
+    # Index of the palette color of every pixel, -1 if not a palette color
+    labels = colors.label(pack_bgr(table_image), number_of_colors)
 
-    # Read the image of the colored table
-    table_image = cv2.imread(table_path)
-
-    # Iterate over colors
-    for (i, color) in enumerate(colors[:number_of_cells]):
-        color_rgb = color[1:]
-        lower_color = np.array(color_rgb)
-        upper_color = np.array(color_rgb)
-
-        # Find a mask of the given color - binary image:
-        # all black except given color, which is white
-        mask = cv2.inRange(table_image, lower_color, upper_color)
-        # Find all contours
+    # Bounding boxes of every palette color in the image
+    height, width = labels.shape
+    pixels = np.flatnonzero(labels >= 0)
+    pixel_labels = labels.ravel()[pixels]
+    order = np.argsort(pixel_labels, kind="stable")
+    pixels = pixels[order]
+    pixel_labels = pixel_labels[order]
+    found, starts = np.unique(pixel_labels, return_index=True)
+    ys = pixels // width
+    xs = pixels % width
+    if len(found):
+        x_min = np.minimum.reduceat(xs, starts)
+        x_max = np.maximum.reduceat(xs, starts)
+        y_min = np.minimum.reduceat(ys, starts)
+        y_max = np.maximum.reduceat(ys, starts)
+    boxes = {}
+    for k, i in enumerate(found):
+        boxes[i] = (x_min[k], y_min[k], x_max[k] + 1, y_max[k] + 1)
+
+    cells_list = []
+    for i in _colors_to_use(boxes.keys(), number_of_colors,
+                            not_found_thresh):
+        # Connected regions of the color inside its bounding box
+        (x1, y1, x2, y2) = boxes[i]
+        mask = (labels[y1:y2, x1:x2] == i).astype(np.uint8) * 255
         cnts = cv2.findContours(
             mask,
             cv2.RETR_EXTERNAL,
             cv2.CHAIN_APPROX_SIMPLE)
         cnts = imutils.grab_contours(cnts)
 
-        # No countour => no presence of the color
-        if len(cnts) == 0:
-            not_found += 1
-            if not_found == 2 and i == 1:
-                # It is not a part of the table on the first page,
-                # if the color of the first cell is missing 2 times in a row
-                return cells_list
-            # For documents with too many max number of cells(ex.10000),
-            # then stop after not_found_thresh
-            # Some colors might be missing because of spanning cells, etc.
-            if not_found == not_found_thresh:
-                break
         # Iterate over the countours and find the bounding rectangle
-        for idx, c in enumerate(cnts):
+        for c in cnts:
             (x, y, w, h) = cv2.boundingRect(c)
-            cells_list.append((x, y, w, h))
+            cells_list.append((int(x1) + x, int(y1) + y, w, h))
 
     # If one countour is nested in another keep only the most outer
     # for ex: letters like o,p,q, have countour inside
     return _drop_nested_cells(cells_list)
 
 
+def cell_borders_detection_vector(paths, loc, colors, number_of_cells):
+    """
+    Same as cell_borders_detection for the table at loc on a page given by
+    its vector paths, without rendering the page
+
+    A cell is the part of a rectangle filled with its color that is left
+    in the color after the page is drawn: the fully covered pixels of the
+    rectangle without the pixels touched by the strokes and the fills
+    drawn later. Touching rectangles of the same color are one cell
+
+    Args:
+        paths: the paths of the colorful page, see Rasterizer.vector_paths
+        loc: (x, y, w, h) of the table on the page
+        colors: the Palette of cell backgrounds
+        number_of_cells: the maximum number of cells in all tables in the
+                        document
+
+    Returns:
+        a list of cells that the table contains[(x,y,w,h),...]
+    """
+    not_found_thresh = 50
+    number_of_colors = min(number_of_cells, len(colors))
+    x, y, w, h = [int(value) for value in loc]
+
+    # The areas drawn by every path in the drawing order: the stroke of a
+    # path is drawn after its fill
+    covers = [(2 * i, fill, area) for i, (fill, area, stroke, segments)
+              in enumerate(paths) if fill is not None]
+    covers += [(2 * i + 1, stroke, segment)
+               for i, (fill, area, stroke, segments) in enumerate(paths)
+               if stroke is not None for segment in segments]
+    cover_order = np.array([order for order, _, _ in covers],
+                           dtype=np.int64)
+    cover_areas = np.array([area for _, _, area in covers],
+                           dtype=np.float64).reshape(-1, 4)
+    # The pixels touched by the areas, inclusive
+    grid = _to_grid(cover_areas)
+    touched = np.concatenate(
+        [grid[:, :2] // AA_GRID[:2], -(-grid[:, 2:] // AA_GRID[2:]) - 1],
+        axis=1)
+
+    fills = [(i, fill, area) for i, (fill, area, _, _) in enumerate(paths)
+             if fill is not None]
+    fills_bgr = np.array([fill[::-1] for _, fill, _ in fills],
+                         dtype=np.uint8).reshape(-1, 3)
+    labels = colors.label(pack_bgr(fills_bgr), number_of_colors)
+    boxes = {}
+    for (i, fill, area), label in zip(fills, labels):
+        if label < 0:
+            continue
+        # The fully covered pixels of the rectangle, inclusive and
+        # clipped to the table
+        grid = _to_grid([area])[0]
+        box = [max(-(-grid[0] // AA_GRID[0]), x),
+               max(-(-grid[1] // AA_GRID[1]), y),
+               min(grid[2] // AA_GRID[2], x + w) - 1,
+               min(grid[3] // AA_GRID[3], y + h) - 1]
+        box = [int(value) for value in box]
+        if box[0] > box[2] or box[1] > box[3]:
+            continue
+        later = (cover_order > 2 * i) & \
+            (touched[:, 0] <= box[2]) & (touched[:, 2] >= box[0]) & \
+            (touched[:, 1] <= box[3]) & (touched[:, 3] >= box[1])
+        for j in np.flatnonzero(later):
+            if covers[j][1] == fill:
+                # Drawing with the same color changes no pixel
+                continue
+            box = _uncovered(box, touched[j])
+            if box is None:
+                break
+        if box is not None:
+            boxes.setdefault(int(label), []).append(box)
+
+    cells_list = []
+    for i in _colors_to_use(boxes.keys(), number_of_colors,
+                            not_found_thresh):
+        regions = [(min(b[0] for b in group), min(b[1] for b in group),
+                    max(b[2] for b in group), max(b[3] for b in group))
+                   for group in touching_groups(boxes[i], 1)]
+        # In the order of the contours of cell_borders_detection_image
+        regions.sort(key=lambda region: (-region[1], -region[0]))
+        for (x1, y1, x2, y2) in regions:
+            cells_list.append((x1 - x, y1 - y, x2 - x1 + 1, y2 - y1 + 1))
+    return _drop_nested_cells(cells_list)
+
+
+def _to_grid(areas):
+    """
+    Areas (x0, y0, x1, y1) in pixels as the indices of the AA_GRID points
+    their edges are moved to
+    """
+    return np.floor(np.asarray(areas, dtype=np.float64).reshape(-1, 4) *
+                    AA_GRID).astype(np.int64)
+
+
+def _uncovered(box, cover):
+    """
+    Remove the pixels of cover from the side of box (x1, y1, x2, y2, both
+    inclusive) that it spans
+
+    A cover inside the box, or over a corner of it, is not removed: it
+    leaves the bounding box of the rest as it is
+
+    Returns:
+        the rest of the box or None if nothing is left
+    """
+    x1, y1, x2, y2 = box
+    cx1, cy1, cx2, cy2 = [int(value) for value in cover]
+    spans_rows = cy1 <= y1 and cy2 >= y2
+    spans_columns = cx1 <= x1 and cx2 >= x2
+    if spans_rows and spans_columns:
+        return None
+    if spans_rows:
+        if cx1 <= x1:
+            x1 = cx2 + 1
+        elif cx2 >= x2:
+            x2 = cx1 - 1
+    elif spans_columns:
+        if cy1 <= y1:
+            y1 = cy2 + 1
+        elif cy2 >= y2:
+            y2 = cy1 - 1
+    return [x1, y1, x2, y2]
+
+
+def _colors_to_use(found, number_of_colors, not_found_thresh):
+    """
+    Choose the indices of the cell colors to take the cells from, in the
+    order of the colors
+
+    If the colors of the first two cells are missing, the table is not
+    a part of the table on the first page: no cells
+
+    For documents with too many max number of cells(ex.10000), stop at the
+    not_found_thresh-th missing color
+    Some colors might be missing because of spanning cells, etc.
+
+    Args:
+        found: the indices of the colors present in the table image
+        number_of_colors: the number of colors that cells can have
+    """
+    present = np.zeros(number_of_colors, dtype=bool)
+    present[list(found)] = True
+    missing = np.flatnonzero(~present)
+    if len(missing) >= 2 and missing[1] == 1:
+        return []
+    if len(missing) >= not_found_thresh:
+        number_of_colors = missing[not_found_thresh - 1]
+    return np.flatnonzero(present[:number_of_colors])
+
+
 def _drop_nested_cells(cells_list):
     """
     Delete from the cells_list the cells that are nested in a bigger cell
     For example the countour inside "O" should be dropped
+
+    Sweep over the cells sorted by the left x, keeping only the cells that
+    the sweep line still crosses sorted by their right x: the cells that
+    the sweep line left are cut from the front, and a cell can only be
+    nested in the ones at the back that reach at least its right x
+
+    Args:
+        cells_list: a list of (x, y, w, h) or an array of shape (n, 4)
+    Returns:
+        the cells that are not nested in any other cell, in the same order
+        and of the same type as cells_list
     """
-    cells_list_shortened = []
-    broken = False
-    for cell1 in cells_list:
-        for cell2 in cells_list:
-            if _box_in_box_xywh(cell1, cell2) and cell1 != cell2:
-                broken = True
-                break
-        if broken:
-            # cell1 is nested in the other cell
-            broken = False
-            continue
+    boxes = np.asarray(cells_list, dtype=np.int64).reshape(-1, 4)
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = x1 + boxes[:, 2]
+    y2 = y1 + boxes[:, 3]
+
+    # A cell comes after all the cells it can be nested in
+    order = np.lexsort((-y2, y1, -x2, x1))
+    nested = np.zeros(len(boxes), dtype=bool)
+    # Not nested cells that reach the sweep line in active[start:end],
+    # sorted by active_x2. Every cell is added at most once
+    active = np.empty(len(boxes), dtype=np.int64)
+    active_x2 = np.empty(len(boxes), dtype=np.int64)
+    start = end = 0
+    for i in order:
+        start += np.searchsorted(active_x2[start:end], x1[i])
+        first = start + np.searchsorted(active_x2[start:end], x2[i])
+        candidates = active[first:end]
+        containing = (y1[candidates] <= y1[i]) & (y2[candidates] >= y2[i])
+        # A cell is not nested in its duplicate
+        containing &= (x1[candidates] != x1[i]) | \
+            (y1[candidates] != y1[i]) | (x2[candidates] != x2[i]) | \
+            (y2[candidates] != y2[i])
+        if containing.any():
+            # The cells nested in cell i are also nested in the cell that
+            # contains it, cell i is not needed in active
+            nested[i] = True
         else:
-            # cell1 is not nested in any of the cells
-            cells_list_shortened.append(cell1)
-    return cells_list_shortened
+            position = start + np.searchsorted(
+                active_x2[start:end], x2[i], side="right")
+            active[position + 1:end + 1] = active[position:end]
+            active_x2[position + 1:end + 1] = active_x2[position:end]
+            active[position] = i
+            active_x2[position] = x2[i]
+            end += 1
+
+    if isinstance(cells_list, np.ndarray):
+        return cells_list[~nested]
+    return [cell for cell, drop in zip(cells_list, nested) if not drop]
 
 
 def _box_in_box_xywh(box1, box2):
@@ -1,88 +1,450 @@
 import os
-from PyPDF2 import PdfFileWriter, PdfFileReader
-from wand.image import Image as WANDImage
-from wand.color import Color
-from win32com import client
+import abc
+import copy
+import cv2
+import importlib.util
+import struct
 import zipfile
 import shutil
+import subprocess
+import tempfile
+import time
+from rasterizer import Rasterizer
+from scheduler import kill_process_tree, track_process, untrack_process
 from utils.file_utils import append_to_file
 
 
-def unpack_zip(file_name, zip_file_path, unzipped_path, output_path):
+def read_docx_parts(file_name, zip_file_path, part_names, output_path):
     """
-    Unpack the .zip if possible
+    Read the given parts (e.g. word/document.xml) of the .docx if possible,
+    without extracting the other members
+
+    Returns:
+        a dictionary part name: content of the parts in the .docx, or None
     """
-    directory_to_extract_to = os.path.join(unzipped_path, file_name[:-5])
     try:
         with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-            zip_ref.extractall(directory_to_extract_to)
-        return True
+            names = set(zip_ref.namelist())
+            return {part_name: zip_ref.read(part_name)
+                    for part_name in part_names if part_name in names}
     except BaseException:
         append_to_file(output_path, 'unpack_failed.csv', file_name)
+        return None
+
+
+def repack_docx(zip_file_path, parts, output):
+    """
+    Write a copy of the .docx with the given parts replaced
+
+    The other members (e.g. the images in word/media) are copied as they
+    are compressed in the .docx, without decompressing them
+
+    Args:
+        zip_file_path: the original .docx
+        parts: a dictionary part name: new content
+        output: a path or a file object (e.g. io.BytesIO)
+    """
+    with zipfile.ZipFile(zip_file_path, 'r') as source, \
+            zipfile.ZipFile(output, 'w') as target:
+        for info in source.infolist():
+            if info.filename in parts:
+                zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+                zinfo.external_attr = info.external_attr
+                # The variants are read once by the renderer: the fastest
+                # compression
+                target.writestr(zinfo, parts[info.filename],
+                                compress_type=zipfile.ZIP_DEFLATED,
+                                compresslevel=1)
+            else:
+                _copy_member(source, target, info)
+
+
+def _copy_member(source, target, info):
+    """
+    Copy the compressed data of a member of source to target
+    """
+    source.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           source.fp.read(zipfile.sizeFileHeader))
+    # Skip the file name and the extra field of the local header
+    source.fp.seek(header[10] + header[11], os.SEEK_CUR)
+
+    zinfo = copy.copy(info)
+    # The sizes and the CRC go to the local header, not to a data
+    # descriptor after the data
+    zinfo.flag_bits &= ~0x08
+    zinfo.header_offset = target.fp.tell()
+    target.fp.write(zinfo.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        data = source.fp.read(min(remaining, 1 << 20))
+        if not data:
+            raise zipfile.BadZipFile("Truncated member " + info.filename)
+        target.fp.write(data)
+        remaining -= len(data)
+    target.filelist.append(zinfo)
+    target.NameToInfo[zinfo.filename] = zinfo
+    # The central directory is written from here on close
+    target.start_dir = target.fp.tell()
+
+
+class Converter(abc.ABC):
+    """
+    Base class of the .docx to .pdf backends
+
+    A converter is a renderer session: start() launches the renderer, which
+    then converts documents until stop(). A backend implements _start,
+    _stop, is_alive and _convert(in_file, out_file), and reports the files
+    it could not open as docx_failed and the files it could not export as
+    pdf_failed, see _failed. _start sets self.pid to the renderer process,
+    which the scheduler kills if the worker times out
+    """
+    name = None
+
+    def __init__(self):
+        self.started = False
+        # Status of the last failed conversion
+        self.failure = None
+        # The renderer process, None if unknown or not running
+        self.pid = None
+
+    def start(self):
+        """
+        Launch the renderer if it is not running yet
+        """
+        if not self.started:
+            self._start()
+            self.started = True
+            track_process(self.pid)
+
+    def stop(self):
+        """
+        Shut the renderer down, ignoring a renderer that already crashed
+        """
+        if self.started:
+            self.started = False
+            try:
+                self._stop()
+            except BaseException:
+                # Do not leave a hung renderer behind
+                if self.pid:
+                    kill_process_tree(self.pid)
+            untrack_process(self.pid)
+            self.pid = None
+
+    def is_alive(self):
+        """
+        Check that the renderer still responds
+        """
+        return self.started
+
+    def docx_to_pdf(self, file_name, docx_path, pdf_path, output_path):
+        """
+        Convert docx_path/file_name to pdf_path/file_name.pdf
+
+        Returns:
+            True if the pdf was successfully saved
+        """
+        in_file = os.path.join(docx_path, file_name)
+        out_file = os.path.join(pdf_path, file_name[:-4] + "pdf")
+        if os.path.exists(out_file):
+            os.remove(out_file)
+        self.failure = None
+        self.start()
+        return self._convert(file_name, in_file, out_file, output_path)
+
+    def _failed(self, status, file_name, output_path):
+        """
+        Record a failed conversion in self.failure and in <status>.csv
+
+        Returns:
+            False
+        """
+        self.failure = status
+        append_to_file(output_path, status + '.csv', file_name)
         return False
 
+    def _start(self):
+        pass
+
+    def _stop(self):
+        pass
+
+    @abc.abstractmethod
+    def _convert(self, file_name, in_file, out_file, output_path):
+        pass
 
-def save_docx(folder_name, unzipped_path, docx_path):
+
+class WordConverter(Converter):
     """
-    Convert the unzipped folder to .docx in docx_path
+    Convert .docx to .pdf with MS Word over COM (Windows only)
     """
-    docx_file_path = os.path.join(docx_path, folder_name + ".docx")
-    if os.path.exists(docx_file_path):
-        os.remove(docx_file_path)
-    folders_to_be_archived_path = os.path.join(unzipped_path, folder_name)
-    zipped_folder_path = os.path.join(docx_path, folder_name)
-    shutil.make_archive(zipped_folder_path, 'zip', folders_to_be_archived_path)
-    os.rename(os.path.join(docx_path, folder_name + ".zip"), docx_file_path)
+    name = "word"
+
+    def _start(self):
+        from win32com import client
+
+        # Create a new Word Object
+        self.word = client.DispatchEx("Word.Application")
+        self.word.Visible = False
+        self.word.DisplayAlerts = 0
+        self.pid = _word_pid(self.word)
+
+    def _stop(self):
+        self.word.Quit()
+
+    def is_alive(self):
+        if not self.started:
+            return False
+        try:
+            # Any call fails if the Word process is gone or hangs in a dialog
+            self.word.Documents.Count
+            return True
+        except BaseException:
+            return False
 
+    def _convert(self, file_name, in_file, out_file, output_path):
+        wdFormatPDF = 17  # PDF format
+        wdExportDocumentContent = 0
 
-def docx_to_pdf(file_name, docx_path, pdf_path, output_path):
+        # Open the word file for read-only
+        try:
+            worddoc = self.word.Documents.Open(in_file, ReadOnly=1)
+        except BaseException:
+            # Save file names that couldn't open
+            return self._failed('docx_failed', file_name, output_path)
+
+        # Save as .pdf
+        try:
+            worddoc.ExportAsFixedFormat(
+                OutputFileName=out_file, Item=wdExportDocumentContent,
+                ExportFormat=wdFormatPDF
+            )
+            return True
+        except BaseException:
+            # Save file names that couldn't convert to .pdf
+            return self._failed('pdf_failed', file_name, output_path)
+        finally:
+            # Close file without saving changes, keep Word running
+            try:
+                worddoc.Close(SaveChanges=0)
+            except BaseException:
+                pass
+
+
+class LibreOfficeConverter(Converter):
     """
-    Convert .docx to .pdf
+    Convert .docx to .pdf with headless LibreOffice (soffice)
+
+    If the python UNO bridge is available, one soffice process is started
+    and documents are fed to it over a pipe. Otherwise every conversion
+    runs soffice --convert-to
     """
-    wdFormatPDF = 17  # PDF format
-    wdExportDocumentContent = 0
-    word = client.DispatchEx("Word.Application")
+    name = "libreoffice"
 
-    in_file = os.path.join(docx_path, file_name)
-    out_file = os.path.join(pdf_path, file_name[:-4] + "pdf")
-    if os.path.exists(out_file):
-        os.remove(out_file)
+    def __init__(self, soffice="soffice", timeout=300):
+        super().__init__()
+        self.soffice = soffice
+        self.timeout = timeout
+        # Every session gets its own LibreOffice profile, otherwise
+        # concurrent soffice instances block each other on the profile lock
+        self.pipe_name = "lo_%i_%i" % (os.getpid(), id(self))
+        self.profile_path = os.path.join(tempfile.gettempdir(), self.pipe_name)
+        self.process = None
+        self.desktop = None
+        self.use_uno = importlib.util.find_spec("uno") is not None
 
-    # Indicator of whether the pdf was successfully saved
-    done = False
+    def _start(self):
+        if not self.use_uno:
+            return
+        import uno
 
-    # Create a new Word Object
-    word = client.DispatchEx("Word.Application")
+        self.process = subprocess.Popen(
+            [self.soffice,
+             "-env:UserInstallation=file://" + self.profile_path,
+             "--headless", "--invisible", "--norestore", "--nologo",
+             "--nodefault",
+             "--accept=pipe,name=" + self.pipe_name + ";urp;"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True)
+        self.pid = self.process.pid
+        # soffice may hang while it starts
+        track_process(self.pid)
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context)
+        url = ("uno:pipe,name=" + self.pipe_name +
+               ";urp;StarOffice.ComponentContext")
+        # Wait until soffice accepts connections
+        deadline = time.time() + 60
+        while True:
+            try:
+                context = resolver.resolve(url)
+                break
+            except BaseException:
+                if self.process.poll() is not None or \
+                        time.time() > deadline:
+                    kill_process_tree(self.process.pid)
+                    untrack_process(self.process.pid)
+                    raise RuntimeError("soffice did not start")
+                time.sleep(0.2)
+        self.desktop = context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", context)
 
-    # Open the word file for read-only
-    try:
-        worddoc = word.Documents.Open(in_file, ReadOnly=1)
-    except BaseException:
-        # Save file names that couldn't open
-        append_to_file(output_path, 'docx_failed.csv', file_name)
+    def _stop(self):
+        try:
+            if self.process is not None:
+                try:
+                    self.desktop.terminate()
+                    self.process.wait(timeout=10)
+                except BaseException:
+                    # Also soffice.bin, which holds the profile
+                    kill_process_tree(self.process.pid)
+                    self.process.wait()
+        finally:
+            self.process = None
+            self.desktop = None
+            # The profile of the soffice --convert-to runs as well
+            shutil.rmtree(self.profile_path, ignore_errors=True)
 
-    # Save as .pdf
-    try:
-        worddoc.ExportAsFixedFormat(
-            OutputFileName=out_file, Item=wdExportDocumentContent,
-            ExportFormat=wdFormatPDF
-        )
-        done = True
-    except BaseException:
-        # Save file names that couldn't convert to .pdf
-        append_to_file(output_path, 'pdf_failed.csv', file_name)
+    def is_alive(self):
+        if not self.started:
+            return False
+        if not self.use_uno:
+            return True
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            self.desktop.getCurrentComponent()
+            return True
+        except BaseException:
+            return False
 
-    finally:
-        # Close file without saving changes
+    def _convert(self, file_name, in_file, out_file, output_path):
+        if not zipfile.is_zipfile(in_file):
+            # Save file names that couldn't open
+            return self._failed('docx_failed', file_name, output_path)
+        if self.use_uno:
+            return self._convert_uno(file_name, in_file, out_file,
+                                     output_path)
+        return self._convert_cli(file_name, in_file, out_file, output_path)
+
+    def _convert_uno(self, file_name, in_file, out_file, output_path):
+        import uno
+
+        # Open the word file for read-only
         try:
-            worddoc.Close(SaveChanges=0)
-            word.Quit()
+            document = self.desktop.loadComponentFromURL(
+                uno.systemPathToFileUrl(in_file), "_blank", 0,
+                _uno_properties(Hidden=True, ReadOnly=True))
+            if document is None:
+                raise IOError("Could not load " + in_file)
         except BaseException:
-            pass
-        return done
+            return self._failed('docx_failed', file_name, output_path)
 
+        # Save as .pdf
+        try:
+            document.storeToURL(
+                uno.systemPathToFileUrl(out_file),
+                _uno_properties(FilterName="writer_pdf_Export"))
+            return True
+        except BaseException:
+            return self._failed('pdf_failed', file_name, output_path)
+        finally:
+            try:
+                document.close(True)
+            except BaseException:
+                pass
 
-def pdf_to_image(input_dir, file_name, output_dir, output_path, temp_path):
+    def _convert_cli(self, file_name, in_file, out_file, output_path):
+        command = [
+            self.soffice,
+            "-env:UserInstallation=file://" + self.profile_path,
+            "--headless", "--norestore", "--nologo",
+            "--convert-to", "pdf:writer_pdf_Export",
+            "--outdir", os.path.dirname(out_file),
+            in_file]
+        try:
+            process = subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                start_new_session=True)
+        except BaseException:
+            return self._failed('pdf_failed', file_name, output_path)
+        track_process(process.pid)
+        try:
+            _, stderr = process.communicate(timeout=self.timeout)
+        except BaseException:
+            kill_process_tree(process.pid)
+            process.wait()
+            return self._failed('pdf_failed', file_name, output_path)
+        finally:
+            untrack_process(process.pid)
+        # soffice exits with 0 even if it could not load the document,
+        # it reports it on stderr instead
+        if b"source file could not be loaded" in stderr:
+            return self._failed('docx_failed', file_name, output_path)
+        if process.returncode != 0 or not os.path.exists(out_file):
+            return self._failed('pdf_failed', file_name, output_path)
+        return True
+
+
+def _word_pid(word):
+    """
+    Find the WINWORD.EXE process of a Word COM object: it is started by the
+    COM server, not by this process, so it is found by its window
+
+    Returns:
+        The pid, None if it could not be found
+    """
+    try:
+        import win32gui
+        import win32process
+
+        caption = "word_%i_%i" % (os.getpid(), id(word))
+        word.Caption = caption
+        # The main Word window exists even if Word is not visible
+        hwnd = win32gui.FindWindow("OpusApp", caption)
+        if hwnd:
+            return win32process.GetWindowThreadProcessId(hwnd)[1]
+    except BaseException:
+        pass
+    return None
+
+
+def _uno_properties(**kwargs):
+    """
+    Build a tuple of UNO PropertyValue from keyword arguments
+    """
+    from com.sun.star.beans import PropertyValue
+
+    properties = []
+    for name, value in kwargs.items():
+        prop = PropertyValue()
+        prop.Name = name
+        prop.Value = value
+        properties.append(prop)
+    return tuple(properties)
+
+
+CONVERTERS = {
+    WordConverter.name: WordConverter,
+    LibreOfficeConverter.name: LibreOfficeConverter,
+}
+
+
+def get_converter(name):
+    """
+    Return a new .docx to .pdf backend by its name: word or libreoffice
+    """
+    try:
+        return CONVERTERS[name]()
+    except KeyError:
+        raise ValueError("Unknown converter: " + str(name) +
+                         ", choose one of: " + ", ".join(CONVERTERS))
+
+
+def pdf_to_image(input_dir, file_name, output_dir, output_path,
+                 workers=1, dpi=300):
     """
     Convert given pdf to images
 
@@ -90,52 +452,25 @@ def pdf_to_image(input_dir, file_name, output_dir, output_path, temp_path):
         input_dir: a path to a folder with the pdf
         file_name: the pdf file name
         output_dir: a path to save the images from pdf
+        workers: the number of processes rendering the pages
+        dpi: the resolution of the images
     """
-    # Create temp_folder to save there separate pages and then delete
-    name = file_name.split(".")[0]
-    temp_folder = os.path.join(temp_path, name)
-    os.makedirs(temp_folder, exist_ok=True)
-
     # Open .pdf
     file_path = os.path.join(input_dir, file_name)
     try:
-        f = open(file_path, "rb")
-        inputpdf = PdfFileReader(f)
+        rasterizer = Rasterizer(file_path, dpi)
     except BaseException:
         append_to_file(output_path, 'pdf_broken.csv', file_name)
+        return False
 
-    number_of_pages = inputpdf.numPages
-    RESOLUTION_COMPRESSION_FACTOR = 300
-
-    # Iterate over all pages
-    for i in range(number_of_pages):
-
-        # Split into single page pdf
-        output = PdfFileWriter()
-        output.addPage(inputpdf.getPage(i))
-        try:
-            with open(
-                os.path.join(temp_folder, "document-page%i.pdf") % i, "wb"
-            ) as outputStream:
-                output.write(outputStream)
-        except BaseException:
-            f.close()
-            append_to_file(output_path, 'pdf_stream.csv', file_name)
-            return False
-
-        # Open the single page pdf as image, compress and save
-        with WANDImage(
-                filename=os.path.join(temp_folder, "document-page%i.pdf") % i,
-                resolution=300) as img:
-            img.background_color = Color("white")
-            img.alpha_channel = 'remove'
-            img.compression_quality = RESOLUTION_COMPRESSION_FACTOR
-            img.save(filename=os.path.join(
-                output_dir, file_name[:-4] + "_%i.png") % i
-            )
-
-        # Remove the single page pdf
-        os.remove(os.path.join(temp_folder, "document-page%i.pdf") % i)
-
-    f.close()
-    os.rmdir(temp_folder)
+    with rasterizer:
+        if workers > 1:
+            pages = rasterizer.render_pages(workers=workers).items()
+        else:
+            # Render page by page to keep one page in memory at a time
+            pages = ((i, rasterizer.render(i))
+                     for i in range(rasterizer.page_count))
+        for i, image in pages:
+            cv2.imwrite(os.path.join(
+                output_dir, file_name[:-4] + "_%i.png") % i, image)
+    return True
@@ -0,0 +1,316 @@
+import collections
+import glob
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from binary_gt import BinaryGroundTruth, COLUMNS
+from image_encoder import CODECS, decode_image
+
+
+class TableSample():
+    """
+    A table of the dataset: its ground truth and its image from
+    table_fuchsia, read and decoded only when image is first accessed
+    """
+
+    def __init__(self, reader, i, gt):
+        self.reader = reader
+        self.index = i
+        self.name = reader.table_names[i]
+        self.loc = gt["loc"]
+        for column in COLUMNS:
+            setattr(self, column, gt[column])
+        self._data = None
+        self._image = None
+
+    def image_bytes(self):
+        """
+        The encoded image of the table (.png, .webp or .npy)
+        """
+        if self._data is None:
+            self._data = self.reader.image_bytes(self.index)
+        return self._data
+
+    @property
+    def image(self):
+        """
+        The table image as a BGR array
+        """
+        if self._image is None:
+            self._image = decode_image(
+                self.image_bytes(), self.reader.image_file(self.index))
+        return self._image
+
+
+class DatasetReader():
+    """
+    Random access to the tables of an output folder by name or index
+
+    The index is built once from what the output folder has:
+        files: a .json per document in gt_tables_dict, an image per table
+               in table_fuchsia (only the folders are listed)
+        shards: the shards of --output shards, from their index files
+        binary: the ground truth converted by binary_gt.py, used instead
+                of the .json files if gt_tables_bin exists
+
+    Reading a table takes one seek per file: the line of its document in a
+    .jsonl shard (or the .json of its document) and the data of its image
+    in a .tar shard (or its file). Tables are named with .png, as in the
+    ground truth, whatever the codec of their images
+    """
+
+    def __init__(self, output_path, layout=None, cache_docs=16):
+        """
+        Args:
+            output_path: the output folder of table_cell_from_docx.py
+            layout: files or shards, found from the output folder if None
+            cache_docs: the number of parsed documents kept in memory,
+                        the tables of a document are often read together
+        """
+        self.output_path = output_path
+        self.gt_path = os.path.join(output_path, "gt_tables_dict")
+        self.tables_path = os.path.join(output_path, "table_fuchsia")
+        self.shards_path = os.path.join(output_path, "shards")
+        binary_path = os.path.join(output_path, "gt_tables_bin")
+        if layout is None:
+            layout = "files"
+            if glob.glob(os.path.join(self.shards_path, "*.index.json")):
+                layout = "shards"
+        self.layout = layout
+        self.binary = None
+        if os.path.exists(os.path.join(binary_path, "meta.json")):
+            self.binary = BinaryGroundTruth(binary_path)
+        self.cache_docs = cache_docs
+        self._docs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._files = {}
+        if layout == "shards":
+            self._index_shards()
+        else:
+            self._index_files()
+        self.table_index = {table_name: i for i, table_name
+                            in enumerate(self.table_names)}
+
+    def _index_files(self):
+        doc_names = set(json_name[:-len(".json")]
+                        for json_name in os.listdir(self.gt_path)
+                        if json_name.endswith(".json"))
+        # The file of a table, a table image is kept only if its document
+        # is processed
+        self.image_files = {}
+        for file_name in os.listdir(self.tables_path):
+            stem, extension = os.path.splitext(file_name)
+            if extension in CODECS.values() and doc_name(stem) in doc_names:
+                self.image_files[stem + ".png"] = file_name
+        self.table_names = sorted(self.image_files)
+
+    def _index_shards(self):
+        """
+        Merge the indexes of the shards: the shard, the offset and the
+        length of every document and table image
+        """
+        self.shard_names = []
+        self.shard_extensions = []
+        self.doc_locations = {}
+        image_locations = {}
+        for index_path in sorted(glob.glob(
+                os.path.join(self.shards_path, "*.index.json"))):
+            shard = len(self.shard_names)
+            self.shard_names.append(index_path[:-len(".index.json")])
+            with open(index_path) as f:
+                index = json.load(f)
+            self.shard_extensions.append(index.get("extension", ".png"))
+            for name, (offset, length) in index["documents"].items():
+                self.doc_locations[name] = (shard, offset, length)
+            for table_name, (offset, size) in index["tables"].items():
+                image_locations[table_name] = (shard, offset, size)
+        # A table without its document (e.g. its shard line was lost in a
+        # killed worker) is left out
+        self.table_names = sorted(
+            table_name for table_name in image_locations
+            if doc_name(table_name) in self.doc_locations)
+        # The location of the image of the i-th table as an array
+        self.image_locations = np.array(
+            [image_locations[table_name] for table_name in self.table_names],
+            dtype=np.int64).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.table_names)
+
+    def __contains__(self, table_name):
+        return table_name in self.table_index
+
+    def _position(self, key):
+        if isinstance(key, str):
+            return self.table_index[key]
+        i = int(key)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(key)
+        return i
+
+    def __getitem__(self, key):
+        """
+        The table given by its name or index
+
+        Returns:
+            a TableSample, its image is not read yet
+        """
+        i = self._position(key)
+        return TableSample(self, i, self.ground_truth(i))
+
+    def ground_truth(self, key):
+        """
+        loc, cells, horizontal_lines and vertical_lines of the table
+        """
+        i = self._position(key)
+        table_name = self.table_names[i]
+        if self.binary is not None:
+            gt = self.binary[table_name]
+        else:
+            gt = self._document(doc_name(table_name))[table_name]
+        return gt
+
+    def _document(self, name):
+        """
+        The ground truth of a document as a dictionary table_name: table
+        """
+        with self._lock:
+            if name in self._docs:
+                self._docs.move_to_end(name)
+                return self._docs[name]
+        if self.layout == "shards":
+            shard, offset, length = self.doc_locations[name]
+            record = json.loads(self._read(
+                self.shard_names[shard] + ".jsonl", offset, length))
+            tables = record["tables"]
+        else:
+            with open(os.path.join(self.gt_path, name + ".json")) as f:
+                tables = json.load(f)
+        gt_tables_dict = {}
+        for table_name, table in tables.items():
+            gt = {"loc": np.asarray(table["loc"], dtype=np.int32)}
+            for column in COLUMNS:
+                gt[column] = np.asarray(
+                    table[column], dtype=np.int32).reshape(-1, 4)
+            gt_tables_dict[table_name] = gt
+        with self._lock:
+            self._docs[name] = gt_tables_dict
+            while len(self._docs) > self.cache_docs:
+                self._docs.popitem(last=False)
+        return gt_tables_dict
+
+    def image_file(self, key):
+        """
+        The file name of the table image, with the extension of its codec
+        """
+        i = self._position(key)
+        table_name = self.table_names[i]
+        if self.layout == "shards":
+            shard = self.image_locations[i][0]
+            return os.path.splitext(table_name)[0] + \
+                self.shard_extensions[shard]
+        return self.image_files[table_name]
+
+    def image_bytes(self, key):
+        """
+        The encoded image of the table
+        """
+        i = self._position(key)
+        if self.layout == "shards":
+            shard, offset, size = self.image_locations[i]
+            return self._read(self.shard_names[shard] + ".tar",
+                              int(offset), int(size))
+        with open(os.path.join(self.tables_path, self.image_file(i)),
+                  "rb") as f:
+            return f.read()
+
+    def _read(self, path, offset, length):
+        """
+        Read length bytes at offset, the shard files stay open and are
+        shared by the threads
+        """
+        key = (os.getpid(), path)
+        fd = self._files.get(key)
+        if fd is None:
+            with self._lock:
+                fd = self._files.get(key)
+                if fd is None:
+                    fd = os.open(path, os.O_RDONLY | getattr(
+                        os, "O_BINARY", 0))
+                    self._files[key] = fd
+        if hasattr(os, "pread"):
+            return os.pread(fd, length, offset)
+        with self._lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+    def iterate(self, indices=None, workers=4, prefetch=64, decode=True):
+        """
+        Iterate over the tables in order, up to prefetch tables are read
+        (and decoded) ahead by a pool of threads
+
+        Args:
+            indices: the tables to read, all tables if None
+            workers: the number of threads, cv2 and the file reads release
+                     the GIL
+            decode: decode the images in the threads, otherwise only their
+                    bytes are read
+        Yields:
+            TableSample
+        """
+        if indices is None:
+            indices = range(len(self))
+        indices = iter(indices)
+        load = self._load_decoded if decode else self._load
+        with ThreadPoolExecutor(workers) as pool:
+            futures = collections.deque()
+            for i in indices:
+                futures.append(pool.submit(load, i))
+                if len(futures) >= prefetch:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    def _load(self, i):
+        sample = self[i]
+        sample.image_bytes()
+        return sample
+
+    def _load_decoded(self, i):
+        sample = self[i]
+        sample.image
+        return sample
+
+    def close(self):
+        for (pid, _), fd in list(self._files.items()):
+            if pid == os.getpid():
+                os.close(fd)
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_lock"] = None
+        state["_files"] = {}
+        state["_docs"] = collections.OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def doc_name(table_name):
+    """
+    The document name of a table named <document>_<page>_<table>.png
+    """
+    return table_name.rsplit("_", 2)[0]
@@ -1,41 +1,323 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+import collections
+import heapq
 import pandas as pd
 import requests
+import argparse
+import threading
+import time
+import csv
 import os
 import uuid
 
+# Every .docx is a zip archive
+ZIP_SIGNATURE = b"PK\x03\x04"
+CHUNK_SIZE = 64 * 1024
+MANIFEST_COLUMNS = ["url", "uuid", "status", "size", "attempts"]
+# Downloads taken from the url list ahead of the free threads, and up to
+# LOOKAHEAD times more while threads wait for a url of a free host
+QUEUED_PER_WORKER = 64
+LOOKAHEAD = 16
 
-def build_url_uuid_df(url_list):
+
+def build_url_uuid_df(url_list, url_uuid_df=None):
     """
-    Given a set of unique urls, build a data frame with the urls and
+    Given a list of urls, build a data frame with the unique urls and
     corresponding uuids
+
+    The uuid of a url is the uuid5 of the url, so that every run gives
+    the same uuids
+
+    Args:
+        url_list: a list of urls, possibly repeated
+        url_uuid_df: a data frame with the urls and uuids of a previous run,
+                     their uuids are kept and the new urls are appended
+    Returns:
+        a data frame with the columns url and uuid
     """
-    url_uuid_df = pd.DataFrame(columns=["url", "uuid"])
-    for url in url_list:
-        uuid_ = uuid.uuid4()
-        add = pd.DataFrame([[url, uuid_]], columns=url_uuid_df.columns)
-        url_uuid_df = url_uuid_df.append(add)
-    url_uuid_df.reset_index(drop=True, inplace=True)
-    return url_uuid_df
+    urls = pd.Series(pd.unique(pd.Series(url_list, dtype=object).dropna()),
+                     dtype=object)
+    if url_uuid_df is not None:
+        url_uuid_df = url_uuid_df[["url", "uuid"]].drop_duplicates("url")
+        urls = urls[~urls.isin(url_uuid_df["url"])]
+    url_uuid_new_df = pd.DataFrame({
+        "url": urls.to_numpy(),
+        "uuid": [str(uuid.uuid5(uuid.NAMESPACE_URL, url)) for url in urls],
+    })
+    if url_uuid_df is not None:
+        url_uuid_new_df = pd.concat([url_uuid_df, url_uuid_new_df])
+    url_uuid_new_df.reset_index(drop=True, inplace=True)
+    return url_uuid_new_df
 
 
-def download_files(url_df, folder_to_save):
+def save_url_uuid_df(url_uuid_df, url_uuid_path):
+    """
+    Save the data frame as .csv and as .parquet next to it
+    """
+    url_uuid_df.to_csv(url_uuid_path)
+    url_uuid_df.to_parquet(
+        os.path.splitext(url_uuid_path)[0] + ".parquet", index=False)
+
+
+class Downloader():
+    """
+    Download files concurrently from many hosts
+
+    Every host has its own session, so connections to the host are kept
+    alive and reused, and its own limit of concurrent downloads
+    """
+
+    def __init__(self, per_host=4, timeout=10, retries=3, backoff=1.0):
+        """
+        Args:
+            per_host: the maximum number of concurrent downloads from a host
+            timeout: the connect and read timeout of a request in seconds
+            retries: the number of retries after a connection error or
+                     a 429/5xx response
+            backoff: the delay before the first retry in seconds, doubled
+                     for every next retry
+        """
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sessions = {}
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def _host(self, url):
+        """
+        The session and the semaphore of the url's host
+        """
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.per_host)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[host] = session
+                self.semaphores[host] = threading.Semaphore(self.per_host)
+            return self.sessions[host], self.semaphores[host]
+
+    def download(self, url, file_path):
+        """
+        Download the url into file_path
+
+        The file is streamed into file_path + ".part" and renamed when
+        complete, so file_path never holds a partial download
+
+        Returns:
+            a dictionary with the status ("ok", "not_docx", "http_<code>",
+            "error"), the size in bytes and the number of attempts
+        """
+        semaphore = self._host(url)[1]
+        result = {"status": "error", "size": 0, "attempts": 0}
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay(attempt))
+            result["attempts"] = attempt + 1
+            with semaphore:
+                result.update(self.attempt(url, file_path))
+            if not _is_retryable(result["status"]):
+                break
+        return result
+
+    def attempt(self, url, file_path):
+        """
+        Download the url into file_path once, without waiting for the limit
+        of the host (see download_files)
+
+        Returns:
+            a dictionary with the status and the size in bytes
+        """
+        session = self._host(url)[0]
+        try:
+            return self._stream(session, url, file_path)
+        except (requests.RequestException, OSError):
+            return {"status": "error", "size": 0}
+
+    def retry_delay(self, attempt):
+        """
+        The delay in seconds before the attempt-th retry
+        """
+        return self.backoff * 2 ** (attempt - 1)
+
+    def _stream(self, session, url, file_path):
+        temp_path = file_path + ".part"
+        with session.get(url, stream=True, timeout=self.timeout) as r:
+            if r.status_code != 200:
+                return {"status": "http_%i" % r.status_code, "size": 0}
+            size = 0
+            head = b""
+            try:
+                with open(temp_path, "wb") as outfile:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        if len(head) < len(ZIP_SIGNATURE):
+                            head += chunk[:len(ZIP_SIGNATURE)]
+                            # An html error page, not a .docx
+                            if len(head) >= len(ZIP_SIGNATURE) and \
+                                    not head.startswith(ZIP_SIGNATURE):
+                                break
+                        outfile.write(chunk)
+                        size += len(chunk)
+                if not head.startswith(ZIP_SIGNATURE):
+                    os.remove(temp_path)
+                    return {"status": "not_docx", "size": 0}
+                os.replace(temp_path, file_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        return {"status": "ok", "size": size}
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+
+
+def _is_retryable(status):
+    """
+    Connection errors, rate limiting and server errors are retried
+    """
+    return status == "error" or status == "http_429" or \
+        status.startswith("http_5")
+
+
+def download_files(url_df, folder_to_save, manifest_path=None, workers=16,
+                   per_host=4, timeout=10, retries=3, backoff=1.0):
     """
     Given a data frame with urls and uuids, download the files from the urls
     and save them with corresponding uuid
+
+    The files already in folder_to_save are skipped. The status of every
+    url is appended to the manifest .csv as soon as its download finishes,
+    so an interrupted run can be resumed
+
+    The urls are taken from url_df only as they can be queued: at most
+    QUEUED_PER_WORKER * workers downloads wait for their turn (LOOKAHEAD
+    times more while threads are idle). A download is handed to a thread
+    only when its host has a free slot, and a retry only when its delay is
+    over, so no thread waits for a busy host
+
+    Args:
+        url_df: a data frame with the columns url and uuid
+        folder_to_save: the folder for the .docx files
+        manifest_path: the .csv with the status of every url, not written
+                       if None
+        workers: the number of concurrent downloads
+        per_host: the maximum number of concurrent downloads from one host
+        timeout, retries, backoff: see Downloader
+    Returns:
+        a dictionary status: number of urls
     """
-    for row in url_df.index:
-        url = url_df.loc[row, "url"]
-        filename = url_df.loc[row, "uuid"]
-        filename = str(filename)+".docx"
-        file_path = os.path.join(folder_to_save, filename)
+    downloader = Downloader(per_host, timeout, retries, backoff)
+    counts = {}
+    manifest = None
+    if manifest_path is not None:
+        new_manifest = not os.path.exists(manifest_path)
+        manifest = open(manifest_path, "a", newline="")
+        manifest_writer = csv.writer(manifest)
+        if new_manifest:
+            manifest_writer.writerow(MANIFEST_COLUMNS)
+    urls = zip(url_df["url"], url_df["uuid"])
+    max_queued = QUEUED_PER_WORKER * workers
+    # Downloads waiting for a slot of their host: host: deque of
+    # [url, uuid, file_path, attempts]
+    queues = collections.OrderedDict()
+    queued = 0
+    # Retries waiting for their delay: (time, number, download)
+    delayed = []
+    active = collections.Counter()
+    futures = {}
+    finished = 0
 
-        try:
-            s = requests.Session()
-            r = s.get(url, timeout=10)
-            with open(file_path, 'wb') as outfile:
-                outfile.write(r.content)
-        except BaseException:
-            pass
+    def submit(host):
+        nonlocal queued
+        queue = queues.get(host)
+        while queue and active[host] < per_host and len(futures) < workers:
+            download = queue.popleft()
+            queued -= 1
+            active[host] += 1
+            futures[executor.submit(
+                downloader.attempt, download[0], download[2])] = \
+                (host, download)
+        if queue is not None and not queue:
+            del queues[host]
+
+    def enqueue(download):
+        nonlocal queued
+        host = urlsplit(download[0]).netloc
+        queues.setdefault(host, collections.deque()).append(download)
+        queued += 1
+        submit(host)
+
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            while True:
+                # Idle threads look further for a url of a free host
+                while urls is not None:
+                    waiting = queued + len(delayed)
+                    if waiting >= LOOKAHEAD * max_queued or \
+                            waiting >= max_queued and len(futures) >= workers:
+                        break
+                    try:
+                        url, uuid_ = next(urls)
+                    except StopIteration:
+                        urls = None
+                        break
+                    file_path = os.path.join(
+                        folder_to_save, str(uuid_) + ".docx")
+                    if os.path.exists(file_path):
+                        counts["exists"] = counts.get("exists", 0) + 1
+                        continue
+                    enqueue([url, uuid_, file_path, 0])
+                while delayed and delayed[0][0] <= time.time():
+                    enqueue(heapq.heappop(delayed)[2])
+                for host in list(queues):
+                    submit(host)
+
+                if not futures:
+                    if not delayed:
+                        if urls is None and not queues:
+                            break
+                        continue
+                    time.sleep(max(delayed[0][0] - time.time(), 0))
+                    continue
+                timeout = None
+                if delayed:
+                    timeout = max(delayed[0][0] - time.time(), 0)
+                done = wait(futures, timeout, FIRST_COMPLETED)[0]
+                for future in done:
+                    host, download = futures.pop(future)
+                    active[host] -= 1
+                    result = future.result()
+                    download[3] += 1
+                    if _is_retryable(result["status"]) and \
+                            download[3] <= retries:
+                        heapq.heappush(delayed, (
+                            time.time() + downloader.retry_delay(download[3]),
+                            id(download), download))
+                        continue
+                    url, uuid_, _, attempts = download
+                    counts[result["status"]] = \
+                        counts.get(result["status"], 0) + 1
+                    if manifest is not None:
+                        manifest_writer.writerow([
+                            url, uuid_, result["status"], result["size"],
+                            attempts])
+                    finished += 1
+                    if finished % 1000 == 0:
+                        if manifest is not None:
+                            manifest.flush()
+                        print("downloaded: ", finished, counts)
+    finally:
+        if manifest is not None:
+            manifest.close()
+        downloader.close()
+    return counts
 
 
 def main():
@@ -43,28 +325,47 @@ def main():
     Download url.csv from TableBank/TableBank_data/Recogntion_data/Word and
     save it in '../url_docx/url.csv'
     """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='16',
+                        help="Number of concurrent downloads")
+    parser.add_argument('--per_host', default='4',
+                        help="Maximum number of concurrent downloads from "
+                        "one host")
+    parser.add_argument('--timeout', default='10',
+                        help="Connect and read timeout in seconds")
+    parser.add_argument('--retries', default='3',
+                        help="Number of retries after connection errors, "
+                        "429 and 5xx responses")
+    args = parser.parse_args()
+
     # Load url.csv
     url_path = '../url_docx/url.csv'
-    url_df = pd.read_csv(url_path)
+    url_list = []
+    if os.path.exists(url_path):
+        url_list = pd.read_csv(url_path, usecols=["url"])['url']
 
-    # Get a list of urls
-    url_list = url_df['url'].tolist()
-
-    # Get a set of unique urls
-    url_list = list(set(url_list))
-
-    # Build a data frame with the urls and corresponding uuids
-    url_uuid_df = build_url_uuid_df(url_list)
-
-    # Save the data frame
+    # Keep the uuids of a previous run, the downloaded files are skipped
     url_uuid_path = "../url_docx/url_uuid.csv"
-    url_uuid_df.to_csv(url_uuid_path)
+    url_uuid_df = None
+    if os.path.exists(url_uuid_path):
+        url_uuid_df = pd.read_csv(url_uuid_path, usecols=["url", "uuid"])
+
+    # Build a data frame with the unique urls and corresponding uuids
+    start = time.time()
+    url_uuid_df = build_url_uuid_df(url_list, url_uuid_df)
+    save_url_uuid_df(url_uuid_df, url_uuid_path)
+    print("urls: ", len(url_uuid_df), " time: ", time.time() - start)
 
     # Create a folder to save downloaded .docx files
     folder_to_save = "../data_docx_structure"
     os.makedirs(folder_to_save, exist_ok=True)
 
-    download_files(url_uuid_df, folder_to_save)
+    manifest_path = "../url_docx/download_manifest.csv"
+    counts = download_files(
+        url_uuid_df, folder_to_save, manifest_path,
+        workers=int(args.workers), per_host=int(args.per_host),
+        timeout=float(args.timeout), retries=int(args.retries))
+    print(counts)
 
 
 if __name__ == "__main__":
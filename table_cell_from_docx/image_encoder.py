@@ -0,0 +1,254 @@
+import io
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import util
+import cv2
+import numpy as np
+
+# Codecs of the written images: the file extension, all of them lossless
+CODECS = {"png": ".png", "webp": ".webp", "npy": ".npy"}
+
+# Image encoders of the current process, see get_image_encoder
+_encoders = {}
+
+
+class ImageEncoder():
+    """
+    Encode images with a codec and write them to files, optionally in a
+    pool of background threads (cv2 releases the GIL while encoding), so
+    that the next step does not wait for the encoding
+
+        png: PNG, level is the zlib compression from 0 (no compression,
+             fastest) to 9, the OpenCV default (fast) if None
+        webp: lossless WebP, smaller and slower than PNG, no level
+        npy: the raw array in the .npy format, no compression
+
+    At most max_pending images wait for their encoding: writing another
+    one blocks until one of them is done, so the memory stays bounded.
+    Files are written under a temporary name and renamed: a file is never
+    seen partially written
+
+    The size and the time of the encodings are counted per codec, see
+    stats
+    """
+
+    def __init__(self, codec="png", level=None, workers=2, max_pending=16):
+        """
+        Args:
+            codec: png, webp or npy
+            level: the compression level of png
+            workers: the number of encoding threads, 0 to encode in the
+                     calling thread
+            max_pending: the maximum number of images waiting for their
+                         encoding (with workers)
+        """
+        if codec not in CODECS:
+            raise ValueError("Unknown codec: " + str(codec) +
+                             ", choose one of: " + ", ".join(CODECS))
+        self.codec = codec
+        self.level = level
+        self.extension = CODECS[codec]
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pool = None
+        if workers > 0:
+            self.pool = ThreadPoolExecutor(workers)
+        self.slots = threading.BoundedSemaphore(max(1, max_pending))
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.error = None
+        self.counts = {}
+
+    def file_name(self, name):
+        """
+        The file name of an image with the extension of the codec, the
+        table names keep .png in the ground truth
+        """
+        return os.path.splitext(name)[0] + self.extension
+
+    def encode(self, image):
+        """
+        Encode the image in the calling thread
+
+        Returns:
+            the encoded bytes
+        """
+        start = time.time()
+        if self.codec == "npy":
+            f = io.BytesIO()
+            np.save(f, np.ascontiguousarray(image))
+            data = f.getvalue()
+        else:
+            params = []
+            if self.codec == "webp":
+                # A quality above 100 is lossless
+                params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+            elif self.level is not None:
+                params = [cv2.IMWRITE_PNG_COMPRESSION, int(self.level)]
+            data = cv2.imencode(self.extension, image, params)[1].tobytes()
+        self._count(image.nbytes, len(data), time.time() - start)
+        return data
+
+    def submit(self, image):
+        """
+        Encode the image in the background
+
+        Returns:
+            a Future of the encoded bytes
+        """
+        return self._submit(self.encode, image)
+
+    def write(self, path, image):
+        """
+        Encode the image and write it to path with the extension of the
+        codec, in the background
+
+        Returns:
+            a Future of the path of the written file
+        """
+        return self._submit(self._write, self.file_name(path), image)
+
+    def _write(self, path, image):
+        data = self.encode(image)
+        temp_path = path + ".%i.tmp" % threading.get_ident()
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        return path
+
+    def _submit(self, function, *args):
+        if self.pool is None:
+            future = Future()
+            future.set_result(function(*args))
+            return future
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            if self.error is None and not future.cancelled():
+                self.error = future.exception()
+        self.slots.release()
+
+    def wait(self, errors=True):
+        """
+        Wait until every submitted image is encoded and written
+
+        Args:
+            errors: raise the first error of the encodings since the last
+                    wait, otherwise the errors are dropped
+        """
+        with self.lock:
+            futures = list(self.pending)
+        for future in futures:
+            try:
+                future.result()
+            except BaseException:
+                pass
+        with self.lock:
+            error = self.error
+            self.error = None
+        if errors and error is not None:
+            raise error
+
+    def read(self, path):
+        """
+        Read an image written by write, path is given without the
+        extension of the codec
+        """
+        return read_image(self.file_name(path))
+
+    def _count(self, raw_bytes, encoded_bytes, seconds):
+        with self.lock:
+            counts = self.counts.setdefault(
+                self.codec, {"images": 0, "raw_bytes": 0,
+                             "encoded_bytes": 0, "seconds": 0.0})
+            counts["images"] += 1
+            counts["raw_bytes"] += raw_bytes
+            counts["encoded_bytes"] += encoded_bytes
+            counts["seconds"] += seconds
+
+    def stats(self):
+        """
+        Per codec: the number of images, the size of the encoded images
+        relative to the raw arrays and the encoding throughput in MB of
+        raw arrays per second of encoding
+        """
+        with self.lock:
+            return {
+                codec: {
+                    "images": counts["images"],
+                    "encoded_mb": round(counts["encoded_bytes"] / 2**20, 2),
+                    "ratio": round(counts["encoded_bytes"] /
+                                   max(counts["raw_bytes"], 1), 4),
+                    "mb_per_s": round(counts["raw_bytes"] / 2**20 /
+                                      max(counts["seconds"], 1e-9), 1)}
+                for codec, counts in self.counts.items()}
+
+    def close(self):
+        """
+        Write the pending images and stop the threads
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    def __getstate__(self):
+        return {"codec": self.codec, "level": self.level,
+                "workers": self.workers, "max_pending": self.max_pending}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+def encoded(data):
+    """
+    The bytes of an encoded image given as bytes or as a Future of bytes
+    (see ImageEncoder.submit)
+    """
+    if isinstance(data, Future):
+        return data.result()
+    return data
+
+
+def read_image(path):
+    """
+    Read an image file written by an ImageEncoder as a BGR array
+    """
+    if path.endswith(CODECS["npy"]):
+        return np.load(path)
+    return cv2.imread(path)
+
+
+def decode_image(data, file_name):
+    """
+    Decode the bytes of an image file with the codec of its extension
+    """
+    if file_name.endswith(CODECS["npy"]):
+        return np.load(io.BytesIO(data))
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                        cv2.IMREAD_COLOR)
+
+
+def get_image_encoder(codec="png", level=None, workers=2):
+    """
+    Return the image encoder of the current process with these settings,
+    its pending images are written when the process exits
+    """
+    key = (os.getpid(), codec, level, workers)
+    if key not in _encoders:
+        encoder = ImageEncoder(codec, level, workers)
+        util.Finalize(encoder, encoder.close, exitpriority=20)
+        _encoders[key] = encoder
+    return _encoders[key]
@@ -0,0 +1,296 @@
+import os
+import socket
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+
+# Final statuses of a document, the failures are also written to
+# <status>.csv in the output folder
+STATUSES = ["processed", "no_tables", "unpack_failed", "docx_failed",
+            "pdf_failed", "pdf_broken", "failed", "timeout"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    uuid TEXT PRIMARY KEY,
+    idx INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker INTEGER,
+    host TEXT,
+    claimed_at REAL,
+    finished_at REAL,
+    duration REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status_idx ON jobs (status, idx);
+CREATE TABLE IF NOT EXISTS stages (
+    uuid TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL,
+    PRIMARY KEY (uuid, attempt, stage)
+);
+"""
+
+
+class JobLedger():
+    """
+    The status of every document of a run in an SQLite database: pending,
+    running or one of STATUSES, with the number of attempts, the duration
+    and the error text, and the duration of every stage
+
+    Every process opens its own connection, a pickled ledger only carries
+    the path of the database. Jobs are claimed in a write transaction, so
+    two workers never claim the same document. A claimed job records the
+    host and the pid of the claiming process: it is claimed again only
+    when this process is gone or after a lease, see reset_running
+    """
+
+    def __init__(self, db_path, timeout=60):
+        """
+        Args:
+            db_path: a path to the database, created if it does not exist
+            timeout: seconds to wait for a lock held by another process
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        # Transactions are started explicitly
+        self.connection = sqlite3.connect(
+            db_path, timeout=timeout, isolation_level=None)
+        # Readers do not block the writer and the other way round
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in
+                   self.connection.execute("PRAGMA table_info(jobs)")]
+        if "host" not in columns:
+            # A ledger of an older version
+            self.connection.execute("ALTER TABLE jobs ADD COLUMN host TEXT")
+
+    @contextmanager
+    def _transaction(self):
+        """
+        A write transaction, the database is locked for the other writers
+        from its start
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def add_jobs(self, uuids, start_idx=0):
+        """
+        Add pending jobs for the uuids not in the ledger yet, idx is the
+        position of the uuid in the url list
+
+        Returns:
+            the uuids of the added jobs
+        """
+        added = []
+        with self._transaction():
+            for idx, uuid_ in enumerate(uuids, start_idx):
+                if self.connection.execute(
+                        "INSERT OR IGNORE INTO jobs (uuid, idx) "
+                        "VALUES (?, ?)", (uuid_, idx)).rowcount:
+                    added.append(uuid_)
+        return added
+
+    def import_csvs(self, output_path, uuids):
+        """
+        Take the statuses of the jobs of the uuids from the <status>.csv
+        files in output_path, written by runs without a ledger (or by the
+        runs of other ranges), e.g. for the jobs just added
+
+        A document that failed and was processed later stays processed
+        """
+        uuids = set(uuids)
+        # processed is set last
+        for status in STATUSES[1:] + STATUSES[:1]:
+            csv_path = os.path.join(output_path, status + ".csv")
+            if not os.path.exists(csv_path):
+                continue
+            with open(csv_path) as f:
+                found = set(line.strip().split(".")[0] for line in f
+                            if line.strip()) & uuids
+            self.set_status(found, status)
+
+    def set_status(self, uuids, status):
+        """
+        Set the status of the jobs of the uuids, e.g. of the documents
+        found complete in the output
+        """
+        with self._transaction():
+            self.connection.executemany(
+                "UPDATE jobs SET status = ? WHERE uuid = ?",
+                [(status, uuid_) for uuid_ in uuids])
+
+    def reset_running(self, start_idx=None, end_idx=None, lease=None):
+        """
+        Return the jobs left running by an interrupted run to pending: the
+        jobs claimed by a process of this host that is gone, and the jobs
+        claimed more than lease seconds ago (by any host)
+
+        The jobs of a run still in progress are left to it
+
+        Returns:
+            the number of jobs returned to pending
+        """
+        where, params = _idx_range(start_idx, end_idx)
+        host = socket.gethostname()
+        with self._transaction():
+            rows = self.connection.execute(
+                "SELECT uuid, worker, host, claimed_at FROM jobs "
+                "%s AND status = 'running'" % where, params).fetchall()
+            # A job of an older ledger has no host
+            stale = [
+                (uuid_,) for uuid_, worker, worker_host, claimed_at in rows
+                if (worker_host in (host, None) and
+                    not _process_alive(worker)) or
+                (lease is not None and
+                 (claimed_at or 0) < time.time() - lease)]
+            self.connection.executemany(
+                "UPDATE jobs SET status = 'pending' WHERE uuid = ?", stale)
+        return len(stale)
+
+    def claim(self, number=1, start_idx=None, end_idx=None):
+        """
+        Mark up to number pending jobs as running, in the order of idx
+
+        Args:
+            start_idx, end_idx: only jobs with start_idx <= idx <= end_idx
+        Returns:
+            a list of uuids
+        """
+        where, params = _idx_range(start_idx, end_idx)
+        query = "SELECT uuid FROM jobs %s AND status = 'pending' " \
+            "ORDER BY idx LIMIT ?" % where
+        params.append(number)
+        # The write lock is taken before reading, so that no other worker
+        # claims the same jobs in between
+        with self._transaction():
+            uuids = [row[0] for row in
+                     self.connection.execute(query, params)]
+            self.connection.executemany(
+                "UPDATE jobs SET status = 'running', "
+                "attempts = attempts + 1, worker = ?, host = ?, "
+                "claimed_at = ? WHERE uuid = ?",
+                [(os.getpid(), socket.gethostname(), time.time(), uuid_)
+                 for uuid_ in uuids])
+        return uuids
+
+    def claim_all(self, start_idx=None, end_idx=None, batch=100):
+        """
+        Claim the pending jobs batch by batch
+
+        Yields:
+            uuids
+        """
+        while True:
+            uuids = self.claim(batch, start_idx, end_idx)
+            if not uuids:
+                return
+            for uuid_ in uuids:
+                yield uuid_
+
+    def finish(self, uuid_, status, duration, error=None, stages=[]):
+        """
+        Record the final status of a job and the durations of its stages
+
+        Args:
+            stages: a list of (stage, status, duration)
+        """
+        with self._transaction():
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, duration = ?, "
+                "error = ? WHERE uuid = ?",
+                (status, time.time(), duration, error, uuid_))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO stages "
+                "(uuid, attempt, stage, status, duration) "
+                "SELECT uuid, attempts, ?, ?, ? FROM jobs WHERE uuid = ?",
+                [(stage, stage_status, stage_duration, uuid_)
+                 for stage, stage_status, stage_duration in stages])
+
+    def report(self, start_idx=None, end_idx=None):
+        """
+        Summary of the ledger
+
+        Returns:
+            a dictionary with the number of jobs per status, the first
+            pending idx, the duration per stage and the last errors
+        """
+        where, params = _idx_range(start_idx, end_idx)
+        statuses = dict(self.connection.execute(
+            "SELECT status, COUNT(*) FROM jobs %s GROUP BY status" % where,
+            params))
+        first_pending = self.connection.execute(
+            "SELECT MIN(idx) FROM jobs %s AND status = 'pending'" % where,
+            params).fetchone()[0]
+        stages = {
+            stage: {"count": count, "mean": mean, "max": max_}
+            for stage, count, mean, max_ in self.connection.execute(
+                "SELECT stage, COUNT(*), AVG(duration), MAX(duration) "
+                "FROM stages GROUP BY stage ORDER BY stage")}
+        errors = self.connection.execute(
+            "SELECT uuid, error FROM jobs %s AND error IS NOT NULL "
+            "ORDER BY finished_at DESC LIMIT 5" % where, params).fetchall()
+        return {"statuses": statuses, "first_pending": first_pending,
+                "stages": stages, "errors": errors}
+
+    def close(self):
+        self.connection.close()
+
+    def __getstate__(self):
+        return {"db_path": self.db_path, "timeout": self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(state["db_path"], state["timeout"])
+
+
+def _process_alive(pid):
+    """
+    Check if the process of pid runs on this host
+    """
+    if pid is None or pid <= 0:
+        return False
+    if sys.platform == "win32":
+        # os.kill would terminate the process
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        # PROCESS_QUERY_LIMITED_INFORMATION
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        # STILL_ACTIVE
+        return exit_code.value == 259
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # A process of another user
+        return True
+    return True
+
+
+def _idx_range(start_idx=None, end_idx=None):
+    """
+    WHERE clause and its parameters for start_idx <= idx <= end_idx
+    """
+    where = "WHERE 1 = 1"
+    params = []
+    if start_idx is not None:
+        where += " AND idx >= ?"
+        params.append(start_idx)
+    if end_idx is not None:
+        where += " AND idx <= ?"
+        params.append(end_idx)
+    return where, params
@@ -0,0 +1,259 @@
+import io
+import json
+import os
+import tarfile
+import uuid
+from multiprocessing import util
+
+# Shard writers of the current process, see get_shard_writer
+_writers = {}
+
+
+class ShardWriter():
+    """
+    Append the ground truth of documents to a JSONL shard and their table
+    images to a tar shard (webdataset layout), instead of one file per
+    document and per table
+
+    A shard is written to .tmp files and renamed when it reaches
+    max_bytes or the writer is closed. Its index, written last, maps
+    every document to the (offset, length) of its line in the .jsonl and
+    every table image to the (offset, size) of its data in the .tar, so
+    that both can be read without scanning the shard. Shards without an
+    index are incomplete
+
+    The images of a shard have one codec: the tar members take its file
+    extension (also kept in the index), the tables keep their .png names
+    of the ground truth in the index
+    """
+
+    def __init__(self, shards_path, max_bytes=1 << 30):
+        """
+        Args:
+            shards_path: a folder for the shards
+            max_bytes: the size of the .tar and .jsonl from which a new
+                       shard is started
+        """
+        self.shards_path = shards_path
+        self.max_bytes = max_bytes
+        # Shard names of different processes and runs never collide
+        self.token = uuid.uuid4().hex[:12]
+        self.number = 0
+        self.tar = None
+
+    def write(self, name, gt_tables_dict, table_images, extension=".png"):
+        """
+        Append the ground truth of the document and its table images
+
+        Args:
+            name: the document name without extension
+            gt_tables_dict: a dictionary table_name: Table
+            table_images: a dictionary table_name: encoded image
+            extension: the file extension of the codec of the images
+        """
+        if self.tar is not None and self.index["extension"] != extension:
+            self.roll()
+        if self.tar is None:
+            self._open(extension)
+        record = {"name": name, "tables": {
+            table_name: table.__dict__
+            for table_name, table in gt_tables_dict.items()}}
+        line = (json.dumps(record, sort_keys=True, separators=(",", ":"),
+                           default=int) + "\n").encode("utf-8")
+        self.index["documents"][name] = (self.jsonl.tell(), len(line))
+        self.jsonl.write(line)
+        for table_name, data in table_images.items():
+            self.index["tables"][table_name] = _add_to_tar(
+                self.tar, os.path.splitext(table_name)[0] + extension, data)
+        # A killed worker loses no written document, see recover_shards
+        self.jsonl.flush()
+        self.tar.fileobj.flush()
+        if self.tar.offset + self.jsonl.tell() >= self.max_bytes:
+            self.roll()
+
+    def _open(self, extension=".png"):
+        self.name = "shard-%s-%05i" % (self.token, self.number)
+        self.number += 1
+        base = os.path.join(self.shards_path, self.name)
+        self.jsonl = open(base + ".jsonl.tmp", "wb")
+        self.tar = tarfile.open(base + ".tar.tmp", "w",
+                                format=tarfile.USTAR_FORMAT)
+        self.index = {"documents": {}, "tables": {}, "extension": extension}
+
+    def roll(self):
+        """
+        Complete the current shard, the next write starts a new one
+        """
+        if self.tar is None:
+            return
+        self.tar.close()
+        self.jsonl.close()
+        self.tar = None
+        _complete_shard(os.path.join(self.shards_path, self.name),
+                        self.index)
+
+    def close(self):
+        self.roll()
+
+
+def _add_to_tar(tar, member_name, data):
+    """
+    Add data to the tar as member_name
+
+    Returns:
+        (offset, size) of the data in the .tar
+    """
+    return _copy_to_tar(tar, member_name, io.BytesIO(data), len(data))
+
+
+def _copy_to_tar(tar, member_name, fileobj, size):
+    """
+    Copy size bytes of fileobj to the tar as member_name
+
+    Returns:
+        (offset, size) of the data in the .tar
+    """
+    tarinfo = tarfile.TarInfo(member_name)
+    tarinfo.size = size
+    tar.addfile(tarinfo, fileobj)
+    # The data is padded to blocks of 512 bytes
+    padded = -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return tar.offset - padded, size
+
+
+def _complete_shard(base, index):
+    """
+    Rename the .tmp files of the shard and write its index, the index
+    is renamed last: a shard with an index is complete
+    """
+    for extension in [".jsonl", ".tar"]:
+        os.replace(base + extension + ".tmp", base + extension)
+    with open(base + ".index.json.tmp", "w") as f:
+        json.dump(index, f, sort_keys=True)
+    os.replace(base + ".index.json.tmp", base + ".index.json")
+
+
+def recover_shards(shards_path):
+    """
+    Complete the shards left as .tmp files by killed workers, keeping
+    every document whose line and table images are complete
+
+    The documents already in a complete shard (done again after the
+    shard was left) are dropped. The files are streamed, a shard is never
+    read into memory
+
+    Must not run while writers of the output are active
+
+    Returns:
+        the names of the documents kept in the completed shards
+    """
+    finished = set()
+    for file_name in os.listdir(shards_path):
+        if file_name.endswith(".index.json"):
+            with open(os.path.join(shards_path, file_name)) as f:
+                finished.update(json.load(f)["documents"])
+    recovered = []
+    for file_name in sorted(os.listdir(shards_path)):
+        if not file_name.endswith(".jsonl.tmp"):
+            continue
+        base = os.path.join(shards_path, file_name[:-len(".jsonl.tmp")])
+        index = {"documents": {}, "tables": {}, "extension": ".png"}
+        members = _complete_members(base + ".tar.tmp")
+
+        # The lines of the documents with all their table images
+        tables = set()
+        with open(base + ".jsonl.tmp", "rb") as f, \
+                open(base + ".jsonl.recover", "wb") as jsonl:
+            for line in f:
+                # The last line may be incomplete
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                name = record["name"]
+                if name in finished or name in index["documents"] or \
+                        not all(table_name in members
+                                for table_name in record["tables"]):
+                    continue
+                index["documents"][name] = (jsonl.tell(), len(line))
+                jsonl.write(line)
+                tables.update(record["tables"])
+        os.replace(base + ".jsonl.recover", base + ".jsonl.tmp")
+
+        # Only the first image of a table is kept, as its first document
+        with tarfile.open(base + ".tar.recover", "w",
+                          format=tarfile.USTAR_FORMAT) as tar:
+            if tables:
+                with tarfile.open(base + ".tar.tmp", "r|") as source:
+                    for tarinfo in source:
+                        table_name = _table_name(tarinfo.name)
+                        if table_name not in tables or \
+                                table_name in index["tables"]:
+                            continue
+                        index["extension"] = os.path.splitext(
+                            tarinfo.name)[1]
+                        index["tables"][table_name] = _copy_to_tar(
+                            tar, tarinfo.name, source.extractfile(tarinfo),
+                            tarinfo.size)
+                        if len(index["tables"]) == len(tables):
+                            break
+        os.replace(base + ".tar.recover", base + ".tar.tmp")
+        _complete_shard(base, index)
+        finished.update(index["documents"])
+        recovered.extend(index["documents"])
+    return recovered
+
+
+def _complete_members(tar_path):
+    """
+    The table names of the complete members of a possibly truncated tar,
+    read as a stream
+    """
+    members = set()
+    if not os.path.exists(tar_path):
+        return members
+    try:
+        with tarfile.open(tar_path, "r|") as tar:
+            for tarinfo in tar:
+                data = tar.extractfile(tarinfo)
+                size = 0
+                while True:
+                    chunk = data.read(1 << 20)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                if size != tarinfo.size:
+                    break
+                members.add(_table_name(tarinfo.name))
+    except (tarfile.TarError, OSError, EOFError):
+        pass
+    return members
+
+
+def _table_name(member_name):
+    """
+    The table name of the ground truth (.png) of a tar member written with
+    the extension of its codec
+    """
+    return os.path.splitext(member_name)[0] + ".png"
+
+
+def get_shard_writer(shards_path, max_bytes=1 << 30):
+    """
+    Return the shard writer of the current process, its last shard is
+    completed when the process exits
+    """
+    key = (os.getpid(), shards_path)
+    if key not in _writers:
+        writer = ShardWriter(shards_path, max_bytes)
+        util.Finalize(writer, writer.close, exitpriority=10)
+        _writers[key] = writer
+    return _writers[key]
+
+
+def close_shard_writers():
+    """
+    Complete the shards of the current process
+    """
+    for key, writer in list(_writers.items()):
+        if key[0] == os.getpid():
+            writer.close()
@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+class Palette():
+    """
+    Cell background colors as one contiguous uint8 array of BGR codes and
+    a lookup table from a packed color to its index in the palette
+
+    The arrays are cached in binary files next to the .csv and memory
+    mapped, so that the workers of a pool share them: a pickled palette
+    only carries the path of the .csv
+    """
+
+    def __init__(self, csv_path, bgr=None):
+        """
+        Args:
+            csv_path: a path to the .csv with the columns HEX and RGB (r-g-b)
+            bgr: the colors of the .csv as an array of BGR codes, if given
+                 the cache is written from it instead of parsing the .csv
+        """
+        self.csv_path = csv_path
+        name = os.path.splitext(csv_path)[0]
+        self.bgr_path = name + "_bgr.npy"
+        self.lookup_path = name + "_lookup.npy"
+        if bgr is not None:
+            self.save_cache(bgr)
+        elif not self._cache_is_valid():
+            self.save_cache(read_csv_bgr(csv_path))
+        self._load_cache()
+
+    def __len__(self):
+        return len(self.bgr)
+
+    def hex(self, i):
+        """
+        HEX code of the i-th color, as used in document.xml
+        """
+        b, g, r = self.bgr[i]
+        return "%02x%02x%02x" % (r, g, b)
+
+    def label(self, keys, number_of_colors=None):
+        """
+        Look up packed colors (see pack_bgr) in the palette
+
+        Args:
+            keys: an array of packed colors
+            number_of_colors: only the first number_of_colors colors of the
+                              palette are looked up
+        Returns:
+            an array of the keys shape with the index of the color in the
+            palette or -1
+        """
+        positions = np.searchsorted(self.sorted_keys, keys)
+        positions[positions == len(self.sorted_keys)] = 0
+        match = self.sorted_keys[positions] == keys
+        labels = np.full(np.shape(keys), -1, dtype=np.int32)
+        labels[match] = self.sorted_index[positions[match]]
+        if number_of_colors is not None:
+            labels[labels >= number_of_colors] = -1
+        return labels
+
+    def save_cache(self, bgr):
+        """
+        Write the BGR array and the lookup table next to the .csv
+        """
+        bgr = np.ascontiguousarray(bgr, dtype=np.uint8)
+        keys = pack_bgr(bgr)
+        order = np.argsort(keys, kind="stable").astype(np.uint32)
+        lookup = np.stack([keys[order], order])
+        for path, array in [(self.bgr_path, bgr),
+                            (self.lookup_path, lookup)]:
+            # Write to a temporary file and rename it, other processes
+            # never see a partially written cache
+            temp_path = path + ".%i.tmp" % os.getpid()
+            with open(temp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(temp_path, path)
+
+    def _cache_is_valid(self):
+        if not os.path.exists(self.bgr_path) or \
+                not os.path.exists(self.lookup_path):
+            return False
+        if not os.path.exists(self.csv_path):
+            return True
+        csv_time = os.path.getmtime(self.csv_path)
+        return os.path.getmtime(self.bgr_path) >= csv_time and \
+            os.path.getmtime(self.lookup_path) >= csv_time
+
+    def _load_cache(self):
+        self.bgr = np.load(self.bgr_path, mmap_mode="r")
+        lookup = np.load(self.lookup_path, mmap_mode="r")
+        self.sorted_keys = lookup[0]
+        self.sorted_index = lookup[1]
+
+    def __getstate__(self):
+        return {"csv_path": self.csv_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["csv_path"])
+
+
+def read_csv_bgr(csv_path):
+    """
+    Read the colors of the .csv into an array of BGR codes
+    """
+    color_code_df = pd.read_csv(csv_path, usecols=["RGB"])
+    rgb = color_code_df["RGB"].str.split("-", expand=True)
+    rgb = rgb.to_numpy(dtype=np.uint8).reshape(-1, 3)
+    return rgb[:, ::-1]
+
+
+def pack_bgr(bgr):
+    """
+    Pack the last axis (B, G, R) of an array into a 24-bit integer key
+    """
+    bgr = np.asarray(bgr, dtype=np.uint32)
+    return (bgr[..., 0] << 16) | (bgr[..., 1] << 8) | bgr[..., 2]
@@ -0,0 +1,196 @@
+import queue
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class Pipeline():
+    """
+    Process documents in stages, every stage with its own pool of workers:
+
+        prepare: read the XML of the .docx and save its fuchsia, aqua and
+                 colorful variants (processes)
+        convert: .docx => .pdf with the renderers (processes, every
+                 process drives its own renderer session from its main
+                 thread, as the Word COM objects require)
+        rasterize: .pdf => .png (processes)
+        detect: find tables, then cells and lines (processes)
+
+    A document goes through convert, rasterize and detect twice: for the
+    tables with the fuchsia and aqua variants, then for the cells with the
+    colorful variant if it has tables. Renderers and CPU cores are busy at
+    the same time with different documents
+
+    At most queue_size documents are in the pipeline, so every queue of
+    the stages is bounded and the documents are taken from docx_names only
+    as the pipeline moves on
+    """
+
+    def __init__(self, wrapper, settings):
+        """
+        Args:
+            wrapper: a DocProcessorWrapper that creates the DocProcessors and
+                     records their status
+            settings: the Settings with the number of workers per stage
+        """
+        self.wrapper = wrapper
+        self.settings = settings
+        self.workers = {
+            "prepare": settings.prepare_workers,
+            "convert": settings.convert_workers,
+            "rasterize": settings.rasterize_workers,
+            "detect": settings.detect_workers or multiprocessing.cpu_count(),
+        }
+        self.queue_size = settings.queue_size or \
+            2 * sum(self.workers.values())
+        self.pools = {pool: ProcessPoolExecutor(workers)
+                      for pool, workers in self.workers.items()}
+        # Finished stages, put by the done callbacks of the futures
+        self.events = queue.Queue()
+        # Seconds spent in the stages per pool
+        self.busy_time = dict.fromkeys(self.pools, 0.0)
+
+    def stages(self):
+        """
+        The stages of a document: (stage, pool, variants)
+        """
+        variants = ["fuchsia"]
+        if self.settings.localization == "ssim":
+            variants.append("aqua")
+        stages = [
+            ("prepare", "prepare", []),
+            ("convert", "convert", variants),
+            ("rasterize", "rasterize", variants),
+            ("locate", "detect", variants),
+            ("convert_color", "convert", ["color"]),
+            ("rasterize_color", "rasterize", ["color"]),
+            ("build", "detect", ["color"]),
+        ]
+        # The detect workers render the pages they need
+        return [stage for stage in stages if stage[1] != "rasterize" or
+                not all(self.settings.pages_in_memory(variant)
+                        for variant in stage[2])]
+
+    def run(self, docx_names):
+        """
+        Process the documents
+
+        Returns:
+            a dictionary status: number of documents
+        """
+        stages = self.stages()
+        docx_names = iter(docx_names)
+        exhausted = False
+        in_flight = 0
+        counts = {}
+        start = time.time()
+        try:
+            while True:
+                while not exhausted and in_flight < self.queue_size:
+                    try:
+                        docx_name = next(docx_names)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    doc = self.wrapper.doc(docx_name)
+                    doc.started_at = time.time()
+                    self._submit(doc, stages, 0)
+                    in_flight += 1
+                if not in_flight:
+                    break
+
+                doc, index, future = self.events.get()
+                stage, pool, _ = stages[index]
+                error = None
+                done = False
+                try:
+                    doc, done, seconds = future.result()
+                    self.busy_time[pool] += seconds
+                except Exception as e:
+                    error = "".join(traceback.format_exception(
+                        type(e), e, e.__traceback__))
+                    doc.status = "failed"
+                    doc.stage_done(stage, "failed")
+                if done and index + 1 < len(stages):
+                    self._submit(doc, stages, index + 1)
+                    continue
+                self._finish(doc, error)
+                counts[doc.status] = counts.get(doc.status, 0) + 1
+                in_flight -= 1
+        finally:
+            self.close()
+        elapsed = time.time() - start
+        print("pipeline: ", counts, " utilization: ", {
+            pool: round(self.busy_time[pool] / elapsed /
+                        self.workers[pool], 2)
+            for pool in self.pools})
+        return counts
+
+    def _submit(self, doc, stages, index):
+        stage, pool, variants = stages[index]
+        args = (doc, stage, variants)
+        try:
+            future = self.pools[pool].submit(_run_stage, *args)
+        except BrokenProcessPool:
+            # A worker of the pool died, the documents it had are failed
+            self.pools[pool] = ProcessPoolExecutor(self.workers[pool])
+            future = self.pools[pool].submit(_run_stage, *args)
+        future.add_done_callback(
+            lambda future: self.events.put((doc, index, future)))
+
+    def _finish(self, doc, error):
+        """
+        Delete the intermediate files of the document and record its status
+        """
+        if doc.status is None:
+            doc.status = "failed"
+        if error is None:
+            doc.clean_up(doc.image_names, doc.table_names)
+        else:
+            # The state of the document from the failed stage is lost
+            doc.clean_up_unknown()
+        self.wrapper.finish(doc, doc.status, time.time() - doc.started_at,
+                            error)
+
+    def close(self):
+        # The workers of the convert pool quit their renderers on exit
+        for pool in self.pools.values():
+            pool.shutdown()
+
+
+def _run_stage(doc, stage, variants):
+    """
+    Run a stage of the document in a worker of the stage pool
+
+    Returns:
+        the document with its new state, True if the document goes on
+        to the next stage and the duration of the stage
+    """
+    start = time.time()
+    doc.step_start = start
+    if stage == "prepare":
+        done = doc.prepare_variants()
+    elif stage.startswith("convert"):
+        done = all(doc.convert(variant) for variant in variants)
+    elif stage.startswith("rasterize"):
+        done = all(doc.rasterize(variant) for variant in variants)
+    else:
+        try:
+            if not all(doc.rasterize(variant) for variant in variants
+                       if doc.settings.pages_in_memory(variant)):
+                done = False
+            elif stage == "locate":
+                done = doc.find_tables()
+                # The table images are read by the next stage, maybe in
+                # another process
+                doc.encoder.wait()
+            else:
+                # Records the steps 6-11 itself
+                done = doc.build_ground_truth() == "processed"
+                return doc, done, time.time() - start
+        finally:
+            doc.close_pages()
+    doc.stage_done(stage, "done" if done else doc.status)
+    return doc, done, time.time() - start
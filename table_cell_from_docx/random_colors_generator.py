@@ -1,15 +1,18 @@
 import pandas as pd
-import random
+import numpy as np
 import argparse
 import os
+import time
+from palette import Palette
 
-
-def random_color():
-    """
-    Generate random RGB code
-    """
-    return random.randrange(0, 256), random.randrange(0, 256),\
-        random.randrange(0, 256)
+# Colors that cell backgrounds must not take: the page, the text and the
+# table borders of the fuchsia and the aqua renders (RGB)
+RESERVED_COLORS = [
+    (255, 255, 255),
+    (0, 0, 0),
+    (255, 0, 255),
+    (0, 255, 255),
+]
 
 
 def rgb2hex(r, g, b):
@@ -19,41 +22,91 @@ def rgb2hex(r, g, b):
     return "%02x%02x%02x" % (r, g, b)
 
 
-def build_color_table(n):
+def allowed_colors_mask(min_dist=1):
+    """
+    Mark the 24-bit colors (packed as r << 16 | g << 8 | b) that cell
+    backgrounds can take
+
+    Args:
+        min_dist: the minimum distance (the maximum over the channels of the
+                  absolute difference) from every reserved color
+    Returns:
+        a boolean array of length 2 ** 24
+    """
+    allowed = np.ones((256, 256, 256), dtype=bool)
+    if min_dist > 0:
+        for r, g, b in RESERVED_COLORS:
+            # The colors closer than min_dist form a cube around the color
+            allowed[max(r - min_dist + 1, 0):r + min_dist,
+                    max(g - min_dist + 1, 0):g + min_dist,
+                    max(b - min_dist + 1, 0):b + min_dist] = False
+    return allowed.ravel()
+
+
+def random_colors(n, seed=0, min_dist=1):
+    """
+    Sample n different colors uniformly from the allowed colors
+
+    Args:
+        n: the number of colors
+        seed: the seed of the random generator
+        min_dist: see allowed_colors_mask
+    Returns:
+        an array of shape (n, 3) with RGB codes
+    """
+    allowed = np.flatnonzero(allowed_colors_mask(min_dist))
+    if n > len(allowed):
+        raise ValueError("Only %i colors are at distance %i from the "
+                         "reserved colors, %i requested" % (
+                             len(allowed), min_dist, n))
+    rng = np.random.default_rng(seed)
+    codes = allowed[rng.choice(len(allowed), size=n, replace=False)]
+    return np.stack([codes >> 16, (codes >> 8) & 255, codes & 255],
+                    axis=1).astype(np.uint8)
+
+
+def build_color_table(n, seed=0, min_dist=1):
     """
     Build a data frame of n random non-repetitive colors with RGB and HEX codes
+
+    Returns:
+        the data frame and the array of RGB codes of shape (n, 3)
     """
-    df_colors = pd.DataFrame(columns=["HEX", "RGB"])
-    hex_list = []
-    for i in range(0, n):
-        r, g, b = random_color()
-        hex_code = rgb2hex(r, g, b)
-        while hex_code in hex_list:
-            r, g, b = random_color()
-            hex_code = rgb2hex(r, g, b)
-        hex_list.append(hex_code)
-        add = pd.DataFrame(
-            [[hex_code, str(r) + "-" + str(g) + "-" + str(b)]],
-            columns=df_colors.columns)
-        df_colors = df_colors.append(add)
-    df_colors.reset_index(drop=True, inplace=True)
-    return df_colors
+    rgb = random_colors(n, seed, min_dist)
+    # Format every channel value once and concatenate the strings
+    hex_codes = np.array(["%02x" % i for i in range(256)], dtype=object)
+    dec_codes = np.array([str(i) for i in range(256)], dtype=object)
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    df_colors = pd.DataFrame({
+        "HEX": hex_codes[r] + hex_codes[g] + hex_codes[b],
+        "RGB": dec_codes[r] + "-" + dec_codes[g] + "-" + dec_codes[b],
+    })
+    return df_colors, rgb
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--n', default='0',
                         help="Number of colors to be generated")
+    parser.add_argument('--seed', default='0',
+                        help="Seed of the random generator")
+    parser.add_argument('--min_dist', default='1',
+                        help="Minimum distance (the largest channel "
+                        "difference) from white, black, fuchsia and aqua")
     args = parser.parse_args()
 
-    random.seed(0)
-    df_colors = build_color_table(int(args.n))
+    start = time.time()
+    df_colors, rgb = build_color_table(
+        int(args.n), int(args.seed), int(args.min_dist))
     dictionaries_path = "../dictionaries"
     os.makedirs(dictionaries_path, exist_ok=True)
     random_colors_path = os.path.join(
         dictionaries_path, "random_colors_" + args.n + ".csv"
     )
     df_colors.to_csv(random_colors_path)
+    # Write the binary palette, the pipeline does not parse the .csv
+    Palette(random_colors_path, bgr=rgb[:, ::-1])
+    print("colors: ", len(df_colors), " time: ", time.time() - start)
 
 
 if __name__ == "__main__":
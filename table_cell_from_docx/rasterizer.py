@@ -0,0 +1,215 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+try:
+    import pymupdf as fitz
+except ImportError:
+    # PyMuPDF < 1.24
+    import fitz
+
+
+class Rasterizer():
+    """
+    Render pages of a pdf directly into BGR uint8 arrays
+
+    The pdf is opened once, only the requested pages are rendered
+    """
+
+    def __init__(self, pdf_path, dpi=300):
+        """
+        Args:
+            pdf_path: a path to the pdf
+            dpi: the resolution of the rendered pages
+        """
+        self.pdf_path = pdf_path
+        self.dpi = dpi
+        self.document = fitz.open(pdf_path)
+        self.page_count = self.document.page_count
+        self.matrix = fitz.Matrix(dpi / 72, dpi / 72)
+
+    def render(self, page_number, dpi=None):
+        """
+        Render one page (starting from 0) into a BGR uint8 array, at dpi
+        instead of the resolution of the rasterizer if given
+        """
+        page = self.document[page_number]
+        matrix = self.matrix
+        if dpi is not None:
+            matrix = fitz.Matrix(dpi / 72, dpi / 72)
+        pix = page.get_pixmap(matrix=matrix, alpha=False)
+        return _pixmap_to_bgr(pix)
+
+    def render_regions(self, page_number, locs):
+        """
+        Render only the given regions of one page, the pixels are the ones
+        of the same regions cropped from render(page_number)
+
+        Args:
+            locs: a list of (x, y, w, h) in pixels of the rendered page
+        Returns:
+            a list of BGR uint8 arrays, one per region
+        """
+        page = self.document[page_number]
+        inverse = ~self.matrix
+        images = []
+        for (x, y, w, h) in locs:
+            # The clip is a pixel larger on every side: its rounding to
+            # pixels must not cut the region
+            clip = fitz.Rect(x - 1, y - 1, x + w + 1, y + h + 1) * inverse
+            pix = page.get_pixmap(matrix=self.matrix, clip=clip,
+                                  alpha=False)
+            image = _pixmap_to_bgr(pix)
+            images.append(np.ascontiguousarray(
+                image[y - pix.y:y - pix.y + h, x - pix.x:x - pix.x + w]))
+        return images
+
+    def page_size(self, page_number):
+        """
+        (width, height) of the rendered page in pixels
+        """
+        rect = self.document[page_number].rect * self.matrix
+        return rect.irect.width, rect.irect.height
+
+    def vector_paths(self, page_number):
+        """
+        Read the vector paths of a page, without rendering the page
+
+        Returns:
+            a list of (fill, area, stroke, segments) in the drawing order:
+            the RGB fill color (or None) and the area of the path, the RGB
+            stroke color (or None) and the area of every stroked segment
+            (with the line width), all areas as (x0, y0, x1, y1) in pixels
+            of the rendered page
+        """
+        page = self.document[page_number]
+        matrix = page.rotation_matrix * self.matrix
+        paths = []
+        for path in page.get_drawings():
+            half_width = (path.get("width") or 0) / 2
+            segments = []
+            if path.get("color") is not None:
+                segments = [
+                    tuple((segment + (-half_width, -half_width,
+                                      half_width, half_width)) * matrix)
+                    for item in path["items"] for segment in _segments(item)]
+            paths.append((_rgb(path.get("fill")),
+                          tuple(fitz.Rect(path["rect"]) * matrix),
+                          _rgb(path.get("color")), segments))
+        return paths
+
+    def color_extents(self, page_number, color_rgb):
+        """
+        Find the parts of the vector paths of a page that are stroked or
+        filled with the given color
+
+        Returns:
+            a list of (x0, y0, x1, y1) in pixels of the rendered page: the
+            area of every stroked segment and of every filled path
+        """
+        color_rgb = tuple(color_rgb)
+        extents = []
+        for fill, area, stroke, segments in self.vector_paths(page_number):
+            if fill == color_rgb:
+                extents.append(area)
+            if stroke == color_rgb:
+                extents.extend(segments)
+        return extents
+
+    def render_pages(self, pages=None, workers=1):
+        """
+        Render the given pages, all pages by default
+
+        Args:
+            pages: a list of page numbers (starting from 0)
+            workers: the number of processes that render page ranges in
+                     parallel, the pdf is opened once per process
+        Returns:
+            a dictionary page_number: BGR uint8 array
+        """
+        if pages is None:
+            pages = list(range(self.page_count))
+        # Workers of multiprocessing.Pool are daemonic and can not start
+        # processes of their own
+        if workers <= 1 or len(pages) <= 1 or \
+                multiprocessing.current_process().daemon:
+            return {page: self.render(page) for page in pages}
+        return render_pages(self.pdf_path, pages, self.dpi, workers)
+
+    def close(self):
+        self.document.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def render_pages(pdf_path, pages, dpi=300, workers=1):
+    """
+    Render the given pages of the pdf, splitting them into contiguous page
+    ranges rendered by separate processes
+
+    Returns:
+        a dictionary page_number: BGR uint8 array
+    """
+    workers = max(1, min(workers, len(pages)))
+    chunk = -(-len(pages) // workers)
+    page_ranges = [pages[i:i + chunk] for i in range(0, len(pages), chunk)]
+    images = {}
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(_render_range, pdf_path, page_range, dpi)
+                   for page_range in page_ranges]
+        for future in futures:
+            images.update(future.result())
+    return images
+
+
+def _render_range(pdf_path, pages, dpi):
+    with Rasterizer(pdf_path, dpi) as rasterizer:
+        return {page: rasterizer.render(page) for page in pages}
+
+
+def _rgb(color):
+    """
+    A pdf RGB color (components from 0 to 1) as 0-255 integers, None for
+    no color or another color space
+    """
+    if color is None or len(color) != 3:
+        return None
+    return tuple(int(round(c * 255)) for c in color)
+
+
+def _segments(item):
+    """
+    The drawn segments of a path item as rectangles: the sides of a
+    rectangle or a quad, a line, the bounding box of a curve
+    """
+    kind = item[0]
+    if kind == "re":
+        rect = fitz.Rect(item[1])
+        corners = [rect.tl, rect.tr, rect.br, rect.bl]
+    elif kind == "qu":
+        quad = item[1]
+        corners = [quad.ul, quad.ur, quad.lr, quad.ll]
+    else:
+        return [_points_rect(item[1:])]
+    return [_points_rect([corners[i], corners[(i + 1) % 4]])
+            for i in range(4)]
+
+
+def _points_rect(points):
+    xs = [point.x for point in points]
+    ys = [point.y for point in points]
+    return fitz.Rect(min(xs), min(ys), max(xs), max(ys))
+
+
+def _pixmap_to_bgr(pix):
+    """
+    Convert an RGB pixmap to a BGR uint8 array
+    """
+    image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(
+        pix.height, pix.stride)[:, :pix.width * pix.n]
+    image = image.reshape(pix.height, pix.width, pix.n)
+    # RGB => BGR, makes the array contiguous as OpenCV expects
+    return np.ascontiguousarray(image[:, :, ::-1])
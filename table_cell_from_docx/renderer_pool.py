@@ -0,0 +1,176 @@
+import collections
+import os
+import queue
+import threading
+import time
+from multiprocessing import util
+from converter import get_converter
+from utils.file_utils import append_to_file
+
+# Renderer pools of the current process, see get_renderer_pool
+_pools = {}
+
+# Number of the last conversion latencies kept for the median
+LATENCY_WINDOW = 1000
+
+
+class RendererPool():
+    """
+    A pool of long-lived renderer sessions (MS Word, LibreOffice)
+
+    Documents are fed to already running sessions. A session is recycled
+    after max_docs conversions or as soon as it stops responding
+    """
+
+    def __init__(self, converter_name, size=1, max_docs=50):
+        """
+        Args:
+            converter_name: the .docx to .pdf backend: word or libreoffice
+            size: the maximum number of sessions running at the same time
+            max_docs: the number of conversions after which a session is
+                      restarted
+        """
+        self.converter_name = converter_name
+        self.size = size
+        self.max_docs = max_docs
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.launches = 0
+        self.recycled = 0
+        self.crashed = 0
+        self.conversions = 0
+        # The mean and the maximum are over all conversions, the median
+        # over the last LATENCY_WINDOW ones
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def convert(self, file_name, docx_path, pdf_path, output_path):
+        """
+        Convert docx_path/file_name to pdf_path/file_name.pdf with a warm
+        session
+
+        Returns:
+            None if the pdf was successfully saved, otherwise the failure
+            status: docx_failed or pdf_failed
+        """
+        session = self._acquire()
+        start = time.time()
+        try:
+            if session.docx_to_pdf(
+                    file_name, docx_path, pdf_path, output_path):
+                failure = None
+            else:
+                failure = session.failure or "pdf_failed"
+        except BaseException:
+            # The session failed to start or crashed outside the conversion
+            session.documents = self.max_docs
+            append_to_file(output_path, 'pdf_failed.csv', file_name)
+            failure = "pdf_failed"
+        finally:
+            with self.lock:
+                latency = time.time() - start
+                self.conversions += 1
+                self.latencies.append(latency)
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+            session.documents += 1
+            self._release(session)
+        return failure
+
+    def _acquire(self):
+        """
+        Take an idle healthy session or launch a new one
+        """
+        while True:
+            try:
+                session = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    launch = self.running < self.size
+                    if launch:
+                        self.running += 1
+                if not launch:
+                    # All sessions are busy, wait for one of them
+                    session = self.idle.get()
+                else:
+                    session = get_converter(self.converter_name)
+                    session.documents = 0
+                    with self.lock:
+                        self.launches += 1
+                    return session
+            if session.is_alive():
+                return session
+            # The session crashed while it was idle
+            self._drop(session, crashed=True)
+
+    def _release(self, session):
+        """
+        Give the session back to the pool or recycle it
+        """
+        if not session.is_alive():
+            self._drop(session, crashed=True)
+        elif session.documents >= self.max_docs:
+            self._drop(session, crashed=False)
+        else:
+            self.idle.put(session)
+
+    def _drop(self, session, crashed):
+        session.stop()
+        with self.lock:
+            self.running -= 1
+            if crashed:
+                self.crashed += 1
+            else:
+                self.recycled += 1
+
+    def close(self):
+        """
+        Stop all idle sessions
+        """
+        while True:
+            try:
+                session = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._drop(session, crashed=False)
+
+    def stats(self):
+        """
+        Return launches, launches avoided by reusing sessions and the
+        conversion latency in seconds (the median of the last
+        LATENCY_WINDOW conversions)
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {
+                "conversions": self.conversions,
+                "launches": self.launches,
+                "launches_avoided": max(self.conversions - self.launches, 0),
+                "recycled": self.recycled,
+                "crashed": self.crashed,
+            }
+            if latencies:
+                stats["latency_mean"] = self.latency_total / self.conversions
+                stats["latency_median"] = latencies[len(latencies) // 2]
+                stats["latency_max"] = self.latency_max
+        return stats
+
+
+def get_renderer_pool(converter_name, size=1, max_docs=50):
+    """
+    Return the renderer pool of the current process, every worker of
+    a multiprocessing.Pool gets its own pool on first use. The pool runs
+    at most the largest size asked for so far sessions at a time
+    """
+    key = (os.getpid(), converter_name)
+    if key not in _pools:
+        pool = RendererPool(converter_name, size, max_docs)
+        # Quit the renderers when the process exits
+        util.Finalize(pool, pool.close, exitpriority=10)
+        _pools[key] = pool
+    pool = _pools[key]
+    with pool.lock:
+        pool.size = max(pool.size, size)
+    return pool
@@ -0,0 +1,354 @@
+import os
+import pickle
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+
+# The pipe of the current worker process to the scheduler, see
+# track_process
+_connection = None
+_send_lock = threading.Lock()
+
+
+class Scheduler():
+    """
+    Run a function over a stream of tasks in worker processes
+
+    Unlike multiprocessing.Pool.map, the tasks are taken from the iterable
+    only when a worker is free and the results are yielded as soon as they
+    are ready. A worker that runs longer than timeout on one task is killed
+    together with the processes it started (e.g. the renderer) and replaced:
+    its process group on Linux, and the processes it reported with
+    track_process (e.g. the Word COM server, which is not its child).
+    A worker is also replaced after max_tasks tasks, so that memory leaked
+    by a task does not build up
+    """
+
+    def __init__(self, function, processes=None, timeout=None,
+                 max_tasks=None):
+        """
+        Args:
+            function: a picklable callable taking one task
+            processes: the number of worker processes, the number of CPUs
+                       by default
+            timeout: the maximum number of seconds per task, no limit if
+                     None
+            max_tasks: the number of tasks after which a worker is replaced,
+                       never if None
+        """
+        self.function = function
+        self.processes = processes or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        self.workers = []
+        self.started = 0
+        self.timed_out = 0
+        self.crashed = 0
+
+    def imap_unordered(self, tasks):
+        """
+        Run the function on every task
+
+        Yields:
+            (task, status, value), status is "done" with the return value of
+            the function, or "failed" with the traceback of the exception,
+            "timeout" or "crashed" with a description
+        """
+        tasks = iter(tasks)
+        exhausted = False
+        try:
+            while True:
+                # Every free worker takes the next task: at most one task
+                # per worker is taken from the iterable
+                while not exhausted:
+                    worker = self._free_worker()
+                    if worker is None:
+                        break
+                    try:
+                        task = next(tasks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    worker.assign(task)
+                busy = [worker for worker in self.workers if worker.busy]
+                if not busy:
+                    return
+                for result in self._wait(busy):
+                    yield result
+        finally:
+            self.close()
+
+    def _free_worker(self):
+        """
+        A started worker without a task, or a new worker if there are less
+        than processes workers
+        """
+        for worker in self.workers:
+            if not worker.busy:
+                return worker
+        if len(self.workers) < self.processes:
+            worker = _Worker(self.function, self.max_tasks)
+            self.workers.append(worker)
+            self.started += 1
+            return worker
+        return None
+
+    def _wait(self, busy):
+        """
+        Wait until a busy worker finishes its task or the first deadline
+
+        Returns:
+            a list of (task, status, value) of the finished tasks
+        """
+        timeout = None
+        if self.timeout is not None:
+            deadline = min(worker.started_at for worker in busy) + \
+                self.timeout
+            timeout = max(deadline - time.time(), 0)
+        wait([worker.connection for worker in busy] +
+             [worker.process.sentinel for worker in busy], timeout)
+
+        results = []
+        now = time.time()
+        for worker in busy:
+            task = worker.task
+            try:
+                result = worker.receive()
+            except (EOFError, OSError):
+                result = self._crashed(worker)
+            else:
+                if result is not None:
+                    worker.done()
+            if result is not None:
+                status, value = result
+            elif not worker.process.is_alive():
+                status, value = self._crashed(worker)
+            elif self.timeout is not None and \
+                    now - worker.started_at >= self.timeout:
+                worker.kill()
+                self.timed_out += 1
+                status = "timeout"
+                value = "killed after %i seconds" % self.timeout
+            else:
+                continue
+            results.append((task, status, value))
+            if not worker.process.is_alive() or \
+                    (self.max_tasks and worker.tasks >= self.max_tasks):
+                # Let a recycled worker exit, it runs the finalizers
+                worker.close()
+                self.workers.remove(worker)
+        return results
+
+    def _crashed(self, worker):
+        worker.kill()
+        self.crashed += 1
+        return "crashed", "worker exited with code %s" % \
+            worker.process.exitcode
+
+    def stats(self):
+        """
+        Return the number of started, timed out and crashed workers
+        """
+        return {"workers_started": self.started,
+                "timed_out": self.timed_out,
+                "crashed": self.crashed}
+
+    def close(self):
+        """
+        Stop all workers, the busy ones are killed
+        """
+        for worker in self.workers:
+            if worker.busy:
+                worker.kill()
+            else:
+                worker.close()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _Worker():
+    """
+    A worker process with its own pipe, killing it never breaks the pipes
+    of the other workers
+    """
+
+    def __init__(self, function, max_tasks):
+        self.connection, child_connection = multiprocessing.Pipe()
+        # The function is pickled with any start method, so that e.g.
+        # a database connection is never shared with the parent
+        self.process = multiprocessing.Process(
+            target=_work,
+            args=(pickle.dumps(function), child_connection, max_tasks),
+            daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.busy = False
+        self.task = None
+        self.started_at = None
+        self.tasks = 0
+        # The running processes reported by the worker, see track_process
+        self.processes = set()
+
+    def assign(self, task):
+        self.connection.send(task)
+        self.busy = True
+        self.task = task
+        self.started_at = time.time()
+
+    def receive(self):
+        """
+        Read the messages of the worker: the processes it reports and the
+        result of its task
+
+        Returns:
+            (status, value) of the task, None if the task is not done
+        """
+        while self.connection.poll():
+            status, value = self.connection.recv()
+            if status == "process":
+                self.processes.add(value)
+            elif status == "process_exited":
+                self.processes.discard(value)
+            else:
+                return status, value
+        return None
+
+    def done(self):
+        self.busy = False
+        self.task = None
+        self.tasks += 1
+
+    def kill(self, tracked=True):
+        """
+        Kill the worker and the processes it started
+
+        Args:
+            tracked: also kill the processes reported with track_process
+        """
+        if tracked:
+            try:
+                # The processes reported up to now
+                self.receive()
+            except (EOFError, OSError):
+                pass
+            for pid in self.processes:
+                kill_process_tree(pid)
+        self.processes = set()
+        if self.process.is_alive() and hasattr(os, "killpg"):
+            try:
+                # The worker leads its own process group, see _work
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                # The worker has not started its group yet
+                pass
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+        self.busy = False
+
+    def close(self, timeout=60):
+        """
+        Let the worker exit normally, kill it if it does not
+        """
+        if self.process.is_alive():
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+            self.process.join(timeout)
+        # The renderers of a worker that exited normally are stopped by
+        # its finalizers
+        self.kill(tracked=self.process.is_alive())
+
+
+def track_process(pid):
+    """
+    Report a process started by the current worker that is not in its
+    process group (e.g. the Word COM server is started by the system,
+    soffice runs in its own session), it is killed with kill_process_tree
+    if the worker times out or crashes
+
+    Does nothing outside the worker processes of a Scheduler
+    """
+    _send(("process", pid))
+
+
+def untrack_process(pid):
+    """
+    Report that a process given to track_process has exited
+    """
+    _send(("process_exited", pid))
+
+
+def _send(message):
+    if _connection is None or not message[1]:
+        return
+    with _send_lock:
+        try:
+            _connection.send(message)
+        except OSError:
+            pass
+
+
+def kill_process_tree(pid):
+    """
+    Kill the process pid and its child processes
+
+    On POSIX the children are the processes of the group of pid, so pid
+    must be started with start_new_session=True (e.g. the soffice launcher
+    forks soffice.bin). The group is killed even if pid already exited
+    """
+    if sys.platform == "win32":
+        subprocess.run(["taskkill", "/T", "/F", "/PID", str(pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        # Not a group leader, or the group has exited
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            # Already exited
+            pass
+
+
+def _work(function, connection, max_tasks):
+    """
+    The loop of a worker process: run the pickled function on the tasks
+    from the connection until None or max_tasks tasks
+    """
+    global _connection
+    _connection = connection
+    if hasattr(os, "setsid"):
+        # A new process group: the renderers started by the worker are
+        # killed together with it
+        os.setsid()
+    function = pickle.loads(function)
+    tasks = 0
+    while not max_tasks or tasks < max_tasks:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        try:
+            result = ("done", function(task))
+        except Exception:
+            result = ("failed", traceback.format_exc())
+        with _send_lock:
+            connection.send(result)
+        tasks += 1
+    connection.close()
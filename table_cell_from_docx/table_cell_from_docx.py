@@ -1,52 +1,227 @@
-# https://imagemagick.org/script/download.php#windows
-# https://www.ghostscript.com/download/gsdnld.html
 import argparse
+import functools
 import os
 import pandas as pd
-import shutil
 import multiprocessing
+import time
+import traceback
+from multiprocessing import util
 from line_builder import build_lines
-from xml_modifier import XMLModifier
-from cell_detector import cell_borders_detection
-from converter import save_docx, unpack_zip, docx_to_pdf, pdf_to_image
-from table_detector import pixelwisecomp, crop_tables
+from xml_modifier import XMLVariants, DOC_XML, STYLES_XML
+from cell_detector import cell_borders_detection, \
+    cell_borders_detection_image, cell_borders_detection_vector
+from converter import read_docx_parts, repack_docx, pdf_to_image
+from rasterizer import Rasterizer
+from renderer_pool import get_renderer_pool
+from palette import Palette
+from ledger import JobLedger
+from scheduler import Scheduler
+from pipeline import Pipeline
+from output_writer import get_shard_writer, close_shard_writers, \
+    recover_shards
+from image_encoder import get_image_encoder, encoded
+from table_detector import pixelwisecomp, compare_page_images, crop_tables, \
+    locate_tables_by_color, locate_tables_by_color_image, \
+    locate_tables_by_vector, coarse_table_regions, locate_tables_in_regions, \
+    FUCHSIA
 from utils.file_utils import save_dict, append_to_file
 from utils.draw_utils import draw_lines, draw_cell_borders
 
+# Stages of DocProcessor.retrieve_tables_structure, in the order of the steps
+STEPS = ["unpack", "render_fuchsia", "render_aqua", "locate_tables",
+         "render_color", "crop_tables", "detect_cells", "draw_cells",
+         "build_lines", "draw_lines", "save"]
 
-def create_docs(docx_path, docx_names, output_path, multiproc, debug):
+# Processes that print their renderer and encoder stats at exit, see
+# report_stats_at_exit
+_reporting = set()
+
+
+def create_docs(docx_path, docx_names, output_path, multiproc, debug,
+                settings, ledger=None):
     """
     For a set of .docx documents find tables, crop them, build ground truth for
     cell, separating horizontal and vertical line positions
+
+    Args:
+        ledger: a JobLedger to record the status of every document in
     """
     dirs = Directories(output_path)
-    colors = Colors()
+    # Loaded from the binary cache, workers map the same files
+    colors = Palette('../dictionaries/random_colors_100000.csv')
     dirs.create_folders()
-    wrapper = DocProcessorWrapper(docx_path, colors, dirs, debug)
-    if multiproc:
-        # Parallel run
+    wrapper = DocProcessorWrapper(docx_path, colors, dirs, debug, settings,
+                                  ledger)
+    # Shards left incomplete by the workers of an interrupted run, their
+    # complete documents are not done again
+    recovered = recover_shards(dirs.shards_path)
+    if ledger is not None and recovered:
+        ledger.set_status(recovered, "processed")
+    if settings.pipeline:
+        # Stage-parallel run
+        Pipeline(wrapper, settings).run(docx_names)
+    elif multiproc:
+        # Parallel run, documents are taken from docx_names only when
+        # a worker is free
         processes_number = multiprocessing.cpu_count()
-        p = multiprocessing.Pool(processes_number)
-        p.map(wrapper, docx_names)
+        scheduler = Scheduler(wrapper, processes_number,
+                              settings.doc_timeout, settings.max_tasks)
+        for docx_name, status, value in scheduler.imap_unordered(
+                docx_names):
+            if status != "done":
+                # The worker crashed or was killed in the middle of the
+                # document
+                wrapper.abort(docx_name, status, value)
+        print("scheduler: ", scheduler.stats())
     else:
         # Sequential run
         for docx_name in docx_names:
             wrapper(docx_name)
+        close_shard_writers()
     dirs.delete_folders()
 
 
 class DocProcessorWrapper():
 
-    def __init__(self, docx_path, colors, dirs, debug):
+    def __init__(self, docx_path, colors, dirs, debug, settings,
+                 ledger=None):
         self.docx_path = docx_path
         self.colors = colors
         self.dirs = dirs
         self.debug = debug
+        self.settings = settings
+        self.ledger = ledger
 
     def __call__(self, docx_name):
-        doc = DocProcessor(docx_name, self.docx_path, self.colors,
-                           self.dirs, self.debug)
-        doc.retrieve_tables_structure()
+        doc = self.doc(docx_name)
+        start = time.time()
+        error = None
+        try:
+            status = doc.retrieve_tables_structure()
+        except Exception:
+            # One broken document does not stop the run
+            status = "failed"
+            error = traceback.format_exc()
+        self.finish(doc, status, time.time() - start, error)
+        return status
+
+    def doc(self, docx_name):
+        return DocProcessor(docx_name, self.docx_path, self.colors,
+                            self.dirs, self.debug, self.settings)
+
+    def finish(self, doc, status, duration, error=None):
+        """
+        Record the status of a processed document
+        """
+        if error is not None:
+            print(error)
+            append_to_file(self.dirs.output_path, 'failed.csv',
+                           doc.docx_name)
+        if self.ledger is not None:
+            self.ledger.finish(doc.name, status, duration, error, doc.stages)
+
+    def abort(self, docx_name, status, error):
+        """
+        Record a document whose worker crashed or timed out and delete its
+        intermediate files
+        """
+        print("name: ", docx_name, status, error)
+        if status != "timeout":
+            status = "failed"
+        append_to_file(self.dirs.output_path, status + '.csv', docx_name)
+        if self.ledger is not None:
+            self.ledger.finish(docx_name.split(".")[0], status, None, error)
+        doc = self.doc(docx_name)
+        doc.clean_up_unknown()
+        # No ground truth is saved for the tables of the document
+        for table_name in os.listdir(self.dirs.tables_path):
+            if table_name.startswith(doc.name + "_"):
+                os.remove(os.path.join(self.dirs.tables_path, table_name))
+
+
+class Settings():
+    """
+    Options of a run that are shared by all documents
+    """
+
+    def __init__(self, converter="word", renderer_max_docs=50,
+                 render_workers=1, in_memory=False, localization="ssim",
+                 diff_engine="ssim", doc_timeout=None, max_tasks=None,
+                 pipeline=False, prepare_workers=1, convert_workers=1,
+                 rasterize_workers=1, detect_workers=None, queue_size=None,
+                 output="files", shard_size=1 << 30, cells="raster",
+                 dpi=300, detection_dpi=None, codec="png", codec_level=None,
+                 encode_workers=2):
+        # Name of the .docx to .pdf backend: word or libreoffice
+        self.converter = converter
+        # Number of conversions after which a renderer session is restarted
+        self.renderer_max_docs = renderer_max_docs
+        # Number of processes rendering page ranges of a pdf in parallel,
+        # only for the sequential run
+        self.render_workers = render_workers
+        # Keep page images and colored tables in memory instead of
+        # images_fuchsia, images_aqua, images_color and table_color
+        self.in_memory = in_memory
+        # How to find tables on the pages: ssim compares the fuchsia and
+        # the aqua render, mask finds the fuchsia borders in one render,
+        # vector finds them in the paths of the fuchsia pdf (only the pages
+        # with tables are rendered, for the table images)
+        self.localization = localization
+        # How the fuchsia and the aqua pages are compared: ssim or exact
+        self.diff_engine = diff_engine
+        # Seconds after which the worker processing a document is killed,
+        # no limit if None (only for the parallel run)
+        self.doc_timeout = doc_timeout
+        # Number of documents after which a worker process is replaced,
+        # never if None (only for the parallel run)
+        self.max_tasks = max_tasks
+        # Run the documents through the stage pools of pipeline.Pipeline,
+        # the number of workers per stage (detect: the number of CPUs by
+        # default) and the maximum number of documents in the pipeline
+        self.pipeline = pipeline
+        self.prepare_workers = prepare_workers
+        self.convert_workers = convert_workers
+        self.rasterize_workers = rasterize_workers
+        self.detect_workers = detect_workers
+        self.queue_size = queue_size
+        # Layout of the output: files - a .json per document in
+        # gt_tables_dict and a .png per table in table_fuchsia, shards -
+        # .jsonl and .tar shards of about shard_size bytes in shards
+        self.output = output
+        self.shard_size = shard_size
+        # How to find the cells of the tables: raster finds the cell colors
+        # in the colorful render, vector finds them in the filled paths of
+        # the colorful pdf (no page is rendered)
+        self.cells = cells
+        # Resolution of the page renders and of the table images, and the
+        # lower resolution of the fuchsia and aqua renders the tables are
+        # first searched in (then found again at dpi in the regions where
+        # they can be), the same as dpi if None
+        self.dpi = dpi
+        self.detection_dpi = detection_dpi
+        # Codec of the table images, the colored tables and the debug
+        # drawings (png, webp or npy, see image_encoder.ImageEncoder), its
+        # level and the number of threads encoding them in the background
+        self.codec = codec
+        self.codec_level = codec_level
+        self.encode_workers = encode_workers
+
+    def coarse_detection(self):
+        """
+        Check if the tables are first searched at detection_dpi
+        """
+        return self.localization != "vector" and \
+            self.detection_dpi is not None and self.detection_dpi < self.dpi
+
+    def pages_in_memory(self, variant):
+        """
+        Check if the pages of the variant (fuchsia, aqua or color) are
+        rendered when they are needed instead of into its images folder
+        """
+        if variant == "color":
+            return self.in_memory or self.cells == "vector"
+        return self.in_memory or self.localization == "vector" or \
+            self.coarse_detection()
 
 
 class Directories():
@@ -54,7 +229,6 @@ class Directories():
     def __init__(self, output_path):
         # Absolute path is necessary for converting .docx for .pdf
         self.output_path = os.path.abspath(output_path)
-        self.unzipped_path = os.path.join(self.output_path, "unzipped")
         self.fuchsia_docx_path = os.path.join(self.output_path, "docx_fuchsia")
         self.fuchsia_pdf_path = os.path.join(self.output_path, "pdf_fuchsia")
         self.aqua_docx_path = os.path.join(self.output_path, "docx_aqua")
@@ -72,11 +246,11 @@ class Directories():
         self.color_tables_path = os.path.join(self.output_path, "table_color")
         self.gt_cells_path = os.path.join(self.output_path, "gt_cells")
         self.gt_rows_cols_path = os.path.join(self.output_path, "gt_rows_cols")
+        self.shards_path = os.path.join(self.output_path, "shards")
         self.temp_path = os.path.join(output_path, "_temp")
 
     def create_folders(self):
         os.makedirs(self.output_path, exist_ok=True)
-        os.makedirs(self.unzipped_path, exist_ok=True)
         os.makedirs(self.fuchsia_docx_path, exist_ok=True)
         os.makedirs(self.fuchsia_pdf_path, exist_ok=True)
         os.makedirs(self.aqua_docx_path, exist_ok=True)
@@ -91,11 +265,11 @@ class Directories():
         os.makedirs(self.color_tables_path, exist_ok=True)
         os.makedirs(self.gt_cells_path, exist_ok=True)
         os.makedirs(self.gt_rows_cols_path, exist_ok=True)
+        os.makedirs(self.shards_path, exist_ok=True)
         os.makedirs(self.temp_path, exist_ok=True)
 
     def delete_folders(self):
         self.folders_to_del = [
-            self.unzipped_path,
             self.fuchsia_docx_path,
             self.fuchsia_pdf_path,
             self.aqua_docx_path,
@@ -112,38 +286,32 @@ class Directories():
                 os.rmdir(folder)
 
 
-class Colors():
-    def __init__(self):
-        # Load generated data frame of random colors
-        color_code_df = pd.read_csv('../dictionaries/random_colors_100000.csv')
-        # Create list HEX+BGR
-        self.colors = []
-        for row in color_code_df.index:
-            rgb = color_code_df.loc[row, "RGB"]
-            r = int(rgb.split("-")[0])
-            g = int(rgb.split("-")[1])
-            b = int(rgb.split("-")[2])
-            self.colors.append([color_code_df.loc[row, "HEX"]] + [b, g, r])
-
-
 class DocProcessor():
     """
     For .docx find tables, crop them, build ground truth for cell, separating
     horizontal and vertical line positions
     """
 
-    def __init__(self, docx_name, docx_path, colors, dirs, debug):
+    def __init__(self, docx_name, docx_path, colors, dirs, debug, settings):
         """
         Args:
             docx_name: a word document name incl. .docx
             docx_path: a path with the word document
-            colors: an object that contain a list of different colors: hex+rgb
+            colors: a Palette of different cell background colors
             output_path: a path to save output tables and ground truth
+            settings: options of the run, e.g. the .docx to .pdf backend
         """
         print("name: ", docx_name)
         self.colors = colors
         self.dirs = dirs
         self.debug = debug
+        self.settings = settings
+        # Renderer sessions are kept warm across the documents of a worker
+        self.converter = get_renderer_pool(
+            settings.converter, max_docs=settings.renderer_max_docs)
+        self.encoder = get_image_encoder(
+            settings.codec, settings.codec_level, settings.encode_workers)
+        report_stats_at_exit(self.converter, self.encoder)
         self.docx_path = docx_path
         self.docx_name = docx_name
         self.docx_file_path = os.path.join(self.docx_path, self.docx_name)
@@ -152,178 +320,551 @@ class DocProcessor():
         self.name = self.docx_name.split(".")[0]
         self.pdf_name = self.name + ".pdf"
         self.json_name = self.name + ".json"
+        # In-memory mode: open pdfs per images path and colored tables
+        self.pages = {}
+        self.color_tables = {}
+        # Pages of the document, found tables and the maximum number of
+        # cells in them
+        self.image_names = []
+        self.table_names = []
+        self.gt_tables_dict = {}
+        self.num_of_cells = 0
+        # The found tables are written to table_folder, or kept as
+        # encoded images (or their Futures) until they are written to a
+        # shard
+        self.table_images = {}
+        self.table_folder = self.dirs.tables_path
+        if self.settings.output == "shards":
+            self.table_folder = self.table_images
+        # Final status (see ledger.STATUSES), the last done step and
+        # (stage, status, duration) of the steps
+        self.status = None
+        self.step = 0
+        self.stages = []
+        self.step_start = time.time()
+
+    def __getstate__(self):
+        # Passed between the processes of the pipeline without the
+        # renderers, the encoder and the open pdfs
+        self.resolve_table_images()
+        state = self.__dict__.copy()
+        del state["converter"]
+        del state["encoder"]
+        state["pages"] = {}
+        state["color_tables"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.converter = get_renderer_pool(
+            self.settings.converter, max_docs=self.settings.renderer_max_docs)
+        self.encoder = get_image_encoder(
+            self.settings.codec, self.settings.codec_level,
+            self.settings.encode_workers)
+        report_stats_at_exit(self.converter, self.encoder)
+
+    def resolve_table_images(self):
+        """
+        Wait for the encoding of the table images kept in memory
+        """
+        for table_name, data in self.table_images.items():
+            self.table_images[table_name] = encoded(data)
+
+    def stage_done(self, stage, status="done"):
+        """
+        Record the duration of the stage since the last recorded stage
+        """
+        now = time.time()
+        self.stages.append((stage, status, now - self.step_start))
+        self.step_start = now
+
+    def step_done(self, step):
+        """
+        Record the duration of the step
+        """
+        self.stage_done(STEPS[step - 1])
+        self.step = step
+        print("Step %i done" % step)
+
+    def step_failed(self):
+        """
+        Record the step after the last done step as failed
+        """
+        step = self.step + 1
+        if step == 8 and not self.debug:
+            step += 1
+        self.stage_done(STEPS[step - 1], self.status or "failed")
+
+    def variant_paths(self, variant):
+        """
+        The .docx, .pdf and images folders of a variant of the document:
+        fuchsia, aqua or color
+        """
+        if variant == "fuchsia":
+            return (self.dirs.fuchsia_docx_path, self.dirs.fuchsia_pdf_path,
+                    self.dirs.fuchsia_images_path)
+        if variant == "aqua":
+            return (self.dirs.aqua_docx_path, self.dirs.aqua_pdf_path,
+                    self.dirs.aqua_images_path)
+        return (self.dirs.color_docx_path, self.dirs.color_pdf_path,
+                self.dirs.color_images_path)
+
+    def unpack(self):
+        """
+        Read document.xml and styles.xml of the .docx into the XML variants
+        """
+        parts = read_docx_parts(self.docx_name, self.docx_file_path,
+                                [DOC_XML, STYLES_XML], self.dirs.output_path)
+        if parts is None:
+            self.status = "unpack_failed"
+            return None
+        return XMLVariants(parts.get(DOC_XML), parts.get(STYLES_XML))
+
+    def save_variant(self, variant, parts):
+        """
+        Save the .docx of the variant: the .docx with its XML parts replaced
+        """
+        file_docx_path, _, _ = self.variant_paths(variant)
+        repack_docx(self.docx_file_path, parts,
+                    os.path.join(file_docx_path, self.name + ".docx"))
+
+    def convert(self, variant):
+        """
+        Convert the .docx of the variant to .pdf
+        """
+        file_docx_path, file_pdf_path, _ = self.variant_paths(variant)
+        failure = self.converter.convert(
+            self.docx_name, file_docx_path, file_pdf_path,
+            self.dirs.output_path)
+        if failure is not None:
+            self.status = failure
+            return False
+        return True
+
+    def rasterize(self, variant):
+        """
+        Render the pages of the .pdf of the variant into its images folder,
+        or open the .pdf in the in-memory mode
+        """
+        _, file_pdf_path, file_images_path = self.variant_paths(variant)
+        if self.settings.pages_in_memory(variant):
+            done = self.open_pages(file_pdf_path, file_images_path)
+        else:
+            done = pdf_to_image(file_pdf_path, self.pdf_name,
+                                file_images_path, self.dirs.output_path,
+                                self.settings.render_workers,
+                                self.settings.dpi)
+        if not done:
+            self.status = "pdf_broken"
+        return done
+
+    def variant_to_images(self, variant, parts):
+        """
+        XML parts=>.docx=>.pdf=>.png
+        """
+        self.save_variant(variant, parts)
+        return self.convert(variant) and self.rasterize(variant)
+
+    def open_pages(self, file_pdf_path, file_images_path):
+        """
+        Keep the pdf open in place of the images in file_images_path,
+        the pages are rendered to arrays when they are needed
+        """
+        try:
+            self.pages[file_images_path] = Rasterizer(
+                os.path.join(file_pdf_path, self.pdf_name),
+                self.settings.dpi)
+        except BaseException:
+            append_to_file(self.dirs.output_path,
+                           'pdf_broken.csv', self.pdf_name)
+            return False
+        return True
+
+    def close_pages(self):
+        """
+        Close the pdfs kept open in the in-memory mode
+        """
+        for pages in self.pages.values():
+            pages.close()
+        self.pages = {}
+        self.color_tables = {}
+
+    def locate_tables(self, image_names):
+        """
+        Find the tables on the fuchsia pages of the document, by comparing
+        them with the aqua pages or by the fuchsia color alone
+
+        Returns:
+            a dictionary table_name: (x, y, w, h) of the found tables
+        """
+        by_color = self.settings.localization == "mask"
+        tables_loc = {}
+        if self.settings.localization == "vector":
+            fuchsia_pages = self.pages[self.dirs.fuchsia_images_path]
+            for i in range(fuchsia_pages.page_count):
+                image_name = self.name + "_%i.png" % i
+                image_names.append(image_name)
+                image_dict = locate_tables_by_vector(
+                    image_name,
+                    fuchsia_pages.color_extents(i, FUCHSIA),
+                    fuchsia_pages.page_size(i),
+                    lambda locs: fuchsia_pages.render_regions(i, locs),
+                    self.table_folder, encoder=self.encoder)
+                if image_dict is not None:
+                    tables_loc.update(image_dict)
+            return tables_loc
 
-    def unzipped_to_images(
-            self,
-            file_docx_path,
-            file_pdf_path,
-            file_images_path):
-        save_docx(self.name, self.dirs.unzipped_path, file_docx_path)
-        if not docx_to_pdf(self.docx_name, file_docx_path, file_pdf_path,
-                           self.dirs.output_path):
+        if self.settings.pages_in_memory("fuchsia"):
+            fuchsia_pages = self.pages[self.dirs.fuchsia_images_path]
+            page_count = fuchsia_pages.page_count
+            if not by_color:
+                aqua_pages = self.pages[self.dirs.aqua_images_path]
+                page_count = min(page_count, aqua_pages.page_count)
+            for i in range(page_count):
+                image_name = self.name + "_%i.png" % i
+                image_names.append(image_name)
+                if self.settings.coarse_detection():
+                    image_dict = self.locate_page_tables_coarse(
+                        image_name, i, by_color)
+                elif by_color:
+                    image_dict = locate_tables_by_color_image(
+                        image_name,
+                        fuchsia_pages.render(i),
+                        self.table_folder,
+                        encoder=self.encoder)
+                else:
+                    image_dict = compare_page_images(
+                        image_name,
+                        fuchsia_pages.render(i),
+                        aqua_pages.render(i),
+                        self.table_folder,
+                        self.settings.diff_engine,
+                        self.encoder)
+                if image_dict is not None:
+                    tables_loc.update(image_dict)
+            return tables_loc
+
+        all_image_names = os.listdir(self.dirs.fuchsia_images_path)
+        for image_name in all_image_names:
+            # Only images that correspond to the current document
+            if image_name.split("_")[0] == self.name:
+                image_names.append(image_name)
+                if by_color:
+                    image_dict = locate_tables_by_color(
+                        image_name,
+                        self.dirs.fuchsia_images_path,
+                        self.table_folder,
+                        self.encoder)
+                else:
+                    image_dict = pixelwisecomp(
+                        image_name,
+                        self.dirs.fuchsia_images_path,
+                        self.dirs.aqua_images_path,
+                        self.table_folder,
+                        self.settings.diff_engine,
+                        self.encoder)
+                if image_dict is not None:
+                    tables_loc.update(image_dict)
+        return tables_loc
+
+    def locate_page_tables_coarse(self, image_name, page, by_color):
+        """
+        Find the tables of a page on its renders at detection_dpi, then
+        again at dpi in the regions of the page where they are
+
+        Returns:
+            a dictionary table_name: (x, y, w, h) at dpi
+        """
+        detection_dpi = self.settings.detection_dpi
+        fuchsia_pages = self.pages[self.dirs.fuchsia_images_path]
+        render_aqua = None
+        img_aqua = None
+        if not by_color:
+            aqua_pages = self.pages[self.dirs.aqua_images_path]
+            img_aqua = aqua_pages.render(page, detection_dpi)
+            render_aqua = functools.partial(aqua_pages.render_regions, page)
+        regions = coarse_table_regions(
+            fuchsia_pages.render(page, detection_dpi), img_aqua)
+        return locate_tables_in_regions(
+            image_name, regions, self.settings.dpi / detection_dpi,
+            fuchsia_pages.page_size(page),
+            functools.partial(fuchsia_pages.render_regions, page),
+            render_aqua, self.table_folder, self.settings.diff_engine,
+            self.encoder)
+
+    def find_tables(self):
+        """
+        From comparing images_fuchsia vs. images_aqua (or from the fuchsia
+        color in images_fuchsia) get tables positions into
+        self.gt_tables_dict
+        """
+        tables_loc = self.locate_tables(self.image_names)
+        for table_name, loc in tables_loc.items():
+            self.gt_tables_dict[table_name] = Table(loc)
+        if self.debug and self.table_folder is self.table_images:
+            # The debug drawings are made on the table images in
+            # table_fuchsia
+            self.resolve_table_images()
+            for table_name, data in self.table_images.items():
+                with open(self.encoder.file_name(os.path.join(
+                        self.dirs.tables_path, table_name)), "wb") as f:
+                    f.write(data)
+        if not len(self.gt_tables_dict.keys()):
+            return self.no_tables()
+        return True
+
+    def make_colorful(self, xml_variants):
+        """
+        Change cells' background to different colors and count the maximum
+        number of cells in tables in this document
+
+        Returns:
+            the XML parts of the colorful variant, or None
+        """
+        parts, self.num_of_cells = xml_variants.colorful(
+            self.aqua, self.colors
+        )
+        if self.num_of_cells == 0:
+            self.no_tables()
+            return None
+        return parts
+
+    def no_tables(self):
+        append_to_file(self.dirs.output_path,
+                       'no_tables.csv', self.docx_name)
+        print("No tables in the document")
+        self.status = "no_tables"
+        return False
+
+    def prepare_variants(self):
+        """
+        Unpack the .docx and save all its variants at once: with fuchsia
+        and aqua table borders and with colorful cells, as the first
+        stage of the pipeline
+        """
+        xml_variants = self.unpack()
+        if xml_variants is None:
+            return False
+        self.save_variant("fuchsia", xml_variants.borders(self.fuchsia))
+        if self.settings.localization == "ssim":
+            self.save_variant("aqua", xml_variants.borders(self.aqua))
+        parts = self.make_colorful(xml_variants)
+        if parts is None:
             return False
-        pdf_to_image(file_pdf_path, self.pdf_name, file_images_path,
-                     self.dirs.output_path, self.dirs.temp_path)
+        self.save_variant("color", parts)
         return True
 
     def retrieve_tables_structure(self):
         """
         Crop tables from .docx files and build ground truth of cell postions,
         separating horizontal and vertical line positions
+
+        Returns:
+            the status of the document, one of ledger.STATUSES
         """
         try:
-            image_names = []
-            table_names = []
-
-            # Step 1: data_unzipped
-            if not unpack_zip(self.docx_name, self.docx_file_path,
-                              self.dirs.unzipped_path, self.dirs.output_path):
-                return
-            print("Step 1 done")
+            # Step 1: read document.xml and styles.xml
+            xml_variants = self.unpack()
+            if xml_variants is None:
+                return self.status
+            self.step_done(1)
 
             # Step 2: Draw table border with FUCHSIA color in document.xml
             # and styles.xml
-            xml_modifier = XMLModifier(self.name, self.dirs.unzipped_path)
-            xml_modifier.xml_draw_border(self.fuchsia)
-            # unzipped_folder=>.docx=>.pdf=>.png
-            if not self.unzipped_to_images(
-                    self.dirs.fuchsia_docx_path,
-                    self.dirs.fuchsia_pdf_path,
-                    self.dirs.fuchsia_images_path):
-                return
-            print("Step 2 done")
+            # XML parts=>.docx=>.pdf=>.png
+            if not self.variant_to_images(
+                    "fuchsia", xml_variants.borders(self.fuchsia)):
+                return self.status
+            self.step_done(2)
 
             # Step 3: Draw table border with AQUA color in document.xml
             # and styles.xml
-            xml_modifier.xml_draw_border(self.aqua)
-            # unzipped_folder=>.docx=>.pdf=>.png
-            if not self.unzipped_to_images(
-                    self.dirs.aqua_docx_path,
-                    self.dirs.fuchsia_pdf_path,
-                    self.dirs.aqua_images_path):
-                return
-            print("Step 3 done")
-
-            # Step 4: From comparing images_fuchsia vs. images_aqua get
-            # tables positions
-            all_image_names = os.listdir(self.dirs.fuchsia_images_path)
-            gt_tables_dict = {}
-            for image_name in all_image_names:
-                # Only images that correspond to the current document
-                if image_name.split("_")[0] == self.name:
-                    image_names.append(image_name)
-                    image_dict = pixelwisecomp(
-                        image_name,
-                        self.dirs.fuchsia_images_path,
-                        self.dirs.aqua_images_path,
-                        self.dirs.tables_path)
-                    if image_dict is not None:
-                        for table_name, loc in image_dict.items():
-                            gt_tables_dict[table_name] = Table(loc)
-
-            if not len(gt_tables_dict.keys()):
-                # No tables
-                append_to_file(self.dirs.output_path,
-                               'no_tables.csv', self.docx_name)
-                print("No tables in the document")
-                return
-
-            # Step 4: Change cells' background to different colors and count
-            # the maximum number of cells in tables in this document
-            num_of_cells = xml_modifier.cell_background_colorful(
-                self.aqua, self.colors.colors
-            )
-            if num_of_cells == 0:
-                append_to_file(self.dirs.output_path,
-                               'no_tables.csv', self.docx_name)
-                print("No tables in the document")
-                return
-            print("Step 4 done")
-
-            # Step 5: # unzipped_folder=>.docx=>.pdf=>.png
-            if not self.unzipped_to_images(
-                    self.dirs.color_docx_path,
-                    self.dirs.color_pdf_path,
-                    self.dirs.color_images_path):
-                return
-            print("Step 5 done")
-
-            # Step 6: Crop colored tables based on gt_tables_dict
-            table_names = list(gt_tables_dict.keys())
-            for table_name in table_names:
-                crop_tables(table_name,
-                            self.dirs.color_images_path,
-                            self.dirs.color_tables_path,
-                            gt_tables_dict)
-            print("Step 6 done")
+            # XML parts=>.docx=>.pdf=>.png,
+            # the aqua pages are only needed for the comparison
+            if self.settings.localization == "ssim" and \
+                    not self.variant_to_images(
+                        "aqua", xml_variants.borders(self.aqua)):
+                return self.status
+            self.step_done(3)
 
-            # Step 7: Find cell positions
-            for table_name in table_names:
-                color_table_path = os.path.join(
-                    self.dirs.color_tables_path, table_name)
-                cells_list = cell_borders_detection(
-                    color_table_path, self.colors.colors, num_of_cells)
-                gt_tables_dict[table_name].cells = cells_list
-            print("Step 7 done")
+            # Step 4: Get tables positions, change cells' background to
+            # different colors
+            if not self.find_tables():
+                return self.status
+            parts = self.make_colorful(xml_variants)
+            if parts is None:
+                return self.status
+            self.step_done(4)
 
-            # Step 8: Draw retrieved cells borders
-            if self.debug:
+            # Step 5: # XML parts=>.docx=>.pdf=>.png
+            if not self.variant_to_images("color", parts):
+                return self.status
+            self.step_done(5)
+
+            return self.build_ground_truth()
+
+        finally:
+            if self.status != "processed":
+                self.step_failed()
+            # Delete all intermediate files
+            self.clean_up(self.image_names, self.table_names)
+
+    def build_ground_truth(self):
+        """
+        Steps 6-11: crop the colored tables of self.gt_tables_dict, find
+        cells and separating lines, save the ground truth
+
+        Returns:
+            the status of the document
+        """
+        gt_tables_dict = self.gt_tables_dict
+        num_of_cells = self.num_of_cells
+
+        # Step 6: Crop colored tables based on gt_tables_dict
+        table_names = list(gt_tables_dict.keys())
+        self.table_names = table_names
+        # The vector cells are found in the paths of the pages instead
+        if self.settings.cells == "raster":
+            if self.settings.in_memory:
+                self.crop_color_tables(gt_tables_dict)
+            else:
                 for table_name in table_names:
-                    draw_cell_borders(
-                        table_name,
-                        gt_tables_dict[table_name].cells,
-                        self.dirs.tables_path,
-                        self.dirs.gt_cells_path)
-                print("Step 8 done")
-
-            # Step 9: Find separating horizontal and vertical lines
+                    crop_tables(table_name,
+                                self.dirs.color_images_path,
+                                self.dirs.color_tables_path,
+                                gt_tables_dict, self.encoder)
+        # The table images and the colored tables are read from here on
+        self.encoder.wait()
+        self.step_done(6)
+
+        # Step 7: Find cell positions
+        page_paths = {}
+        for table_name in table_names:
+            if self.settings.cells == "vector":
+                page = int(table_name.split("_")[1])
+                if page not in page_paths:
+                    page_paths[page] = self.pages[
+                        self.dirs.color_images_path].vector_paths(page)
+                cells_list = cell_borders_detection_vector(
+                    page_paths[page], gt_tables_dict[table_name].loc,
+                    self.colors, num_of_cells)
+            elif self.settings.in_memory:
+                cells_list = cell_borders_detection_image(
+                    self.color_tables[table_name], self.colors,
+                    num_of_cells)
+            else:
+                color_table_path = self.encoder.file_name(os.path.join(
+                    self.dirs.color_tables_path, table_name))
+                cells_list = cell_borders_detection(
+                    color_table_path, self.colors, num_of_cells)
+            gt_tables_dict[table_name].cells = cells_list
+        self.step_done(7)
+
+        # Step 8: Draw retrieved cells borders
+        if self.debug:
             for table_name in table_names:
-                horizontal_lines, vertical_lines = build_lines(
-                    gt_tables_dict[table_name].cells)
-                # At least two rows and at least two columns
-                if len(horizontal_lines) <= 2 or len(vertical_lines) <= 2:
-                    del gt_tables_dict[table_name]
-                    table_path = os.path.join(
-                        self.dirs.tables_path, table_name)
+                draw_cell_borders(
+                    table_name,
+                    gt_tables_dict[table_name].cells,
+                    self.dirs.tables_path,
+                    self.dirs.gt_cells_path,
+                    self.encoder)
+            self.step_done(8)
+
+        # Step 9: Find separating horizontal and vertical lines
+        for table_name in table_names:
+            horizontal_lines, vertical_lines = build_lines(
+                gt_tables_dict[table_name].cells)
+            # At least two rows and at least two columns
+            if len(horizontal_lines) <= 2 or len(vertical_lines) <= 2:
+                del gt_tables_dict[table_name]
+                self.table_images.pop(table_name, None)
+                table_path = self.encoder.file_name(os.path.join(
+                    self.dirs.tables_path, table_name))
+                if os.path.exists(table_path):
                     os.remove(table_path)
-                    continue
-                gt_tables_dict[table_name].horizontal_lines = horizontal_lines
-                gt_tables_dict[table_name].vertical_lines = vertical_lines
-            print("Step 9 done")
-
-            # Step 10: Draw horizontal and vertical lines
-            if self.debug:
-                for table_name in gt_tables_dict.keys():
-                    draw_lines(
-                        table_name,
-                        self.dirs.tables_path,
-                        self.dirs.gt_rows_cols_path,
-                        gt_tables_dict)
-            print("Step 10 done")
-
-            # Step 11: Save gt_tables_dict,
-            # write down to the list of processed files
+                continue
+            gt_tables_dict[table_name].horizontal_lines = horizontal_lines
+            gt_tables_dict[table_name].vertical_lines = vertical_lines
+        self.step_done(9)
+
+        # Step 10: Draw horizontal and vertical lines
+        if self.debug:
+            for table_name in gt_tables_dict.keys():
+                draw_lines(
+                    table_name,
+                    self.dirs.tables_path,
+                    self.dirs.gt_rows_cols_path,
+                    gt_tables_dict,
+                    self.encoder)
+        self.step_done(10)
+
+        # Step 11: Save gt_tables_dict,
+        # write down to the list of processed files
+        # A processed document has all its images written
+        self.encoder.wait()
+        if self.settings.output == "shards":
+            self.resolve_table_images()
+            get_shard_writer(
+                self.dirs.shards_path, self.settings.shard_size).write(
+                    self.name, gt_tables_dict, self.table_images,
+                    self.encoder.extension)
+        else:
             save_dict(self.dirs.gt_tables_dict_path,
                       self.json_name, gt_tables_dict)
-            append_to_file(self.dirs.output_path,
-                           'processed.csv', self.docx_name)
-            print("Step 11 done")
+        append_to_file(self.dirs.output_path,
+                       'processed.csv', self.docx_name)
+        self.status = "processed"
+        self.step_done(11)
+        return self.status
 
-        finally:
-            # Delete all intermediate files
-            self.clean_up(image_names, table_names)
+    def crop_color_tables(self, gt_tables_dict):
+        """
+        Render the colored tables of the colorful pages into
+        self.color_tables, only the regions of the tables are rendered
+        """
+        color_pages = self.pages[self.dirs.color_images_path]
+        page_tables = {}
+        for table_name in gt_tables_dict.keys():
+            page = int(table_name.split("_")[1])
+            page_tables.setdefault(page, []).append(table_name)
+        for page, page_table_names in page_tables.items():
+            table_images = color_pages.render_regions(
+                page, [gt_tables_dict[table_name].loc
+                       for table_name in page_table_names])
+            for table_name, table_image in zip(page_table_names,
+                                               table_images):
+                self.color_tables[table_name] = table_image
+
+    def clean_up_unknown(self):
+        """
+        Delete all intermediate files of the document, when the names of its
+        images and tables are not known, e.g. after its worker was killed
+        """
+        prefix = self.name + "_"
+        image_names = [
+            image_name for images_path in [
+                self.dirs.fuchsia_images_path,
+                self.dirs.aqua_images_path,
+                self.dirs.color_images_path]
+            for image_name in os.listdir(images_path)
+            if image_name.startswith(prefix)]
+        table_names = [
+            table_name
+            for table_name in os.listdir(self.dirs.color_tables_path)
+            if table_name.startswith(prefix)]
+        self.clean_up(image_names, table_names)
 
     def clean_up(self, image_names=[], table_names=[]):
         """
         Delete all intermediate files if they exists:
-        unzipped, docx, pdf, images, table_color
+        docx, pdf, images, table_color
         Except:
             table images, gt_tables_dict
         """
-        # Delete unzipped_folder
-        file_unzipped_path = os.path.join(self.dirs.unzipped_path, self.name)
-        if os.path.exists(file_unzipped_path):
-            shutil.rmtree(file_unzipped_path)
+        # The table_color files may still be written in the background
+        self.encoder.wait(errors=False)
+        self.close_pages()
 
         # Delete .docx
         folder_names = ["docx_aqua", "docx_color", "docx_fuchsia"]
@@ -352,13 +893,32 @@ class DocProcessor():
 
         # Delete in table_color
         for table_name in table_names:
-            file_path = os.path.join(
-                self.dirs.output_path, "table_color", table_name
-            )
+            file_path = self.encoder.file_name(os.path.join(
+                self.dirs.output_path, "table_color", table_name))
             if os.path.exists(file_path):
                 os.remove(file_path)
 
 
+def report_stats_at_exit(converter, encoder):
+    """
+    Print the stats of the renderer pool and of the image encoder of the
+    current process once, when it exits: they add up over its documents
+    """
+    if os.getpid() in _reporting:
+        return
+    _reporting.add(os.getpid())
+    # After the renderers are stopped and the pending images are encoded
+    util.Finalize(None, _print_stats, args=(converter, encoder),
+                  exitpriority=5)
+
+
+def _print_stats(converter, encoder):
+    if converter.conversions:
+        print("renderer: ", converter.stats())
+    if encoder.stats():
+        print("encoder: ", encoder.stats())
+
+
 class Table():
     def __init__(self, loc):
         self.loc = loc
@@ -367,35 +927,6 @@ class Table():
         self.vertical_lines = []
 
 
-def find_index(output_path, uuids, url_df):
-    """
-    Find the index from which continue to process documents after interuption
-    """
-    # All files that were processed incl. successfully and unsuccessfully
-    csvs = [f for f in os.listdir(output_path) if f[-3:] == "csv"]
-    files_done = []
-    for csv_doc in csvs:
-        csv_path = os.path.join(output_path, csv_doc)
-        csv_df = pd.read_csv(csv_path, header=None)
-        files = csv_df.iloc[:, 0].to_list()
-        files = [f.split(".")[0] for f in files]  # file names wo extension
-        files_done.extend(files)
-
-    # Indices that expected to still be processed
-    files_to_be_done = list(set(uuids) - set(files_done))
-    file_name = files_to_be_done[0]
-    index_min = url_df.index[url_df['uuid'] == file_name][0]
-    indices_to_be_done = []
-    for file_name in files_to_be_done[1:]:
-        index = url_df.index[url_df['uuid'] == file_name][0]
-        indices_to_be_done.append(index)
-        if index_min > index:
-            index_min = index
-    indices_to_be_done.sort()
-    
-    return indices_to_be_done, index_min
-
-
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--start_idx', default='0',
@@ -403,32 +934,148 @@ def main():
     parser.add_argument('--end_idx', default='0',
                         help="Choose end index(incl. end_idx)")
     parser.add_argument('--do', default='run',
-                        help="Process documents(run) or \
-                        find index to start (index)")
+                        help="Process the pending documents (run) or \
+                        report the status of the documents (index)")
     parser.add_argument('--multiproc', action='store_true',
                         help="Use multiprocessing: True/False")
     parser.add_argument('--debug', action='store_true',
                         help="Debug: True/False")
+    parser.add_argument('--converter', default='word',
+                        choices=['word', 'libreoffice'],
+                        help="Backend to convert .docx to .pdf")
+    parser.add_argument('--recycle_after', default='50',
+                        help="Restart a renderer after this number of "
+                        "conversions")
+    parser.add_argument('--render_workers', default='1',
+                        help="Number of processes rendering the pages of "
+                        "a pdf (without --multiproc)")
+    parser.add_argument('--in_memory', action='store_true',
+                        help="Pass page and table images between the steps "
+                        "in memory, only table_fuchsia and gt_tables_dict "
+                        "are written")
+    parser.add_argument('--localization', default='ssim',
+                        choices=['ssim', 'mask', 'vector'],
+                        help="Find tables by comparing the fuchsia and the "
+                        "aqua render (ssim), by the fuchsia borders in "
+                        "one render (mask) or in the fuchsia pdf (vector)")
+    parser.add_argument('--cells', default='raster',
+                        choices=['raster', 'vector'],
+                        help="Find cells by their colors in the colorful "
+                        "render (raster) or in the colorful pdf (vector)")
+    parser.add_argument('--dpi', default='300',
+                        help="Resolution of the page renders and of the "
+                        "table images")
+    parser.add_argument('--detection_dpi', default='0',
+                        help="Lower resolution of the renders the tables are "
+                        "first searched in, 0 to search at --dpi")
+    parser.add_argument('--diff', default='ssim', choices=['ssim', 'exact'],
+                        help="Compare the fuchsia and the aqua pages by "
+                        "SSIM over the whole page, or only on the tiles "
+                        "where their pixels differ (same tables, faster)")
+    parser.add_argument('--doc_timeout', default='0',
+                        help="Kill the worker after this number of seconds "
+                        "on one document, 0 for no limit (with --multiproc)")
+    parser.add_argument('--lease', default='24',
+                        help="Hours after which the documents claimed by "
+                        "another run are done again even if the run still "
+                        "looks alive (e.g. a run on another host), 0 for "
+                        "never")
+    parser.add_argument('--max_tasks', default='100',
+                        help="Replace a worker process after this number "
+                        "of documents, 0 for never (with --multiproc)")
+    parser.add_argument('--output', default='files',
+                        choices=['files', 'shards'],
+                        help="Write a .json per document and a .png per "
+                        "table (files) or append them to .jsonl and .tar "
+                        "shards (shards)")
+    parser.add_argument('--codec', default='png',
+                        choices=['png', 'webp', 'npy'],
+                        help="Codec of the table images and of the debug "
+                        "images: PNG, lossless WebP or raw .npy arrays")
+    parser.add_argument('--codec_level', default='-1',
+                        help="PNG compression level from 0 (fastest) to 9, "
+                        "-1 for the OpenCV default")
+    parser.add_argument('--encode_workers', default='2',
+                        help="Number of threads per process encoding and "
+                        "writing the images in the background, 0 to encode "
+                        "them in the processing thread")
+    parser.add_argument('--shard_size', default='1024',
+                        help="Size of a shard in MB (with --output shards)")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Run the XML variants, conversion, rasterization "
+                        "and detection in separate worker pools")
+    parser.add_argument('--prepare_workers', default='1',
+                        help="Processes modifying the XML of the .docx "
+                        "(with --pipeline)")
+    parser.add_argument('--convert_workers', default='1',
+                        help="Renderers converting .docx to .pdf "
+                        "(with --pipeline)")
+    parser.add_argument('--rasterize_workers', default='1',
+                        help="Processes rendering .pdf pages "
+                        "(with --pipeline)")
+    parser.add_argument('--detect_workers', default='0',
+                        help="Processes finding tables and cells, 0 for the "
+                        "number of CPUs (with --pipeline)")
 
     args = parser.parse_args()
     start_idx = int(args.start_idx)
     end_idx = int(args.end_idx)
 
-    # Build a list of file-names to be processed
+    # Add the documents of the range to the ledger
     url_df_path = "../url_docx/url_table_structure_recognition_uuid_final.csv"
     url_df = pd.read_csv(url_df_path)
     uuids = url_df.loc[start_idx:end_idx, "uuid"].to_list()
-    docx_names = [name + ".docx" for name in uuids]
     docx_path = "../data_raw/data_docx_recognition"
     output_path = "../output"
+    os.makedirs(output_path, exist_ok=True)
+    ledger = JobLedger(os.path.join(output_path, "jobs.sqlite"))
+    added = ledger.add_jobs(uuids, start_idx)
+    if added:
+        # Documents done before the ledger existed or before their range
+        # was added to it
+        ledger.import_csvs(output_path, added)
 
     if args.do == "run":
+        settings = Settings(converter=args.converter,
+                            renderer_max_docs=int(args.recycle_after),
+                            render_workers=int(args.render_workers),
+                            in_memory=args.in_memory,
+                            localization=args.localization,
+                            diff_engine=args.diff,
+                            doc_timeout=float(args.doc_timeout) or None,
+                            max_tasks=int(args.max_tasks) or None,
+                            pipeline=args.pipeline,
+                            prepare_workers=int(args.prepare_workers),
+                            convert_workers=int(args.convert_workers),
+                            rasterize_workers=int(args.rasterize_workers),
+                            detect_workers=int(args.detect_workers) or None,
+                            output=args.output,
+                            shard_size=int(args.shard_size) << 20,
+                            cells=args.cells,
+                            dpi=int(args.dpi),
+                            detection_dpi=int(args.detection_dpi) or None,
+                            codec=args.codec,
+                            codec_level=(int(args.codec_level)
+                                         if int(args.codec_level) >= 0
+                                         else None),
+                            encode_workers=int(args.encode_workers))
+        # Documents left running by an interrupted run are done again,
+        # the ones of a run still in progress are left to it
+        ledger.reset_running(start_idx, end_idx,
+                             float(args.lease) * 3600 or None)
+        docx_names = (uuid_ + ".docx" for uuid_ in
+                      ledger.claim_all(start_idx, end_idx))
         create_docs(docx_path, docx_names, output_path,
-                    args.multiproc, args.debug)
+                    args.multiproc, args.debug, settings, ledger)
     elif args.do == "index":
-        indices_to_be_done, idx_min = find_index(output_path, uuids, url_df)
-        print("idx_found: ", idx_min)
-        print("indices_to_be_done: ", indices_to_be_done)
+        report = ledger.report(start_idx, end_idx)
+        print("statuses: ", report["statuses"])
+        print("idx_found: ", report["first_pending"])
+        for stage, stats in report["stages"].items():
+            print("stage: ", stage, stats)
+        for uuid_, error in report["errors"]:
+            print("error: ", uuid_, error)
+    ledger.close()
 
 
 if __name__ == "__main__":
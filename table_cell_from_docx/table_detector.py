@@ -5,40 +5,382 @@ import imutils
 import numpy as np
 from operator import itemgetter
 
+FUCHSIA = (255, 0, 255)  # the same in RGB and BGR
+# Window of compare_ssim
+SSIM_WINDOW = 7
+# Side of the tiles in which exact_diff looks for changed pixels
+DIFF_TILE = 64
+
 
 def pixelwisecomp(image_name, images_fuchsia_path, images_aqua_path,
-                  table_folder):
+                  table_folder, diff_engine="ssim", encoder=None):
     """
     Given two images where only the outside table borders are of different
     color, detect the tables positions
     """
-    # Read a page image with potential tables of fuchsia color border,
-    # convert it to the gray scale image
+    # Read a page image with potential tables of fuchsia color border
     image_fuchsia_path = os.path.join(images_fuchsia_path, image_name)
     img_fuchsia = cv2.imread(image_fuchsia_path)
-    gray_fuchsia = cv2.cvtColor(img_fuchsia, cv2.COLOR_BGR2GRAY)
 
-    # Read a page image with potential tables of aqua color border,
-    # convert it to the gray scale image
+    # Read a page image with potential tables of aqua color border
     image_aqua_path = os.path.join(images_aqua_path, image_name)
     img_aqua = cv2.imread(image_aqua_path)
-    gray_aqua = cv2.cvtColor(img_aqua, cv2.COLOR_BGR2GRAY)
+    return compare_page_images(image_name, img_fuchsia, img_aqua,
+                               table_folder, diff_engine, encoder)
+
+
+def compare_page_images(image_name, img_fuchsia, img_aqua, table_folder,
+                        diff_engine="ssim", encoder=None):
+    """
+    Same as pixelwisecomp for page images given as BGR arrays
+
+    Args:
+        diff_engine: ssim - structural similarity of the gray scale images,
+                     exact - the same, computed only on the tiles where the
+                     gray scale images differ, see exact_diff
+    """
+    thresh = diff_mask(img_fuchsia, img_aqua, diff_engine)
+
+    # No table in the images
+    if thresh is None:
+        return
+    return tables_from_mask(image_name, img_fuchsia, thresh, table_folder,
+                            encoder)
+
+
+def diff_mask(img_fuchsia, img_aqua, diff_engine="ssim"):
+    """
+    Binary image of the difference between the page images by
+    diff_engine, None if the images are the same
+    """
+    if diff_engine == "exact":
+        return exact_diff(img_fuchsia, img_aqua)
+    return ssim_diff(img_fuchsia, img_aqua)
+
+
+def ssim_diff(img1, img2):
+    """
+    Binary image of the difference between img1 and img2 by SSIM
+
+    Returns:
+        None if the images are the same
+    """
+    # Convert the page images to the gray scale images
+    gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+    gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
 
     # Compare the above images: score 1 - the images are the same,
     # score 0  - the images do not have any same pixel
-    (score, diff) = compare_ssim(gray_fuchsia, gray_aqua, full=True)
+    (score, diff) = compare_ssim(gray1, gray2, full=True)
 
-    # No table in the images
+    # No difference in the images
     if score == 1:
         return
 
     # Convert the difference image to binary
     diff = (diff * 255).astype("uint8")
-    thresh = cv2.threshold(
+    diff[_same_windows(cv2.compare(gray1, gray2, cv2.CMP_NE))] = 255
+    return cv2.threshold(
         diff, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
 
+
+def exact_diff(img1, img2):
+    """
+    Binary image of the difference between img1 and img2, the same as
+    ssim_diff but faster
+
+    The SSIM of two windows with the same pixels is 1, so it is computed
+    only around the pixels that differ: on the runs of DIFF_TILE x
+    DIFF_TILE tiles where the gray scale images differ, widened by the
+    window of compare_ssim. The rest of the page counts as the same in
+    the Otsu threshold of the whole page, as in ssim_diff
+
+    Returns:
+        None if the images are the same
+    """
+    gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+    gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+    # No difference in the images
+    if cv2.norm(gray1, gray2, cv2.NORM_INF) == 0:
+        return
+
+    height, width = gray1.shape
+    changed = cv2.compare(gray1, gray2, cv2.CMP_NE)
+    rows = -(-height // DIFF_TILE)
+    columns = -(-width // DIFF_TILE)
+    tiles = cv2.copyMakeBorder(
+        changed, 0, rows * DIFF_TILE - height, 0,
+        columns * DIFF_TILE - width, cv2.BORDER_CONSTANT, value=0)
+    tiles = tiles.reshape(rows, DIFF_TILE, columns, DIFF_TILE).max(
+        axis=(1, 3)) > 0
+
+    # The pixels within SSIM_WINDOW // 2 of a changed pixel have an SSIM
+    # below 1, their windows are inside the crop without its borders
+    pad = SSIM_WINDOW // 2
+    margin = SSIM_WINDOW
+    diff = np.full((height, width), 255, dtype=np.uint8)
+    for row, start, end in _tile_runs(tiles):
+        y0 = max(row * DIFF_TILE - margin, 0)
+        y1 = min((row + 1) * DIFF_TILE + margin, height)
+        x0 = max(start * DIFF_TILE - margin, 0)
+        x1 = min(end * DIFF_TILE + margin, width)
+        region = compare_ssim(gray1[y0:y1, x0:x1], gray2[y0:y1, x0:x1],
+                              full=True)[1]
+        region = (region * 255).astype("uint8")
+        # Written back without the borders of the crop (but with the
+        # borders of the page)
+        top = 0 if y0 == 0 else margin - pad
+        left = 0 if x0 == 0 else margin - pad
+        bottom = y1 - y0 - (0 if y1 == height else margin - pad)
+        right = x1 - x0 - (0 if x1 == width else margin - pad)
+        diff[y0 + top:y0 + bottom, x0 + left:x0 + right] = \
+            region[top:bottom, left:right]
+    diff[_same_windows(changed)] = 255
+    return cv2.threshold(
+        diff, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+
+
+def _same_windows(changed):
+    """
+    Mask of the pixels without a changed pixel in their SSIM window: their
+    SSIM is 1, compare_ssim gives slightly less for some of them since its
+    filters round differently along the rows and the columns of the page
+    """
+    return cv2.dilate(
+        changed, np.ones((SSIM_WINDOW, SSIM_WINDOW), np.uint8)) == 0
+
+
+def _tile_runs(tiles):
+    """
+    The runs of consecutive True tiles of every row of tiles
+
+    Returns:
+        a list of (row, first column, last column + 1)
+    """
+    runs = []
+    for row in np.flatnonzero(tiles.any(axis=1)):
+        line = np.concatenate([[False], tiles[row], [False]]).astype(np.int8)
+        edges = np.flatnonzero(np.diff(line))
+        runs.extend((row, start, end)
+                    for start, end in zip(edges[::2], edges[1::2]))
+    return runs
+
+
+def _channel_diff(img1, img2, tolerance):
+    """
+    The maximum absolute difference over the channels, the differences up
+    to tolerance are set to 0
+    """
+    diff = cv2.absdiff(img1, img2)
+    b, g, r = cv2.split(diff)
+    diff = cv2.max(cv2.max(b, g), r)
+    return cv2.threshold(diff, tolerance, 255, cv2.THRESH_TOZERO)[1]
+
+
+def locate_tables_by_color(image_name, images_fuchsia_path, table_folder,
+                           encoder=None):
+    """
+    Detect the tables positions from one page image by the fuchsia color
+    of the outside table borders, without the image with aqua borders
+    """
+    image_fuchsia_path = os.path.join(images_fuchsia_path, image_name)
+    img_fuchsia = cv2.imread(image_fuchsia_path)
+    return locate_tables_by_color_image(image_name, img_fuchsia,
+                                        table_folder, encoder=encoder)
+
+
+def locate_tables_by_color_image(image_name, img_fuchsia, table_folder,
+                                 tolerance=100, encoder=None):
+    """
+    Same as locate_tables_by_color for a page image given as a BGR array
+
+    Args:
+        tolerance: the maximum deviation of a border pixel from FUCHSIA in
+                   every channel, the thin borders are anti-aliased and
+                   partly blended with the background
+    """
+    mask = fuchsia_mask(img_fuchsia, tolerance)
+
+    # No table in the image
+    if mask is None:
+        return
+    return tables_from_mask(image_name, img_fuchsia, mask, table_folder,
+                            encoder)
+
+
+def fuchsia_mask(img_fuchsia, tolerance=100):
+    """
+    Binary image of the fuchsia borders, None if there are none
+    """
+    lower_color = np.array(FUCHSIA) - tolerance
+    upper_color = np.array(FUCHSIA) + tolerance
+    mask = cv2.inRange(img_fuchsia, lower_color, upper_color)
+    if cv2.countNonZero(mask) == 0:
+        return
+
+    # compare_ssim marks the pixels in its window around a changed pixel,
+    # widen the border mask the same way to get the same rectangles
+    return cv2.dilate(mask, np.ones((SSIM_WINDOW, SSIM_WINDOW), np.uint8))
+
+
+def locate_tables_by_vector(image_name, extents, page_size,
+                            render_regions, table_folder, tolerance=100,
+                            encoder=None):
+    """
+    Detect the tables positions on a pdf page from the parts of its vector
+    paths drawn in fuchsia (see Rasterizer.color_extents), without
+    rendering the page or comparing renders
+
+    The rectangles are the ones locate_tables_by_color_image finds on the
+    render: a pixel belongs to the border if the border covers at least
+    1 - tolerance / 255 of it, and the border is widened by SSIM_WINDOW // 2
+
+    Args:
+        extents: a list of (x0, y0, x1, y1) in pixels of the render
+        page_size: (width, height) of the render
+        render_regions: a function rendering a list of (x, y, w, h) of the
+                        page into BGR arrays (see Rasterizer.render_regions),
+                        only called if the page has tables to crop
+    """
+    if not extents:
+        return
+    coverage = 1 - tolerance / 255
+    pad = SSIM_WINDOW // 2
+    width, height = page_size
+    # The first and the last pixel of every extent on the border mask
+    pixels = [(int(np.ceil(x0 - 1 + coverage)),
+               int(np.ceil(y0 - 1 + coverage)),
+               int(np.floor(x1 - coverage)),
+               int(np.floor(y1 - coverage)))
+              for (x0, y0, x1, y1) in extents]
+    pixels = [p for p in pixels if p[0] <= p[2] and p[1] <= p[3]]
+
+    rects = []
+    for group in touching_groups(pixels, pad):
+        x = max(min(p[0] for p in group) - pad, 0)
+        y = max(min(p[1] for p in group) - pad, 0)
+        w = min(max(p[2] for p in group) + pad, width - 1) - x + 1
+        h = min(max(p[3] for p in group) + pad, height - 1) - y + 1
+
+        # Skip if the table image is less than 10 in width or height
+        if w <= 10 or h <= 10:
+            continue
+
+        # Sort out small wrongly cropped images
+        if w < 500 and h < 500:
+            continue
+
+        # Fully covered pixels 5 pixels inside the rectangle: the table has
+        # nested tables or non-rectangular shape
+        nested = any(
+            int(np.ceil(x0)) < x + w - 5 and int(np.floor(x1)) > x + 5 and
+            int(np.ceil(y0)) < y + h - 5 and int(np.floor(y1)) > y + 5
+            for (x0, y0, x1, y1) in extents
+            if x <= x0 and x1 <= x + w and y <= y0 and y1 <= y + h)
+        rects.append(((x, y, w, h), nested))
+
+    # Sort tables by top y-coord
+    rects.sort(key=lambda rect: rect[0][1])
+    image_dict = {}
+    for idx, (loc, nested) in enumerate(rects):
+        if nested:
+            continue
+        table_name = image_name[:-4] + "_" + str(idx) + ".png"
+        image_dict[table_name] = loc
+    if table_folder is not None and image_dict:
+        # Only the tables are rendered
+        table_images = render_regions(list(image_dict.values()))
+        for table_name, table_image in zip(image_dict, table_images):
+            save_table_image(table_folder, table_name, table_image,
+                             encoder)
+    return image_dict
+
+
+def touching_groups(boxes, distance):
+    """
+    Group the boxes (x0, y0, x1, y1) that are connected by chains of
+    boxes less than distance apart
+    """
+    parent = list(range(len(boxes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, a in enumerate(boxes):
+        for j in range(i):
+            b = boxes[j]
+            if a[0] - distance <= b[2] and b[0] - distance <= a[2] and \
+                    a[1] - distance <= b[3] and b[1] - distance <= a[3]:
+                parent[find(i)] = find(j)
+    groups = {}
+    for i, box in enumerate(boxes):
+        groups.setdefault(find(i), []).append(box)
+    return list(groups.values())
+
+
+def save_table_image(table_folder, table_name, table_image, encoder=None):
+    """
+    Save the table image to table_folder, a dictionary table_folder gets
+    table_name: encoded .png instead
+
+    With an ImageEncoder the image is encoded by its codec in the
+    background: the file gets the extension of the codec, a dictionary
+    gets a Future of the encoded bytes
+    """
+    if encoder is not None:
+        if isinstance(table_folder, dict):
+            table_folder[table_name] = encoder.submit(table_image)
+        else:
+            encoder.write(os.path.join(table_folder, table_name),
+                          table_image)
+    elif isinstance(table_folder, dict):
+        table_folder[table_name] = cv2.imencode(
+            ".png", table_image)[1].tobytes()
+    else:
+        cv2.imwrite(os.path.join(table_folder, table_name), table_image)
+
+
+def tables_from_mask(image_name, img_fuchsia, mask, table_folder,
+                     encoder=None):
+    """
+    Given a binary mask of the outside table borders, crop the tables
+    from img_fuchsia and save them to table_folder (if given), a dictionary
+    table_folder gets table_name: encoded .png instead
+
+    Returns:
+        a dictionary table_name: (x, y, w, h)
+    """
+    image_dict = {}
+
+    # Iterate over all tables in the image
+    for idx, ((x, y, w, h), nested) in enumerate(
+            mask_rects(img_fuchsia, mask)):
+        if not nested:
+            table_name = image_name[:-4] + "_" + str(idx) + ".png"
+            # Without table_folder only the positions are returned
+            if table_folder is not None:
+                table_image = img_fuchsia[y:(y + h), x:(x + w)]
+                save_table_image(table_folder, table_name, table_image,
+                                 encoder)
+            image_dict[table_name] = (x, y, w, h)
+
+    return image_dict
+
+
+def mask_rects(img_fuchsia, mask):
+    """
+    The rectangles of the tables in a binary mask of the outside table
+    borders, sorted by top y-coord
+
+    Returns:
+        a list of ((x, y, w, h), nested), nested is True if the table has
+        nested tables or non-rectangular shape
+    """
     # Find countours
-    cnts = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cnts = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     cnts = imutils.grab_contours(cnts)
 
     rects = []
@@ -58,25 +400,114 @@ def pixelwisecomp(image_name, images_fuchsia_path, images_aqua_path,
 
     # Sort tables by top y-coord
     rects.sort(key=itemgetter(1))
-    image_dict = {}
 
-    color_rgb = (255, 0, 255)  # FUCHSIA
-    # Iterate over all tables in the image
-    for idx, (x, y, w, h) in enumerate(rects):
-        table_image = img_fuchsia[y:(y + h), x:(x + w)]
+    # Remove 5 pixels from every side which usually contains table border,
+    # if the rest has FUCHSIA inside: it means the table has nested tables
+    # or non-rectangular shape
+    return [((x, y, w, h), detect_color_presence(
+        img_fuchsia[(y + 5):(y + h - 5), (x + 5):(x + w - 5)], FUCHSIA))
+        for (x, y, w, h) in rects]
 
-        # Remove 5 pixels from every side which usually contains table border
-        table_wo_borders = img_fuchsia[(
-            y + 5):(y + h - 5), (x + 5):(x + w - 5)]
 
-        # If the table_wo_borders has FUCHSIA inside: it means
-        # the table has nested tables or non-rectangular shape
-        if not detect_color_presence(table_wo_borders, color_rgb):
-            table_name = image_name[:-4] + "_" + str(idx) + ".png"
-            table_path = os.path.join(table_folder, table_name)
-            cv2.imwrite(table_path, table_image)
-            image_dict[table_name] = (x, y, w, h)
+def coarse_table_regions(img_fuchsia, img_aqua=None):
+    """
+    Find the regions of a low resolution page render that can have tables:
+    where the fuchsia and the aqua render differ or, without img_aqua,
+    where the fuchsia render has fuchsia-like pixels
+
+    The thin borders are blended with the background at a low resolution,
+    so any difference and any pixel more red and blue than green counts
+
+    Returns:
+        a list of (x0, y0, x1, y1), both inclusive
+    """
+    if img_aqua is not None:
+        mask = _channel_diff(img_fuchsia, img_aqua, 0)
+    else:
+        b, g, r = cv2.split(img_fuchsia)
+        mask = cv2.min(cv2.subtract(b, g), cv2.subtract(r, g))
+    mask = cv2.threshold(mask, 0, 255, cv2.THRESH_BINARY)[1]
+    if cv2.countNonZero(mask) == 0:
+        return []
+    # Join the dashes of a border
+    mask = cv2.dilate(mask, np.ones((3, 3), np.uint8))
+    number, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+    return [(int(x), int(y), int(x + w - 1), int(y + h - 1))
+            for (x, y, w, h, _) in stats[1:number]]
 
+
+def locate_tables_in_regions(image_name, regions, scale, page_size,
+                             render_fuchsia, render_aqua, table_folder,
+                             diff_engine="ssim", encoder=None):
+    """
+    Detect the tables positions on a page in the regions found on a low
+    resolution render (see coarse_table_regions): only the regions, with
+    a margin, are rendered at the full resolution and compared
+
+    The rectangles are the ones found on the full page: the mask of the
+    fuchsia borders and the exact difference only depend on the pixels
+    near a table, SSIM thresholds the difference of a region by its own
+    Otsu threshold and can be off by a few pixels
+
+    Args:
+        regions: a list of (x0, y0, x1, y1) in pixels of the low
+                 resolution render, both inclusive
+        scale: the full resolution over the low resolution
+        page_size: (width, height) of the full resolution render
+        render_fuchsia: a function rendering a list of (x, y, w, h) of the
+                        fuchsia page into BGR arrays, see
+                        Rasterizer.render_regions
+        render_aqua: the same for the aqua page, None to find the tables
+                     by the fuchsia color alone
+    Returns:
+        a dictionary table_name: (x, y, w, h)
+    """
+    if not regions:
+        return
+    width, height = page_size
+    # The error of the scaled regions, the window of the comparison and
+    # the pixels of the nested tables check
+    margin = int(np.ceil(scale)) + 2 * SSIM_WINDOW + 5
+    boxes = [(int(np.floor(x0 * scale)), int(np.floor(y0 * scale)),
+              int(np.ceil((x1 + 1) * scale)) - 1,
+              int(np.ceil((y1 + 1) * scale)) - 1)
+             for (x0, y0, x1, y1) in regions]
+    locs = []
+    for group in touching_groups(boxes, 2 * margin):
+        x = max(min(b[0] for b in group) - margin, 0)
+        y = max(min(b[1] for b in group) - margin, 0)
+        x1 = min(max(b[2] for b in group) + margin, width - 1)
+        y1 = min(max(b[3] for b in group) + margin, height - 1)
+        locs.append((x, y, x1 - x + 1, y1 - y + 1))
+
+    fuchsia_images = render_fuchsia(locs)
+    aqua_images = [None] * len(locs)
+    if render_aqua is not None:
+        aqua_images = render_aqua(locs)
+    rects = []
+    crops = zip(locs, fuchsia_images, aqua_images)
+    for (x, y, _, _), img_fuchsia, img_aqua in crops:
+        if img_aqua is None:
+            mask = fuchsia_mask(img_fuchsia)
+        else:
+            mask = diff_mask(img_fuchsia, img_aqua, diff_engine)
+        if mask is None:
+            continue
+        for (rx, ry, w, h), nested in mask_rects(img_fuchsia, mask):
+            rects.append(((x + rx, y + ry, w, h), nested,
+                          img_fuchsia[ry:(ry + h), rx:(rx + w)]))
+
+    # Sort tables by top y-coord, as on the full page
+    rects.sort(key=lambda rect: rect[0][1])
+    image_dict = {}
+    for idx, (loc, nested, table_image) in enumerate(rects):
+        if nested:
+            continue
+        table_name = image_name[:-4] + "_" + str(idx) + ".png"
+        if table_folder is not None:
+            save_table_image(table_folder, table_name, table_image,
+                             encoder)
+        image_dict[table_name] = loc
     return image_dict
 
 
@@ -98,15 +529,29 @@ def detect_color_presence(img, color_rgb):
     return False
 
 
-def crop_tables(table_name, images_path, tables_path, gt_tables_dict):
+def crop_tables(table_name, images_path, tables_path, gt_tables_dict,
+                encoder=None):
     """
     Given tables positions in gt_tables_dict crop the tables from page images
+
+    With an ImageEncoder the table image is written by it in the
+    background
     """
     image_name = table_name.split(
         "_")[0] + "_" + table_name.split("_")[1] + ".png"
     image_path = os.path.join(images_path, image_name)
     image = cv2.imread(image_path)
-    (x, y, w, h) = gt_tables_dict[table_name].loc
-    table_image = image[y:y + h, x:x + w]
+    table_image = crop_table_image(image, gt_tables_dict[table_name].loc)
     tables_path = os.path.join(tables_path, table_name)
-    cv2.imwrite(tables_path, table_image)
+    if encoder is not None:
+        encoder.write(tables_path, table_image)
+    else:
+        cv2.imwrite(tables_path, table_image)
+
+
+def crop_table_image(image, loc):
+    """
+    Crop the table at loc=(x, y, w, h) from the page image array
+    """
+    (x, y, w, h) = loc
+    return image[y:y + h, x:x + w]
@@ -1,206 +1,238 @@
 from lxml import etree
-import os
 
+# The parts of a .docx changed for the variants
+DOC_XML = "word/document.xml"
+STYLES_XML = "word/styles.xml"
 
-class XMLModifier():
+# Compiled XPath queries per WordprocessingML namespace, see _xpaths
+_XPATHS = {}
 
-    def __init__(self, folder_name, unzipped_path):
-        self.doc_xml_path = os.path.join(
-            unzipped_path, folder_name, "word", "document.xml"
-        )
-        self.styles_xml_path = os.path.join(
-            unzipped_path, folder_name, "word", "styles.xml"
-        )
-        self.doc_tree = None
-        self.styles_tree = None
-        try:
-            # Some files made from .doc are not readable
-            self.doc_tree = etree.parse(self.doc_xml_path)
-        except BaseException:
-            pass
-        try:
-            self.styles_tree = etree.parse(self.styles_xml_path)
-        except BaseException:
-            pass
 
-    def xml_draw_border(self, color_code):
+def _xpaths(w):
+    """
+    XPath queries compiled once for the namespace w of the prefix w
+    """
+    if w not in _XPATHS:
+        namespaces = {"w": w}
+        _XPATHS[w] = {
+            name: etree.XPath(path, namespaces=namespaces)
+            for name, path in [
+                ("tables", "//w:tbl"),
+                ("rows", ".//w:tr"),
+                ("cells", ".//w:tc"),
+                ("grid_cols", ".//w:gridCol"),
+                ("styles", "//w:style"),
+                ("paragraphs", ".//w:p"),
+                ("runs", ".//w:r"),
+            ]}
+    return _XPATHS[w]
+
+
+class XMLVariants():
+    """
+    Build the variants of document.xml and styles.xml: with fuchsia or
+    aqua table borders and with colorful cells
+
+    Both files are parsed and the tables are checked once. The borders of
+    the eligible tables are built once as well, a variant only sets their
+    color. The variants are returned as serialized parts, the colorful
+    variant is built on the tree with the last border color
+    """
+
+    def __init__(self, doc_xml, styles_xml):
         """
-        Draw table borders with the given color in document.xml and styles.xml
-        Note: if the border is defined in styles.xml, it overrids the border
-        defined in document.xml
+        Args:
+            doc_xml: the content of document.xml or None
+            styles_xml: the content of styles.xml or None
         """
-        self.color = color_code
-
+        self.doc_tree = _parse(doc_xml)
+        self.styles_tree = _parse(styles_xml)
+        # Border elements whose color is set per variant
+        self.border_sides = []
+        # Eligible tables of document.xml: a list of rows of cells
+        self.tables = []
         if self.doc_tree is not None:
-            self.root = self.doc_tree.getroot()
-            self.nsmap = self.root.nsmap
+            self._use_namespace(self.doc_tree)
+            self.tables = self._eligible_tables()
             self._doc_table_border()
-            self.doc_tree.write(self.doc_xml_path, pretty_print=True)
-
         if self.styles_tree is not None:
-            self.root = self.styles_tree.getroot()
-            self.nsmap = self.root.nsmap
+            self._use_namespace(self.styles_tree)
             self._styles_table_border()
-            self.styles_tree.write(self.styles_xml_path, pretty_print=True)
+        self.colorful_done = False
 
-    def cell_background_colorful(self, color_code, colors):
+    def _use_namespace(self, tree):
+        self.nsmap = tree.getroot().nsmap
+        self.w = "{" + self.nsmap['w'] + "}"
+        self.xpath = _xpaths(self.nsmap['w'])
+
+    def borders(self, color_code):
         """
-        1. Change background color of every cell in document.xml in the order
-        of colors
-        2. Delete all cell overridings in styles.xml
+        The variant with table borders of the given color in document.xml
+        and styles.xml
+        Note: if the border is defined in styles.xml, it overrids the border
+        defined in document.xml
+
         Returns:
-            the maximum number of cells among the tables of this document
+            a dictionary part name: content of the parsed parts
         """
-        self.color = color_code
-        self.colors = colors
+        self._set_border_color(color_code)
+        return self._serialize()
 
-        # Change background color of every cell in document.xml
-        self.root = self.doc_tree.getroot()
-        self.nsmap = self.root.nsmap
-        num_of_cells = self._cell_background_colorful_doc()
-        # Save the changed document.xml back to the same place
-        self.doc_tree.write(self.doc_xml_path, pretty_print=True)
+    def colorful(self, color_code, colors):
+        """
+        The variant with table borders of the given color and
+        1. the background of every cell in document.xml in the order of
+        colors
+        2. all cell overridings in styles.xml deleted
+        The tree is changed: no borders variant can follow
 
-        # Delete all cell overridings in styles.xml
-        self.root = self.styles_tree.getroot()
-        self.nsmap = self.root.nsmap
+        Returns:
+            a dictionary part name: content and the maximum number of cells
+            among the tables of this document
+        """
+        if self.doc_tree is None or self.styles_tree is None:
+            raise ValueError("document.xml or styles.xml is not readable")
+        if self.colorful_done:
+            raise ValueError("The colorful variant is already built")
+        self.colorful_done = True
+        self._set_border_color(color_code)
+        self._use_namespace(self.doc_tree)
+        num_of_cells = self._cell_background_colorful_doc(colors)
+        self._use_namespace(self.styles_tree)
         self._delete_cell_background_styles()
-        # Save the changed styles.xml back to the same place
-        self.styles_tree.write(self.styles_xml_path, pretty_print=True)
-        return num_of_cells
+        return self._serialize(), num_of_cells
+
+    def _serialize(self):
+        """
+        The parsed parts as bytes, without pretty printing
+        """
+        parts = {}
+        for part_name, tree in [(DOC_XML, self.doc_tree),
+                                (STYLES_XML, self.styles_tree)]:
+            if tree is not None:
+                parts[part_name] = etree.tostring(
+                    tree, xml_declaration=True, encoding="UTF-8",
+                    standalone=tree.docinfo.standalone)
+        return parts
+
+    def _eligible_tables(self):
+        """
+        The tables with more than one cell, without nested tables and of
+        rectangular shape, as lists of rows of cells
+        """
+        tables = []
+        for table in self.xpath["tables"](self.doc_tree):
+            rows = [(row, self.xpath["cells"](row))
+                    for row in self.xpath["rows"](table)]
+            if self._table_checks(table, rows):
+                tables.append((table, rows))
+        return tables
 
     def _doc_table_border(self):
         """
-        Draw outside border of tables with the given color in 2 steps
+        Build the outside border of the eligible tables in 2 steps
         1. do it in tblBorders
-        2. iterate over edge cells and draw their edge borders, because
+        2. iterate over edge cells and build their edge borders, because
         cells border overrids tblBorders
         """
-        # Find all tables
-        tables = self.doc_tree.findall('.//w:tbl', self.nsmap)
-        for table in tables:
-            # Check if the table has more than one cell, does not have nested
-            # tables and it is rectangular
-            if not self._table_checks(table):
-                continue
-
+        for table, rows in self.tables:
             # If there is no tblBorders add it
             properties = table.find('.//w:tblPr', self.nsmap)
             table_borders = properties.find('.//w:tblBorders', self.nsmap)
             if table_borders is None:
                 table_borders = etree.SubElement(
-                    properties, "{" + self.nsmap['w'] + "}" + "tblBorders"
-                )
-            # Change the color of the outside borders of the tables to the
-            # given color
-            self._color_tblBorders(table_borders)
+                    properties, self.w + "tblBorders")
+            self._build_tblBorders(table_borders)
 
             # If table_spacing non-zero do not do cell borders
             table_spacing = properties.find('.//w:tblCellSpacing', self.nsmap)
             if table_spacing is not None:
-                table_space_w = table_spacing.get(
-                    "{" + self.nsmap['w'] + "}" + "w"
-                )
+                table_space_w = table_spacing.get(self.w + "w")
                 # The size of table_spacing bigger than 0
                 if int(table_space_w) > 0:
                     continue
 
             # If there is a cell border it would overwrite table border =>
-            # Draw edge cell borders
-            nrows = table.findall('.//w:tr', self.nsmap)
-            self._color_edge_cells(nrows)
+            # Build edge cell borders
+            self._build_edge_cells(rows)
 
-    def _color_edge_cells(self, nrows):
+    def _build_edge_cells(self, rows):
         """
-        Color the sides of edge cells that overlaps with the table border
+        Build the sides of edge cells that overlaps with the table border
         """
         # Iteratate over rows and then cells inside the rows
-        for idx_row, row in enumerate(nrows):
-            ncells = row.findall('.//w:tc', self.nsmap)
+        for idx_row, (_, ncells) in enumerate(rows):
             for idx_cell, cell in enumerate(ncells):
                 cell_props = cell.find('.//w:tcPr', self.nsmap)
-                cell_borders = cell_props.find(
-                    './/w:tcBorders', self.nsmap
-                )
+                cell_borders = cell_props.find('.//w:tcBorders', self.nsmap)
                 if cell_borders is None:
                     cell_borders = etree.SubElement(
-                        cell_props, "{" + self.nsmap['w'] + "}" + "tcBorders")
+                        cell_props, self.w + "tcBorders")
 
+                # Left and right cells of every row
+                sides = []
+                if idx_cell == 0:
+                    sides.append("left")
+                if idx_cell == len(ncells) - 1:
+                    sides.append("right")
                 # First row in the table
                 if idx_row == 0:
-                    self._set_border(cell_borders, "top")
-                    # top left cell
-                    if idx_cell == 0:
-                        self._set_border(cell_borders, "left")
-                    # top right cell
-                    if idx_cell == len(ncells) - 1:
-                        self._set_border(cell_borders, "right")
-
+                    for side in ["top"] + sides:
+                        self._build_border(cell_borders, side)
                 # Last row in the table
-                if idx_row == len(nrows) - 1:
-                    self._set_border(cell_borders, "bottom")
-                    # bottom left cell
-                    if idx_cell == 0:
-                        self._set_border(cell_borders, "left")
-                    # bottom right cell
-                    if idx_cell == len(ncells) - 1:
-                        self._set_border(cell_borders, "right")
-
+                if idx_row == len(rows) - 1:
+                    for side in ["bottom"] + sides:
+                        self._build_border(cell_borders, side)
                 # Neither the first, nor the last row
-                if idx_row != 0 and idx_row != len(nrows) - 1:
-                    if idx_cell == 0:
-                        self._set_border(cell_borders, "left")
-                    if idx_cell == len(ncells) - 1:
-                        self._set_border(cell_borders, "right")
+                if idx_row != 0 and idx_row != len(rows) - 1:
+                    for side in sides:
+                        self._build_border(cell_borders, side)
 
-    def _set_border(self, cell_borders, side):
+    def _build_border(self, cell_borders, side):
         """
-        Given a cell draw build the given border with the given color
+        Build the given side of the cell borders
         """
         cell_side = cell_borders.find('.//w:' + side, self.nsmap)
         if cell_side is None:
-            cell_side = etree.SubElement(
-                cell_borders, "{" + self.nsmap['w'] + "}" + side)
+            cell_side = etree.SubElement(cell_borders, self.w + side)
         self._border_params(cell_side)
         try:
-            del cell_side.attrib["{" + self.nsmap['w'] + "}" + "themeColor"]
+            del cell_side.attrib[self.w + "themeColor"]
         except BaseException:
             pass
 
-    def _color_tblBorders(self, table_borders):
+    def _build_tblBorders(self, table_borders):
         """
-        Change the color of the outside borders of the tables to the
-        given color
+        Build the outside borders of the table
         """
         for side_name in ["top", "bottom", "left", "right"]:
             side = table_borders.find('.//w:' + side_name, self.nsmap)
             if side is None:
-                side = etree.SubElement(
-                    table_borders, "{" + self.nsmap['w'] + "}" + side_name
-                )
+                side = etree.SubElement(table_borders, self.w + side_name)
             self._border_params(side)
 
     def _border_params(self, side):
         """
-        Set the border parameters
+        Set the border parameters, the color is set per variant
         """
-        side.set("{" + self.nsmap['w'] + "}" + "val", 'single')
-        side.set("{" + self.nsmap['w'] + "}" + "sz", '3')
-        side.set("{" + self.nsmap['w'] + "}" + "space", '0')
-        side.set("{" + self.nsmap['w'] + "}" + "color", self.color)
+        side.set(self.w + "val", 'single')
+        side.set(self.w + "sz", '3')
+        side.set(self.w + "space", '0')
+        self.border_sides.append((side, self.w + "color"))
 
-    def _table_rectangular(self, table):
+    def _set_border_color(self, color_code):
+        for side, color_attribute in self.border_sides:
+            side.set(color_attribute, color_code)
+
+    def _table_rectangular(self, table, rows):
         """
         Check if the table is rectangular: compare the number of columns in
         gridCol with the sum of cells in the row, taking into account the
         number of cells covered by the spanning cells
         """
-        nrows = table.findall('.//w:tr', self.nsmap)
         tblGrid = table.find('.//w:tblGrid', self.nsmap)
-        ncols = tblGrid.findall('.//w:gridCol', self.nsmap)
-        number_of_cols = len(ncols)
-        for row in nrows:
-            ncells = row.findall('.//w:tc', self.nsmap)
+        number_of_cols = len(self.xpath["grid_cols"](tblGrid))
+        for _, ncells in rows:
             if len(ncells) == number_of_cols:
                 continue
             # Number of cells in the row is not equal to the number of columns
@@ -210,46 +242,40 @@ class XMLModifier():
                 cell_grid_span = cell_props.find('.//w:gridSpan', self.nsmap)
                 val = 1
                 if cell_grid_span is not None:
-                    val = cell_grid_span.get(
-                        "{" + self.nsmap['w'] + "}" + "val"
-                    )
+                    val = cell_grid_span.get(self.w + "val")
                 number_of_cells += int(val)
             if number_of_cells < number_of_cols:
                 return False
         return True
 
-    def _one_cell_check(self, table, ):
+    def _one_cell_check(self, rows):
         """
         Check if the table consists of only one cell
         """
-        nrows = table.findall('.//w:tr', self.nsmap)
-        if len(nrows) > 1:
+        if len(rows) > 1:
             return True
-        ncells = nrows[0].findall('.//w:tc', self.nsmap)
-        if len(ncells) == 1:
+        if len(rows[0][1]) == 1:
             return False
         return True
 
-    def _table_checks(self, table):
+    def _table_checks(self, table, rows):
         # If a table consists of only one cell => not a table
-        if not self._one_cell_check(table):
+        if not self._one_cell_check(rows):
             return False
         # If a table has other tables inside => skip this table
-        if table.find('.//w:tbl', self.nsmap):
+        if table.find('.//w:tbl', self.nsmap) is not None:
             return False
         # If a table does not have rectangular shape => skip this table
-        if not self._table_rectangular(table):
+        if not self._table_rectangular(table, rows):
             return False
         return True
 
     def _styles_table_border(self):
         """
-        Change background color in styles.xml
+        Build the table borders in styles.xml
         """
-        # Find all styles
-        styles = self.styles_tree.findall('.//w:style', self.nsmap)
-        for style in styles:
-            style_type = style.get("{" + self.nsmap['w'] + "}" + "type")
+        for style in self.xpath["styles"](self.styles_tree):
+            style_type = style.get(self.w + "type")
             if style_type != "table":
                 continue
             properties = style.find('.//w:tblPr', self.nsmap)
@@ -258,47 +284,32 @@ class XMLModifier():
             # Change border color of the table
             table_borders = properties.find('.//w:tblBorders', self.nsmap)
             if table_borders is not None:
-                self._color_tblBorders(table_borders)
+                self._build_tblBorders(table_borders)
 
-    def _cell_background_colorful_doc(self):
+    def _cell_background_colorful_doc(self, colors):
         """
-        Change background color of every cell in document.xml in the order of
-        self.colors
+        Change background color of every cell of the eligible tables in
+        document.xml in the order of colors
         """
-        tables = self.doc_tree.findall('.//w:tbl', self.nsmap)
         max_num_cells = 0
-        for table in tables:
+        for _, rows in self.tables:
             k = 0  # Count the number of cells
-            # Check if table has more than one cell, does not have nested
-            # tables and it is rectangular
-            if not self._table_checks(table):
-                continue
-            # Change background color of cells
-            nrows = table.findall('.//w:tr', self.nsmap)
-            for row in nrows:
-                ncells = row.findall('.//w:tc', self.nsmap)
+            for _, ncells in rows:
                 for cell in ncells:
                     cell_props = cell.find('.//w:tcPr', self.nsmap)
                     if cell_props is None:
-                        cell_props = etree.SubElement(
-                            cell, "{" + self.nsmap['w'] + "}" + "shd")
+                        cell_props = etree.SubElement(cell, self.w + "shd")
                     cell_background = cell_props.find('.//w:shd', self.nsmap)
                     if cell_background is None:
                         cell_background = etree.SubElement(
-                            cell_props, "{" + self.nsmap['w'] + "}" + "shd")
-                    cell_background.set(
-                        "{" + self.nsmap['w'] + "}" + "fill",
-                        self.colors[k][0])
-                    cell_background.set(
-                        "{" + self.nsmap['w'] + "}" + "color",
-                        self.colors[k][0])
-                    cell_background.set(
-                        "{" + self.nsmap['w'] + "}" + "val", "clear")
+                            cell_props, self.w + "shd")
+                    cell_background.set(self.w + "fill", colors.hex(k))
+                    cell_background.set(self.w + "color", colors.hex(k))
+                    cell_background.set(self.w + "val", "clear")
                     k += 1
                     # Delete if there is any color in "themeFill"
                     try:
-                        del cell_background.attrib[
-                            "{" + self.nsmap['w'] + "}" + "themeFill"]
+                        del cell_background.attrib[self.w + "themeFill"]
                     except BaseException:
                         pass
                     # Remove the paragraph background if any in document.xml
@@ -312,17 +323,17 @@ class XMLModifier():
         The paragraph background overrrids the cell background
         Remove the paragraph background if any in document.xml
         """
-        for par in cell.findall('.//w:p', self.nsmap):
+        for par in self.xpath["paragraphs"](cell):
             par_props = par.find('.//w:pPr', self.nsmap)
             if par_props is None:
                 continue
             par_bkgd = par_props.find('.//w:shd', self.nsmap)
             try:
-                del par_bkgd.attrib["{" + self.nsmap['w'] + "}" + "fill"]
+                del par_bkgd.attrib[self.w + "fill"]
             except BaseException:
                 pass
             try:
-                del par_bkgd.attrib["{" + self.nsmap['w'] + "}" + "themeFill"]
+                del par_bkgd.attrib[self.w + "themeFill"]
             except BaseException:
                 pass
             self._remove_char_background(par)
@@ -332,7 +343,7 @@ class XMLModifier():
         Character background overrids the paragraph background
         Remove character background if any in document.xml
         """
-        for par_row in paragraph.findall('.//w:r', self.nsmap):
+        for par_row in self.xpath["runs"](paragraph):
             par_row_prop = par_row.find('.//w:rPr', self.nsmap)
             if par_row_prop is None:
                 continue
@@ -347,9 +358,8 @@ class XMLModifier():
         """
         Remove the paragraph background if any in styles.xml
         """
-        styles = self.styles_tree.findall('.//w:style', self.nsmap)
-        for style in styles:
-            style_type = style.get("{" + self.nsmap['w'] + "}" + "type")
+        for style in self.xpath["styles"](self.styles_tree):
+            style_type = style.get(self.w + "type")
             if style_type != "paragraph":
                 continue
             properties = style.find('.//w:pPr', self.nsmap)
@@ -357,3 +367,17 @@ class XMLModifier():
                 shd = properties.find('.//w:shd', self.nsmap)
                 if shd is not None:
                     properties.remove(shd)
+
+
+def _parse(content):
+    """
+    Parse the content of an XML part, None if it is missing or not readable
+    (some files made from .doc are not readable)
+    """
+    if content is None:
+        return None
+    try:
+        return etree.ElementTree(etree.fromstring(
+            content, etree.XMLParser(huge_tree=True)))
+    except BaseException:
+        return None
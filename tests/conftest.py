@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The modules of table_cell_from_docx import each other and utils by bare
+# name, as when the scripts are run
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "table_cell_from_docx"))
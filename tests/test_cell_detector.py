@@ -0,0 +1,56 @@
+import numpy as np
+from cell_detector import _drop_nested_cells, _box_in_box_xywh
+
+
+def drop_nested_cells_pairwise(cells_list):
+    """
+    Compare every cell with every other cell
+    """
+    return [cell1 for cell1 in cells_list
+            if not any(_box_in_box_xywh(cell1, cell2) and cell1 != cell2
+                       for cell2 in cells_list)]
+
+
+def test_drop_nested_cells_matches_pairwise():
+    rng = np.random.RandomState(0)
+    for trial in range(1000):
+        size = rng.choice([5, 20, 100])
+        boxes = rng.randint(0, size, size=(rng.randint(0, 60), 4))
+        if len(boxes):
+            duplicates = boxes[rng.randint(0, len(boxes), rng.randint(0, 5))]
+            boxes = np.concatenate([boxes, duplicates])
+        cells_list = [tuple(int(v) for v in box) for box in boxes]
+        expected = drop_nested_cells_pairwise(cells_list)
+        assert _drop_nested_cells(cells_list) == expected, trial
+        assert [tuple(box) for box in _drop_nested_cells(boxes)] == \
+            expected, trial
+
+
+def test_duplicate_cells_are_kept():
+    cells_list = [(0, 0, 10, 10), (2, 2, 3, 3), (0, 0, 10, 10),
+                  (2, 2, 3, 3)]
+    assert _drop_nested_cells(cells_list) == [(0, 0, 10, 10),
+                                              (0, 0, 10, 10)]
+    assert _drop_nested_cells([(1, 1, 5, 5)] * 3) == [(1, 1, 5, 5)] * 3
+
+
+def test_touching_cells():
+    # Neighbour cells sharing a side are not nested
+    cells_list = [(0, 0, 10, 10), (10, 0, 10, 10), (0, 10, 10, 10),
+                  (10, 10, 10, 10)]
+    assert _drop_nested_cells(cells_list) == cells_list
+    # A cell touching the sides of a bigger cell from inside is nested
+    cells_list = [(0, 0, 5, 10), (0, 0, 10, 10), (5, 0, 5, 10),
+                  (0, 0, 10, 4), (2, 6, 8, 4)]
+    assert _drop_nested_cells(cells_list) == [(0, 0, 10, 10)]
+    # Cells that only overlap are kept
+    cells_list = [(0, 0, 10, 10), (5, 5, 10, 10), (9, 0, 2, 20)]
+    assert _drop_nested_cells(cells_list) == cells_list
+
+
+def test_drop_nested_cells_keeps_the_type():
+    boxes = np.array([[0, 0, 10, 10], [1, 1, 2, 2], [20, 0, 5, 5]])
+    result = _drop_nested_cells(boxes)
+    assert isinstance(result, np.ndarray)
+    assert result.tolist() == [[0, 0, 10, 10], [20, 0, 5, 5]]
+    assert _drop_nested_cells([]) == []
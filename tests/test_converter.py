@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+import pytest
+from converter import Converter, LibreOfficeConverter
+from test_scheduler import exited
+
+
+class HungDesktop():
+    def terminate(self):
+        raise RuntimeError("soffice does not respond")
+
+
+def test_converter_is_abstract():
+    with pytest.raises(TypeError):
+        Converter()
+
+
+def test_stop_removes_the_profile_of_the_cli_runs():
+    converter = LibreOfficeConverter()
+    converter.use_uno = False
+    converter.start()
+    os.makedirs(os.path.join(converter.profile_path, "user"))
+    converter.stop()
+    assert not os.path.exists(converter.profile_path)
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"),
+                    reason="reads /proc")
+def test_stop_kills_the_hung_soffice_group():
+    converter = LibreOfficeConverter()
+    # Like the soffice launcher, which forks soffice.bin
+    converter.process = subprocess.Popen(
+        ["sh", "-c", "sleep 600 & echo $!; wait"], stdout=subprocess.PIPE,
+        start_new_session=True)
+    child = int(converter.process.stdout.readline())
+    converter.process.stdout.close()
+    converter.desktop = HungDesktop()
+    converter.started = True
+    os.makedirs(converter.profile_path)
+    converter.stop()
+    assert exited(child)
+    assert not os.path.exists(converter.profile_path)
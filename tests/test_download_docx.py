@@ -0,0 +1,120 @@
+import csv
+import os
+import threading
+import time
+import pandas as pd
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from download_docx import ZIP_SIGNATURE, download_files
+
+DOCX = ZIP_SIGNATURE + b"\0" * 100
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    /docx/*: a .docx, /html/*: an html page, /flaky/*: 503 on the first
+    request then a .docx, /missing/*: 404. Every response takes 50 ms
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(0.05)
+            if self.path.startswith("/docx/"):
+                self.respond(200, DOCX)
+            elif self.path.startswith("/html/"):
+                self.respond(200, b"<html>Not found</html>")
+            elif self.path.startswith("/flaky/") and \
+                    server.requests.count(self.path) == 1:
+                self.respond(503, b"")
+            elif self.path.startswith("/flaky/"):
+                self.respond(200, DOCX)
+            else:
+                self.respond(404, b"")
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def respond(self, code, body):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.active = 0
+    server.max_active = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path, newline="") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["url", "uuid", "status", "size", "attempts"]
+    return {row[1]: row for row in rows[1:]}
+
+
+def test_download_files(server, tmp_path):
+    base = "http://127.0.0.1:%i" % server.server_address[1]
+    paths = ["/docx/a", "/docx/b", "/html/c", "/flaky/d", "/missing/e",
+             "/docx/f"]
+    url_df = pd.DataFrame({"url": [base + path for path in paths],
+                           "uuid": list("abcdef")})
+    folder = os.path.join(str(tmp_path), "docx")
+    os.makedirs(folder)
+    # Downloaded by a previous run
+    open(os.path.join(folder, "f.docx"), "wb").close()
+    manifest_path = os.path.join(str(tmp_path), "manifest.csv")
+
+    counts = download_files(url_df, folder, manifest_path, workers=4,
+                            per_host=4, retries=2, backoff=0.01)
+
+    assert counts == {"ok": 3, "not_docx": 1, "http_404": 1, "exists": 1}
+    assert "/docx/f" not in server.requests
+    assert server.requests.count("/flaky/d") == 2
+    # The 404 is not retried
+    assert server.requests.count("/missing/e") == 1
+    assert sorted(os.listdir(folder)) == ["a.docx", "b.docx", "d.docx",
+                                          "f.docx"]
+    with open(os.path.join(folder, "a.docx"), "rb") as f:
+        assert f.read() == DOCX
+    assert read_manifest(manifest_path) == {
+        "a": [base + "/docx/a", "a", "ok", str(len(DOCX)), "1"],
+        "b": [base + "/docx/b", "b", "ok", str(len(DOCX)), "1"],
+        "c": [base + "/html/c", "c", "not_docx", "0", "1"],
+        "d": [base + "/flaky/d", "d", "ok", str(len(DOCX)), "2"],
+        "e": [base + "/missing/e", "e", "http_404", "0", "1"],
+    }
+
+
+def test_per_host_limit(server, tmp_path):
+    port = server.server_address[1]
+    # Two hosts on the same server
+    urls = ["http://%s:%i/docx/%i" % (host, port, i)
+            for i in range(8) for host in ["127.0.0.1", "localhost"]]
+    url_df = pd.DataFrame({"url": urls,
+                           "uuid": [str(i) for i in range(len(urls))]})
+    folder = str(tmp_path)
+
+    counts = download_files(url_df, folder, workers=8, per_host=1,
+                            backoff=0.01)
+
+    assert counts == {"ok": len(urls)}
+    # One download per host at a time, but both hosts at the same time
+    assert server.max_active == 2
@@ -0,0 +1,40 @@
+import os
+from ledger import JobLedger
+
+
+def statuses(ledger):
+    return dict(ledger.connection.execute("SELECT uuid, status FROM jobs"))
+
+
+def test_csv_statuses_of_every_added_range(tmp_path):
+    with open(os.path.join(str(tmp_path), "failed.csv"), "w") as f:
+        f.write("b.docx\nc.docx\n")
+    with open(os.path.join(str(tmp_path), "processed.csv"), "w") as f:
+        f.write("c.docx\n")
+    ledger = JobLedger(os.path.join(str(tmp_path), "jobs.sqlite"))
+    added = ledger.add_jobs(["a"], 0)
+    assert added == ["a"]
+    ledger.import_csvs(str(tmp_path), added)
+    # A later run over another range
+    added = ledger.add_jobs(["a", "b", "c"], 0)
+    assert added == ["b", "c"]
+    ledger.import_csvs(str(tmp_path), added)
+    assert statuses(ledger) == {"a": "pending", "b": "failed",
+                                "c": "processed"}
+
+
+def test_reset_running_keeps_the_jobs_of_live_runs(tmp_path):
+    ledger = JobLedger(os.path.join(str(tmp_path), "jobs.sqlite"))
+    ledger.add_jobs(["a", "b", "c"], 0)
+    assert ledger.claim(3) == ["a", "b", "c"]
+    # Claimed by this process, which is alive
+    assert ledger.reset_running() == 0
+    # A run that is gone, a run of another host past its lease
+    ledger.connection.execute(
+        "UPDATE jobs SET worker = -1 WHERE uuid = 'a'")
+    ledger.connection.execute(
+        "UPDATE jobs SET host = 'other', claimed_at = 0 WHERE uuid = 'b'")
+    assert ledger.reset_running() == 1
+    assert ledger.reset_running(lease=3600) == 1
+    assert statuses(ledger) == {"a": "pending", "b": "pending",
+                                "c": "running"}
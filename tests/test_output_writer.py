@@ -0,0 +1,73 @@
+import json
+import os
+import tarfile
+from output_writer import ShardWriter, recover_shards
+
+
+class Table():
+    def __init__(self, loc):
+        self.loc = loc
+
+
+def write_documents(writer, names, tables=2, extension=".png"):
+    for name in names:
+        gt_tables_dict = {"%s_0_%i.png" % (name, i): Table([i, 0, 5, 5])
+                          for i in range(tables)}
+        table_images = {table_name: table_name.encode() * 300
+                        for table_name in gt_tables_dict}
+        writer.write(name, gt_tables_dict, table_images, extension)
+
+
+def read_index(shards_path, shard_name):
+    with open(os.path.join(shards_path, shard_name + ".index.json")) as f:
+        return json.load(f)
+
+
+def test_recover_shards_keeps_complete_documents(tmp_path):
+    shards_path = str(tmp_path)
+    # A complete shard with doc0, a killed writer with doc0 done again,
+    # doc1 and doc2 whose last image is cut
+    finished = ShardWriter(shards_path)
+    write_documents(finished, ["doc0"])
+    finished.close()
+    writer = ShardWriter(shards_path)
+    write_documents(writer, ["doc0", "doc1", "doc2"], extension=".webp")
+    base = os.path.join(shards_path, writer.name)
+    tar_size = os.path.getsize(base + ".tar.tmp")
+    with open(base + ".tar.tmp", "r+b") as f:
+        f.truncate(tar_size - 1500)
+    # An incomplete line of doc3
+    with open(base + ".jsonl.tmp", "ab") as f:
+        f.write(b'{"name": "doc3", "tab')
+
+    assert recover_shards(shards_path) == ["doc1"]
+    index = read_index(shards_path, writer.name)
+    assert sorted(index["documents"]) == ["doc1"]
+    assert sorted(index["tables"]) == ["doc1_0_0.png", "doc1_0_1.png"]
+    assert index["extension"] == ".webp"
+
+    with open(base + ".jsonl", "rb") as f:
+        data = f.read()
+    offset, length = index["documents"]["doc1"]
+    assert json.loads(data[offset:offset + length])["name"] == "doc1"
+    with open(base + ".tar", "rb") as f:
+        data = f.read()
+    for table_name, (offset, size) in index["tables"].items():
+        assert data[offset:offset + size] == table_name.encode() * 300
+    with tarfile.open(base + ".tar") as tar:
+        assert tar.getnames() == ["doc1_0_0.webp", "doc1_0_1.webp"]
+    assert not any(file_name.endswith((".tmp", ".recover"))
+                   for file_name in os.listdir(shards_path))
+
+
+def test_recover_shards_without_images(tmp_path):
+    shards_path = str(tmp_path)
+    writer = ShardWriter(shards_path)
+    write_documents(writer, ["doc0"])
+    base = os.path.join(shards_path, writer.name)
+    os.remove(base + ".tar.tmp")
+
+    assert recover_shards(shards_path) == []
+    index = read_index(shards_path, writer.name)
+    assert index["documents"] == {} and index["tables"] == {}
+    assert os.path.getsize(base + ".jsonl") == 0
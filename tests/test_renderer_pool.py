@@ -0,0 +1,106 @@
+import os
+import time
+import pytest
+import converter
+import renderer_pool
+from renderer_pool import RendererPool, get_renderer_pool
+
+
+class StubConverter(converter.Converter):
+    """
+    Saves an empty pdf, fails on bad*.docx, dies on crash*.docx and takes
+    50 ms on slow*.docx
+    """
+    sessions = []
+
+    def __init__(self):
+        super().__init__()
+        self.crashed = False
+        self.stopped = False
+        StubConverter.sessions.append(self)
+
+    def _stop(self):
+        self.stopped = True
+
+    def is_alive(self):
+        return self.started and not self.crashed
+
+    def _convert(self, file_name, in_file, out_file, output_path):
+        if file_name.startswith("bad"):
+            return self._failed('docx_failed', file_name, output_path)
+        if file_name.startswith("crash"):
+            self.crashed = True
+            return self._failed('pdf_failed', file_name, output_path)
+        if file_name.startswith("slow"):
+            time.sleep(0.05)
+        open(out_file, "wb").close()
+        return True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setitem(converter.CONVERTERS, "stub", StubConverter)
+    StubConverter.sessions = []
+    return RendererPool("stub", max_docs=2)
+
+
+def convert(pool, file_names, path):
+    return [pool.convert(file_name, str(path), str(path), str(path))
+            for file_name in file_names]
+
+
+def test_sessions_are_recycled_after_max_docs(pool, tmp_path):
+    file_names = ["%i.docx" % i for i in range(5)]
+    assert convert(pool, file_names, tmp_path) == [None] * 5
+    stats = pool.stats()
+    assert stats["launches"] == 3
+    assert stats["launches_avoided"] == 2
+    assert stats["recycled"] == 2
+    assert [session.stopped for session in StubConverter.sessions] == \
+        [True, True, False]
+    pool.close()
+    assert all(session.stopped for session in StubConverter.sessions)
+
+
+def test_failures_keep_the_session(pool, tmp_path):
+    assert convert(pool, ["bad.docx", "a.docx"], tmp_path) == \
+        ["docx_failed", None]
+    assert pool.stats()["launches"] == 1
+
+
+def test_crashed_sessions_are_replaced(pool, tmp_path):
+    assert convert(pool, ["crash.docx", "a.docx"], tmp_path) == \
+        ["pdf_failed", None]
+    stats = pool.stats()
+    assert stats["crashed"] == 1
+    assert stats["launches"] == 2
+    assert StubConverter.sessions[0].stopped
+
+
+def test_latency_stats(pool, tmp_path):
+    convert(pool, ["a.docx", "b.docx", "slow.docx", "c.docx"], tmp_path)
+    stats = pool.stats()
+    assert stats["conversions"] == 4
+    assert stats["latency_max"] >= 0.05
+    assert stats["latency_median"] < 0.05
+    assert 0.05 / 4 <= stats["latency_mean"] < stats["latency_max"]
+
+
+def test_latency_median_of_the_last_conversions(tmp_path, monkeypatch):
+    monkeypatch.setitem(converter.CONVERTERS, "stub", StubConverter)
+    monkeypatch.setattr(renderer_pool, "LATENCY_WINDOW", 2)
+    pool = RendererPool("stub")
+    convert(pool, ["slow.docx", "a.docx", "b.docx"], tmp_path)
+    stats = pool.stats()
+    assert len(pool.latencies) == 2
+    assert stats["latency_max"] >= 0.05
+    assert stats["latency_median"] < 0.05
+    assert os.path.exists(os.path.join(str(tmp_path), "b.pdf"))
+
+
+def test_pool_grows_to_the_largest_size():
+    # The documents of a process ask for one session, the pipeline for one
+    # per convert worker, in any order
+    pool = get_renderer_pool("test_size", max_docs=10)
+    assert get_renderer_pool("test_size", size=4) is pool
+    assert get_renderer_pool("test_size", size=2).size == 4
@@ -0,0 +1,79 @@
+import os
+import subprocess
+import sys
+import time
+import pytest
+from scheduler import Scheduler, kill_process_tree, track_process, \
+    untrack_process
+
+
+def hang_with_renderer(pid_file, untrack=False):
+    # Like the Word COM server, the process is outside the worker's group
+    process = subprocess.Popen(["sleep", "600"], start_new_session=True)
+    track_process(process.pid)
+    if untrack:
+        untrack_process(process.pid)
+    with open(pid_file, "w") as f:
+        f.write(str(process.pid))
+    time.sleep(600)
+
+
+def hang_after_renderer(pid_file):
+    hang_with_renderer(pid_file, untrack=True)
+
+
+def process_exists(pid):
+    # The killed process is not waited for by its parent, count a zombie as
+    # exited
+    try:
+        with open("/proc/%i/stat" % pid) as f:
+            return f.read().split(")")[-1].split()[0] != "Z"
+    except IOError:
+        return False
+
+
+def exited(pid, seconds=10):
+    deadline = time.time() + seconds
+    while process_exists(pid) and time.time() < deadline:
+        time.sleep(0.1)
+    return not process_exists(pid)
+
+
+def run_until_timeout(function, tmp_path):
+    pid_file = os.path.join(str(tmp_path), "pid")
+    with Scheduler(function, processes=1, timeout=2) as scheduler:
+        results = list(scheduler.imap_unordered([pid_file]))
+    assert [status for _, status, _ in results] == ["timeout"]
+    return int(open(pid_file).read())
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"),
+                    reason="reads /proc")
+def test_timeout_kills_the_tracked_processes(tmp_path):
+    pid = run_until_timeout(hang_with_renderer, tmp_path)
+    assert exited(pid)
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"),
+                    reason="reads /proc")
+def test_timeout_keeps_the_untracked_processes(tmp_path):
+    pid = run_until_timeout(hang_after_renderer, tmp_path)
+    try:
+        assert process_exists(pid)
+    finally:
+        os.kill(pid, 9)
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"),
+                    reason="reads /proc")
+def test_kill_process_tree_kills_the_grandchildren():
+    # Like the soffice launcher, which forks soffice.bin
+    process = subprocess.Popen(["sh", "-c", "sleep 600 & echo $!; wait"],
+                               stdout=subprocess.PIPE,
+                               start_new_session=True)
+    grandchild = int(process.stdout.readline())
+    kill_process_tree(process.pid)
+    process.wait()
+    process.stdout.close()
+    assert not process_exists(process.pid)
+    assert exited(grandchild)
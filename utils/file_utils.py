@@ -25,8 +25,13 @@ def load_dict(path, name):
 def append_to_file(output_path, filename, line):
     """
     Write the given line to the .csv file with the given filename
+
+    The line is written with one write call to a file opened in append
+    mode, so lines of concurrent workers are never interleaved
     """
     csv_path = os.path.join(output_path, filename)
-    with open(csv_path, 'a', newline="\n") as f:
-        f.write(line)
-        f.write("\n")
+    fd = os.open(csv_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (line + "\n").encode("utf-8"))
+    finally:
+        os.close(fd)